@@ -1,6 +1,7 @@
-import os, json
+import os, json, time
 from datetime import datetime
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional, Callable
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeout
 from loguru import logger
 from pathlib import Path
 
@@ -9,6 +10,13 @@ import sys
 sys.path.insert(0, str(Path(__file__).parent.parent.parent))
 from settings import settings
 
+# Shared provider rate limiter from the Viser AI root (llm_gateway.py). Available when
+# the planner runs inside flask_server.py; standalone Core Engine runs skip limiting.
+try:
+    import llm_gateway
+except ImportError:
+    llm_gateway = None
+
 # NOTE: groq and google.generativeai are imported LAZILY inside AIPlanner.__init__
 # to avoid stale module-cache / pycache issues when loaded in a background thread.
 
@@ -58,6 +66,71 @@ Example:
 def _now_id() -> str:
     return datetime.now().strftime("%Y%m%d_%H%M%S_%f")[:-3]
 
+def _usage(resp) -> tuple:
+    """(prompt, completion) tokens from an OpenAI/Groq or Gemini SDK response, 0 if absent."""
+    usage = getattr(resp, "usage", None)
+    if usage is not None:
+        return getattr(usage, "prompt_tokens", 0) or 0, getattr(usage, "completion_tokens", 0) or 0
+    usage = getattr(resp, "usage_metadata", None)
+    if usage is not None:
+        return getattr(usage, "prompt_token_count", 0) or 0, getattr(usage, "candidates_token_count", 0) or 0
+    return 0, 0
+
+def _report(provider: str, model: str, start: float, resp=None, error: Exception = None):
+    """Send one planner call to the gateway's observers (/api/metrics)."""
+    if llm_gateway is None:
+        return
+    prompt_tokens, completion_tokens = _usage(resp) if resp is not None else (0, 0)
+    llm_gateway.report_call({"provider": provider, "model": model, "prompt_tokens": prompt_tokens,
+                             "completion_tokens": completion_tokens,
+                             "latency": time.monotonic() - start if start else 0.0, "error": error})
+
+def _generate_content(model: str, client, prompt: str):
+    """Gemini completion (not rate limited by the gateway), reported to its observers."""
+    start = time.monotonic()
+    try:
+        resp = client.generate_content(prompt)
+    except Exception as e:
+        _report("gemini", model, start, error=e)
+        raise
+    _report("gemini", model, start, resp)
+    return resp
+
+def _create_completion(provider: str, model: str, client, kwargs: Dict[str, Any]):
+    """Groq/OpenAI chat completion through the process-wide rate limiter and circuit breaker."""
+    if llm_gateway is None:
+        return client.chat.completions.create(**kwargs)
+    breaker = llm_gateway.get_breaker(provider, model)
+    if not breaker.allow():
+        raise llm_gateway.CircuitOpen(provider, model, breaker.retry_in())
+    max_tokens = kwargs.get("max_completion_tokens") or kwargs.get("max_tokens") or 0
+    try:
+        llm_gateway.acquire(provider, model, llm_gateway.estimate_tokens(kwargs["messages"], max_tokens),
+                            priority=llm_gateway.PRIORITY_INTERACTIVE)
+    except (llm_gateway.RateLimitExceeded, llm_gateway.RequestTooLarge) as e:
+        breaker.release()
+        _report(provider, model, 0, error=e)
+        raise
+    start = time.monotonic()
+    try:
+        resp = client.chat.completions.create(**kwargs)
+    except Exception as e:
+        if llm_gateway.is_failover_error(e):
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        _report(provider, model, start, error=e)
+        raise
+    breaker.record_success()
+    _report(provider, model, start, resp)
+    return resp
+
+def _is_retryable(exc: Exception) -> bool:
+    """Provider-health failure (429/quota/5xx/timeout) - worth retrying on another provider."""
+    if llm_gateway is not None:
+        return llm_gateway.is_failover_error(exc)
+    return "429" in str(exc) or "insufficient_quota" in str(exc).lower()
+
 class AIPlanner:
     def __init__(self, provider: str = "groq"):
         self.provider = provider.lower()
@@ -97,11 +170,11 @@ class AIPlanner:
                 kwargs["max_completion_tokens"] = 1500
             else:
                 kwargs["max_tokens"] = 1500
-            resp = self.client.chat.completions.create(**kwargs)
+            resp = _create_completion(self.provider, self.model, self.client, kwargs)
             return resp.choices[0].message.content.strip()
         else:  # gemini
             prompt = f"{context_prompt}\nUser Request: {user_request}"
-            resp = self.client.generate_content(prompt)
+            resp = _generate_content(self.model, self.client, prompt)
             return resp.text.strip()
 
     def _save_plan(self, plan_data: Dict[str, Any]) -> str:
@@ -146,11 +219,11 @@ class AIPlanner:
                     kwargs["max_completion_tokens"] = 1000
                 else:
                     kwargs["max_tokens"] = 1000
-                resp = self.client.chat.completions.create(**kwargs)
+                resp = _create_completion(self.provider, self.model, self.client, kwargs)
                 raw = resp.choices[0].message.content.strip()
             else:  # gemini
                 prompt = f"{context_prompt}\nUser Request: {user_request}"
-                resp = self.client.generate_content(prompt)
+                resp = _generate_content(self.model, self.client, prompt)
                 raw = resp.text.strip()
             
             try:
@@ -187,6 +260,7 @@ class AIPlanner:
                 "user_request": user_request,
                 "target_url": target_url,
                 "error": str(e),
+                "retryable": _is_retryable(e),
                 "task_description": user_request,
                 "execution_type": "browser_use",
                 "status":"error"
@@ -235,14 +309,36 @@ class AIPlanner:
                 "user_request": user_request,
                 "target_url": target_url,
                 "error": str(e),
+                "retryable": _is_retryable(e),
                 "objectives": [],
                 "steps": [],
                 "status":"error"
             }
 
-def compare(user_request: str, target_url: str = "") -> Dict[str, Dict[str, Any]]:
-    """Compare planning results from all available providers."""
-    results = {}
+def _error_plan(provider: str, user_request: str, target_url: str, error: str) -> Dict[str, Any]:
+    return {
+        "request_id": _now_id(),
+        "timestamp": datetime.now().isoformat(),
+        "ai_model": f"{provider}/unknown",
+        "user_request": user_request,
+        "target_url": target_url,
+        "error": error,
+        "objectives": [],
+        "steps": [],
+        "status": "error"
+    }
+
+def compare(user_request: str, target_url: str = "", timeout: Optional[float] = None,
+            on_result: Optional[Callable[[str, Dict[str, Any]], None]] = None) -> Dict[str, Dict[str, Any]]:
+    """Compare planning results from all available providers.
+
+    Providers are queried concurrently, so total latency is roughly the slowest
+    provider rather than the sum. A provider that takes longer than `timeout`
+    seconds (COMPARE_TIMEOUT env, default 90) is reported as an error.
+    `on_result(provider, plan)` is called as each provider finishes.
+    """
+    if timeout is None:
+        timeout = float(os.getenv("COMPARE_TIMEOUT", "90"))
     # Only include providers that have keys configured
     candidates = []
     if os.getenv("GROQ_API_KEY"):   candidates.append("groq")
@@ -250,22 +346,35 @@ def compare(user_request: str, target_url: str = "") -> Dict[str, Dict[str, Any]
     if not candidates:
         candidates = ["groq"]  # fallback, will error gracefully
 
-    for provider in candidates:
+    def _run(provider: str) -> Dict[str, Any]:
         try:
-            planner = AIPlanner(provider)
-            plan = planner.plan(user_request, target_url)
-            results[provider] = plan
+            return AIPlanner(provider).plan(user_request, target_url)
         except Exception as e:
-            results[provider] = {
-                "request_id": _now_id(),
-                "timestamp": datetime.now().isoformat(),
-                "ai_model": f"{provider}/unknown",
-                "user_request": user_request,
-                "target_url": target_url,
-                "error": str(e),
-                "objectives": [],
-                "steps": [],
-                "status": "error"
-            }
+            return _error_plan(provider, user_request, target_url, str(e))
+
+    def _done(provider: str, plan: Dict[str, Any]) -> None:
+        results[provider] = plan
+        if on_result:
+            try:
+                on_result(provider, plan)
+            except Exception as e:
+                logger.warning(f"compare on_result callback failed for {provider}: {e}")
+
+    results: Dict[str, Dict[str, Any]] = {}
+    # Not a context manager: a hung provider must not block the return past the timeout
+    pool = ThreadPoolExecutor(max_workers=len(candidates), thread_name_prefix="plan-compare")
+    futures = {pool.submit(_run, provider): provider for provider in candidates}
+    try:
+        for future in as_completed(futures, timeout=timeout):
+            _done(futures[future], future.result())
+    except FuturesTimeout:
+        for future, provider in futures.items():
+            if provider not in results:
+                future.cancel()
+                _done(provider, _error_plan(provider, user_request, target_url,
+                                            f"Timed out after {timeout:.0f}s"))
+    finally:
+        pool.shutdown(wait=False)
 
-    return results
\ No newline at end of file
+    # Keep the configured provider order for callers that render side by side
+    return {provider: results[provider] for provider in candidates}
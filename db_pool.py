@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+"""
+SQLite connection pool and schema migrations for Viser AI.
+
+Connections are long-lived and reused across requests (Flask and Socket.IO run
+a thread per request here, so a per-thread connection would be rebuilt on every
+request). Each connection is configured once - WAL, busy timeout, row factory,
+prepared-statement cache - and schema changes run once at startup through
+versioned migrations tracked in PRAGMA user_version.
+
+WriteBehind buffers hot-path INSERTs and group-commits them from a background
+thread, so request threads never wait on a disk sync.
+"""
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+
+class ConnectionPool:
+    """Small pool of configured sqlite3 connections to one database file."""
+
+    def __init__(self, db_path: str, max_size: int = 8, timeout: float = 30.0, cached_statements: int = 256):
+        self.db_path = db_path
+        self.max_size = max(1, max_size)
+        self.timeout = timeout
+        self.cached_statements = cached_statements
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._all = []
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.waits = 0
+
+    def _open(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=self.timeout,
+                               cached_statements=self.cached_statements)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+
+    def _acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.max_size:
+                self._created += 1
+                try:
+                    conn = self._open()
+                except Exception:
+                    self._created -= 1
+                    raise
+                self._all.append(conn)
+                return conn
+        self.waits += 1
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError(f"no free database connection after {self.timeout:.0f}s")
+
+    def _release(self, conn: sqlite3.Connection):
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection; commits on success, rolls back on error, then returns it."""
+        conn = self._acquire()
+        self.checkouts += 1
+        try:
+            yield conn
+            if conn.in_transaction:
+                conn.commit()
+        except BaseException:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            self._release(conn)
+
+    def migrate(self, migrations: list) -> int:
+        """Apply (version, description, [sql, ...]) migrations newer than PRAGMA user_version.
+
+        Each migration runs in its own transaction together with the version bump.
+        Returns the schema version afterwards.
+        """
+        with self.connection() as conn:
+            current = conn.execute("PRAGMA user_version").fetchone()[0]
+            for version, description, statements in sorted(migrations, key=lambda m: m[0]):
+                if version <= current:
+                    continue
+                try:
+                    conn.execute("BEGIN IMMEDIATE")
+                    for sql in statements:
+                        if callable(sql):
+                            sql(conn)
+                        else:
+                            conn.execute(sql)
+                    conn.execute(f"PRAGMA user_version={int(version)}")
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                print(f"🗄️ DB migration {version}: {description}")
+                current = version
+            return current
+
+    def stats(self) -> dict:
+        return {"size": self._created, "idle": self._idle.qsize(), "max_size": self.max_size,
+                "checkouts": self.checkouts, "waits": self.waits}
+
+    def close_all(self):
+        with self._lock:
+            for conn in self._all:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            self._all.clear()
+            self._created = 0
+        self._idle = queue.LifoQueue()
+
+
+def _is_transient(error: sqlite3.OperationalError) -> bool:
+    """Lock contention / busy database: worth retrying the whole batch later."""
+    message = str(error).lower()
+    return "locked" in message or "busy" in message or "no free database connection" in message
+
+
+class WriteBehind:
+    """Buffers rows for one INSERT statement and group-commits them in the background.
+
+    Rows are flushed every `interval` seconds or as soon as `max_batch` are
+    pending, in a single transaction. `on_batch(conn, rows)` runs inside that
+    transaction in a savepoint (e.g. to maintain derived counters): if it fails only
+    its own writes are rolled back and the rows still commit, since derived data can be
+    rebuilt but the rows cannot; failures are counted in hook_errors. `on_commit(rows)` runs after it
+    has committed (e.g. to tell other processes the rows are readable). Rows stay visible through
+    pending() until their batch has committed, so callers can merge them into reads.
+    Only transient errors (locked/busy) requeue a batch; otherwise it is retried row
+    by row and rows that still fail are logged and dropped, so one bad row cannot
+    block every later write.
+    """
+
+    def __init__(self, pool: ConnectionPool, sql: str, interval: float = 0.05, max_batch: int = 200,
+                 name: str = "db-writer", on_batch=None, on_commit=None):
+        self.pool = pool
+        self.sql = sql
+        self.on_batch = on_batch
+        self.on_commit = on_commit
+        self.interval = interval
+        self.max_batch = max(1, max_batch)
+        self._pending = []
+        self._inflight = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self.batches = 0
+        self.rows = 0
+        self.errors = 0
+        self.dropped = 0
+        self.hook_errors = 0
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def add(self, params: tuple):
+        with self._lock:
+            self._pending.append(params)
+            full = len(self._pending) >= self.max_batch
+        if full or self._closed:
+            self._wake.set()
+
+    def pending(self, predicate=None) -> list:
+        """Rows not yet committed (oldest first), optionally filtered."""
+        with self._lock:
+            rows = self._inflight + self._pending
+        return [r for r in rows if predicate is None or predicate(r)]
+
+    def flush(self) -> int:
+        """Commit everything buffered so far; returns the number of rows written."""
+        written = 0
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    batch = self._pending[:self.max_batch]
+                    if not batch:
+                        return written
+                    del self._pending[:len(batch)]
+                    self._inflight = batch
+                try:
+                    self._commit(batch)
+                except Exception as e:
+                    if isinstance(e, sqlite3.OperationalError) and _is_transient(e):
+                        self.errors += 1
+                        self._requeue(batch)
+                        print(f"⚠️ Write-behind flush error ({len(batch)} rows kept): {e}")
+                        return written
+                    committed = self._commit_rows(batch, e)
+                    if committed is None:  # went transient part-way; the rest is requeued
+                        return written
+                else:
+                    committed = len(batch)
+                    self._committed(batch)
+                with self._lock:
+                    self._inflight = []
+                self.batches += 1
+                self.rows += committed
+                written += committed
+
+    def _commit(self, rows: list):
+        with self.pool.connection() as conn:
+            conn.executemany(self.sql, rows)
+            if self.on_batch:
+                conn.execute("SAVEPOINT write_behind_hook")
+                try:
+                    self.on_batch(conn, rows)
+                except Exception as e:
+                    conn.execute("ROLLBACK TO write_behind_hook")
+                    self.hook_errors += 1
+                    print(f"⚠️ Write-behind on_batch error ({len(rows)} rows kept, derived data now stale): {e}")
+                conn.execute("RELEASE write_behind_hook")
+
+    def _committed(self, rows: list):
+        if self.on_commit:
+            try:
+                self.on_commit(rows)
+            except Exception as e:  # the rows are durable; never retry them over a hook error
+                print(f"⚠️ Write-behind on_commit error: {e}")
+
+    def _requeue(self, rows: list):
+        with self._lock:
+            self._pending[:0] = rows
+            self._inflight = []
+
+    def _commit_rows(self, batch: list, error: Exception):
+        """After a non-transient batch error, commit row by row and drop the rows that still fail.
+
+        Returns the number committed, or None if a transient error stopped it (rest requeued).
+        """
+        self.errors += 1
+        print(f"⚠️ Write-behind batch error, retrying {len(batch)} rows one by one: {error}")
+        committed = 0
+        for i, row in enumerate(batch):
+            try:
+                self._commit([row])
+                committed += 1
+                self._committed([row])
+            except sqlite3.OperationalError as e:
+                if _is_transient(e):
+                    self.rows += committed
+                    self._requeue(batch[i:])
+                    return None
+                self._drop(row, e)
+            except Exception as e:
+                self._drop(row, e)
+        return committed
+
+    def _drop(self, row, error: Exception):
+        self.dropped += 1
+        print(f"⚠️ Write-behind dropped row {str(row)[:200]}: {error}")
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+    def stats(self) -> dict:
+        with self._lock:
+            pending = len(self._pending) + len(self._inflight)
+        return {"pending": pending, "batches": self.batches, "rows": self.rows, "errors": self.errors,
+                "dropped": self.dropped, "hook_errors": self.hook_errors,
+                "interval_ms": int(self.interval * 1000), "max_batch": self.max_batch}
+
+    def close(self, timeout: float = 5.0):
+        """Stop the background thread and flush what is left (call on shutdown)."""
+        self._closed = True
+        self._wake.set()
+        self._thread.join(timeout)
+        deadline = time.time() + timeout
+        while self.pending() and time.time() < deadline:
+            if not self.flush():
+                time.sleep(0.05)
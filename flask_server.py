@@ -12,11 +12,14 @@ if sys.platform == "win32":
     except (AttributeError, OSError):
         pass
 
-from flask import Flask, request, jsonify, send_file, send_from_directory
+from flask import Flask, Request, request, jsonify, send_file, send_from_directory, g, has_request_context
 from flask_cors import CORS
 from werkzeug.routing import PathConverter, BaseConverter
 import os
 import json
+import re
+import atexit
+import html
 from dotenv import load_dotenv
 from pathlib import Path
 
@@ -32,6 +35,8 @@ import time
 import requests
 import traceback
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge
+import hashlib
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
@@ -41,8 +46,15 @@ from datetime import datetime, date, timedelta
 import base64
 from io import BytesIO
 import threading
+from concurrent.futures import ThreadPoolExecutor
 import asyncio
 from flask_socketio import SocketIO, emit
+import llm_gateway
+from session_cache import SessionCache
+from state_store import create_store
+from text_cache import ExtractionCache, file_sha256
+from pdf_extract import PdfEngine
+from upload_store import HashingSpool, UploadTooLarge, copy_stream, sweep_stale
 try:
     import schedule
     SCHEDULE_AVAILABLE = True
@@ -84,6 +96,20 @@ try:
 except ImportError:
     GOOGLE_SHEETS_AVAILABLE = False
 
+# Upload ingestion extras (image thumbnails, language detection)
+try:
+    from PIL import Image as PILImage
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
+try:
+    from langdetect import DetectorFactory, detect as _langdetect
+    DetectorFactory.seed = 0  # langdetect is randomised; same text must give the same language
+    LANGDETECT_AVAILABLE = True
+except ImportError:
+    LANGDETECT_AVAILABLE = False
+
 # Core Engine 2.0 integration
 CORE_ENGINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Core Engine 2.0")
 sys.path.insert(0, os.path.join(CORE_ENGINE_DIR, "src"))
@@ -106,6 +132,65 @@ except ImportError:
     TOON_AVAILABLE = False
     toon_encode = None
 
+# Older chat turns are folded into one TOON block; the newest turns stay native messages
+PROMPT_TOON_HISTORY = os.getenv("PROMPT_TOON_HISTORY", "true").lower() == "true"
+PROMPT_HISTORY_NATIVE_MESSAGES = int(os.getenv("PROMPT_HISTORY_NATIVE_MESSAGES", "6"))
+
+
+def prompt_encode(data, kind: str = "data", record: bool = True, baseline_tokens: int = None) -> str:
+    """Serialize structured data for an LLM prompt: TOON when available, else compact JSON.
+
+    Token savings are recorded per endpoint/kind in /api/metrics, measured against plain
+    json.dumps unless the caller passes what the prompt would have cost (baseline_tokens).
+    """
+    encoded = None
+    if TOON_AVAILABLE:
+        try:
+            encoded = toon_encode(data)
+        except Exception as e:
+            print(f"⚠️ TOON encode failed ({kind}): {e}")
+    if encoded is None:
+        encoded = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+    if not record:
+        return encoded
+    try:
+        _LLM_METRICS.record_serialization(
+            _llm_call_tags().get("endpoint", "background"), kind,
+            "toon" if TOON_AVAILABLE else "json",
+            baseline_tokens if baseline_tokens is not None
+            else llm_gateway.estimate_tokens(json.dumps(data, ensure_ascii=False)),
+            llm_gateway.estimate_tokens(encoded)
+        )
+    except NameError:
+        pass  # metrics not set up yet (module import)
+    return encoded
+
+
+def prompt_encode_records(records: list, max_chars: int, kind: str = "records"):
+    """Encode as many whole records as fit in max_chars. Returns (text, records_included).
+
+    Replaces json.dumps(...)[:N], which cut the last record in half.
+    """
+    count = len(records)
+    text = prompt_encode(records, kind, record=False)
+    while count > 1 and len(text) > max_chars:
+        # Shrink proportionally, then step down one at a time
+        count = max(1, min(count - 1, int(count * max_chars / len(text))))
+        text = prompt_encode(records[:count], kind, record=False)
+    return prompt_encode(records[:count], kind)[:max_chars], count
+
+
+def prompt_compact_text(text: str, kind: str = "document") -> str:
+    """Re-encode pasted JSON (e.g. an OpenAPI snippet) compactly; other text is returned unchanged."""
+    stripped = (text or "").strip()
+    if not stripped or stripped[0] not in "{[":
+        return text
+    try:
+        data = json.loads(stripped)
+    except ValueError:
+        return text
+    return prompt_encode(data, kind)
+
 
 def tonnify_preprocess(user_prompt: str) -> str:
     """
@@ -126,8 +211,41 @@ class StaticPathConverter(BaseConverter):
     """Matches static file paths only. Excludes /api/* so API routes take precedence."""
     regex = r'(?!api/).+'
 
+# ─── Upload limits ───
+# Multipart file parts are streamed into a HashingSpool (spooled temp file, sha256
+# on the fly) that enforces the per-type cap while the body is still being read.
+UPLOAD_LIMITS_MB = {
+    "image": float(os.getenv("UPLOAD_MAX_IMAGE_MB", "20")),
+    "document": float(os.getenv("UPLOAD_MAX_DOCUMENT_MB", "100")),
+    "other": float(os.getenv("UPLOAD_MAX_OTHER_MB", "50")),
+}
+UPLOAD_TMP_DIR = "uploads/tmp"
+
+def upload_limit_bytes(filename: str) -> int:
+    file_type = get_file_type(os.path.splitext(filename or "")[1])
+    return int(UPLOAD_LIMITS_MB.get(file_type, UPLOAD_LIMITS_MB["other"]) * 1024 * 1024)
+
+# Routes whose whole body may exceed the app-wide cap (several files per request)
+ROUTE_BODY_LIMITS = {
+    "hr_resume_analyze": int(float(os.getenv("UPLOAD_MAX_RESUME_BATCH_MB", "200")) * 1024 * 1024),
+}
+
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        os.makedirs(UPLOAD_TMP_DIR, exist_ok=True)
+        return HashingSpool(upload_limit_bytes(filename), filename, dir=UPLOAD_TMP_DIR)
+
+    @property
+    def max_content_length(self):
+        limit = ROUTE_BODY_LIMITS.get(self.endpoint)
+        return limit if limit is not None else super().max_content_length
+
 app = Flask(__name__)
+app.request_class = UploadRequest
 app.config['SECRET_KEY'] = 'viser-ai-secret-key'
+# Whole-body cap (largest per-type limit plus form overhead), checked against Content-Length up front;
+# multi-file routes get their own cap in ROUTE_BODY_LIMITS
+app.config['MAX_CONTENT_LENGTH'] = int((max(UPLOAD_LIMITS_MB.values()) + 1) * 1024 * 1024)
 app.url_map.converters['staticpath'] = StaticPathConverter
 CORS(app)
 
@@ -154,11 +272,14 @@ class WebUILogger:
 ui_logger = WebUILogger(socketio)
 automation_running = False
 
-# Global variables for throttling and context
-last_openai_call = 0.0
-
-# Session storage for context awareness
-user_sessions = {}
+# Session storage for context awareness: bounded LRU (entries + approx bytes) with an
+# idle-TTL sweeper. Messages and documents are written through to SQLite, so an
+# evicted session is simply reloaded on its next access.
+user_sessions = SessionCache(
+    max_entries=int(os.getenv("SESSION_CACHE_MAX_ENTRIES", "500")),
+    max_bytes=int(float(os.getenv("SESSION_CACHE_MAX_MB", "64")) * 1024 * 1024),
+    idle_ttl=float(os.getenv("SESSION_IDLE_TTL", "3600")),
+)
 uploaded_files_context = {}
 
 
@@ -191,52 +312,78 @@ def strip_user_prefix(session_id, user_id=None):
     return session_id[len(prefix):] if session_id.startswith(prefix) else session_id
 
 
+_SESSION_VERSION_TTL = 7 * 86400
+
+def _session_version(session_id) -> int:
+    return _STATE.get(f"session_version:{session_id}", 0) if _STATE.shared else 0
+
+def _session_changed(session_id, session):
+    """With a shared state backend, bump the session's version so other workers
+    drop their cached copy and reload it from SQLite on next access.
+
+    Call it once the change is in SQLite: new chat messages bump it from the chat
+    writer after their batch commits (_chat_rows_committed), not on the request path.
+    """
+    if not _STATE.shared:
+        return
+    version = _STATE.incr(f"session_version:{session_id}", ttl=_SESSION_VERSION_TTL)
+    if session is not None and version == session.get("_version", 0) + 1:
+        session["_version"] = version  # nobody else changed it in between; our copy is current
+
+def _chat_rows_committed(rows):
+    """Chat writer hook: a batch is durable, so other workers may now reload its sessions."""
+    if _STATE.shared:
+        for session_id in dict.fromkeys(row[0] for row in rows):
+            _session_changed(session_id, user_sessions.peek(session_id))
+
+
 class ContextManager:
     """Manages conversation and file context for users"""
     
     @staticmethod
     def get_session(session_id):
-        """Get or create user session, restoring from DB if not in memory."""
-        if session_id not in user_sessions:
-            history = db_load_session(session_id, limit=60)
-            user_sessions[session_id] = {
-                "conversation_history": history,
-                "uploaded_files": [],
-                "last_activity": time.time()
+        """Get or create user session, restoring from DB if not in memory (or if another
+        worker changed it since it was cached)."""
+        session = user_sessions.get(session_id)
+        if session is not None and _STATE.shared and session.get("_version", 0) != _session_version(session_id):
+            session = None
+        if session is None:
+            version = _session_version(session_id)
+            session = {
+                "conversation_history": _history_with_summary(session_id, db_load_session(session_id, limit=60)),
+                "uploaded_files": db_list_documents(session_id),
+                "last_activity": time.time(),
+                "_version": version
             }
-        return user_sessions[session_id]
+            user_sessions[session_id] = session
+        return session
     
     @staticmethod
     def add_message(session_id, role, content):
         """Add message to conversation history and persist to SQLite."""
         session = ContextManager.get_session(session_id)
-        session["conversation_history"].append({
-            "role": role,
-            "content": content,
-            "timestamp": time.time()
-        })
-        session["last_activity"] = time.time()
+        now = time.time()
+        with _SUMMARY_LOCK:
+            session["conversation_history"].append({
+                "role": role,
+                "content": content,
+                "timestamp": now
+            })
+        session["last_activity"] = now
         # Persist to DB
-        db_save_message(session_id, role, content)
+        db_save_message(session_id, role, content, ts=now)  # version bumped once the row commits
+        user_sessions.touch(session_id, added=session["conversation_history"][-1])
 
-        # Smart context: when history is long, summarise old messages
+        # Smart context: when history is long, fold old messages into the rolling
+        # summary in the background (never on the chat request path)
         if len(session["conversation_history"]) > _SUMMARIZE_THRESHOLD:
-            old  = session["conversation_history"][:-_SUMMARIZE_KEEP]
-            keep = session["conversation_history"][-_SUMMARIZE_KEEP:]
-            summary = _summarize_old_messages(old)
-            if summary:
-                session["conversation_history"] = [
-                    {"role": "system", "content": f"[Earlier conversation summary]\n{summary}",
-                     "timestamp": time.time()}
-                ] + keep
-            else:
-                session["conversation_history"] = keep
+            _schedule_summary(session_id, session)
 
     @staticmethod
     def add_file_context(session_id, file_info):
-        """Add uploaded file to context"""
+        """Add uploaded file to context and record it in the documents table"""
         session = ContextManager.get_session(session_id)
-        session["uploaded_files"].append({
+        document = {
             "filename": file_info["filename"],
             "path": file_info["path"],
             "size": file_info["size"],
@@ -244,9 +391,16 @@ class ContextManager:
             "type": file_info.get("type", "unknown"),  # Include file type
             "extension": file_info.get("extension", ""),  # Include extension
             "upload_time": time.time(),
-            "analyzed": False
-        })
+            "analyzed": False,
+            "sha256": file_info.get("sha256"),
+            "ingest": {"status": "none"}
+        }
+        db_save_document(session_id, document)
+        session["uploaded_files"].append(document)
         session["last_activity"] = time.time()
+        user_sessions.touch(session_id, added=document)
+        _session_changed(session_id, session)
+        return document
     
     @staticmethod
     def get_conversation_context(session_id, include_files=True):
@@ -284,11 +438,20 @@ TABLE RULES (use tables ONLY when explicitly requested):
             if context_lines:
                 system_message += "\n\nFILE CONTEXT:\n" + "\n".join(context_lines)
         
+        # Add recent conversation history (last 10 exchanges)
+        recent_history = session["conversation_history"][-20:]  # Last 20 messages (10 exchanges)
+        if TOON_AVAILABLE and PROMPT_TOON_HISTORY and len(recent_history) > PROMPT_HISTORY_NATIVE_MESSAGES:
+            # Fold older turns into one compact TOON table; newest turns stay as real messages
+            split = len(recent_history) - PROMPT_HISTORY_NATIVE_MESSAGES
+            older = [{"role": m["role"], "content": m["content"]} for m in recent_history[:split]]
+            # Savings are measured against these turns sent as native messages, not as JSON
+            system_message += ("\n\nEARLIER CONVERSATION (TOON, oldest first; newer messages follow as chat turns):\n"
+                               + prompt_encode(older, "history", baseline_tokens=llm_gateway.estimate_tokens(older)))
+            recent_history = recent_history[split:]
+
         # Build message history
         messages = [{"role": "system", "content": system_message}]
         
-        # Add recent conversation history (last 10 exchanges)
-        recent_history = session["conversation_history"][-20:]  # Last 20 messages (10 exchanges)
         for msg in recent_history:
             messages.append({
                 "role": msg["role"],
@@ -304,23 +467,38 @@ TABLE RULES (use tables ONLY when explicitly requested):
         for file_info in session["uploaded_files"]:
             if file_info["filename"] == filename:
                 file_info["analyzed"] = True
+                db_mark_document_analyzed(session_id, file_info.get("fileId", ""))
+                _session_changed(session_id, session)
                 break
     
     @staticmethod
     def cleanup_old_sessions():
-        """Clean up sessions older than 24 hours"""
-        current_time = time.time()
-        expired_sessions = []
-        
-        for session_id, session in user_sessions.items():
-            if current_time - session["last_activity"] > 86400:  # 24 hours
-                expired_sessions.append(session_id)
-        
-        for session_id in expired_sessions:
-            del user_sessions[session_id]
+        """Evict idle sessions now (the session cache's sweeper also does this in the background)."""
+        return user_sessions.sweep()
+
+# Automation State: one task at a time across all workers (lock in the state store;
+# the TTL frees it if a worker dies mid-task)
+_AUTOMATION_LOCK = "automation:running"
+_AUTOMATION_LOCK_TTL = 3600
+
+def is_automation_running() -> bool:
+    return _STATE.get(_AUTOMATION_LOCK) is not None
+
 
-# Automation State
-is_automation_running = False
+def _plan_with_failover(provider: str, method: str, *args, **kwargs) -> dict:
+    """Run AIPlanner(provider).<method>(...), retrying with the next healthy provider when
+    the plan failed on a provider-health error (429/quota/5xx/timeout/open circuit)."""
+    from spec2.ai_planner import AIPlanner
+    plan = getattr(AIPlanner(provider), method)(*args, **kwargs)
+    if not plan.get('error') or not plan.get('retryable'):
+        return plan
+    for alt in llm_gateway.healthy_providers(exclude=provider):
+        ui_logger.log('INFO', f'⚠️ {provider} unavailable, retrying with {alt}...')
+        plan = getattr(AIPlanner(alt), method)(*args, **kwargs)
+        if not plan.get('error') or not plan.get('retryable'):
+            break
+        provider = alt
+    return plan
 
 @socketio.on('connect')
 def handle_connect():
@@ -330,9 +508,7 @@ def handle_connect():
 @socketio.on('execute_task')
 def handle_execute_task(data):
     """Handle task execution request from web UI"""
-    global is_automation_running
-    
-    if is_automation_running:
+    if is_automation_running():
         emit('error', {'message': 'An automation task is already running'})
         return
         
@@ -350,14 +526,16 @@ def handle_execute_task(data):
         emit('error', {'message': 'Core Engine 2.0 not available on this server'})
         return
 
-    # Start task in background
+    if not _STATE.add(_AUTOMATION_LOCK, {"pid": os.getpid(), "since": time.time()}, ttl=_AUTOMATION_LOCK_TTL):
+        emit('error', {'message': 'An automation task is already running'})
+        return
+
+    # Start task in background (releases the lock when done)
     socketio.start_background_task(run_core_engine_task, url, prompt, provider)
 
 def run_core_engine_task(url, prompt, provider):
     """Execute Core Engine 2.0 task following original logic exactly."""
-    global is_automation_running
     try:
-        is_automation_running = True
         ui_logger.log('INFO', 'Starting Core Engine 2.0...')
         ui_logger.log('INFO', f'Target URL: {url}')
         ui_logger.log('INFO', f'Task: {prompt}')
@@ -371,7 +549,6 @@ def run_core_engine_task(url, prompt, provider):
         asyncio.set_event_loop(loop)
         
         try:
-            from spec2.ai_planner import AIPlanner
             from spec2.intent_router import infer_intent
             from spec2.executor import run_with_browser_use, run_async
             
@@ -380,14 +557,9 @@ def run_core_engine_task(url, prompt, provider):
             intent = infer_intent(prompt)
             ui_logger.log('INFO', f'📋 Detected intent: {intent}')
             
-            # Plan the task (fallback to Groq if OpenAI returns 429)
+            # Plan the task (fails over to the next healthy provider on 429/5xx/timeouts)
             ui_logger.log('INFO', '🗂️ Planning objectives...')
-            planner = AIPlanner(provider)
-            plan = planner.plan_for_browser_use(prompt, target_url=url)
-            if plan.get('error') and ('429' in str(plan.get('error', '')) or 'insufficient_quota' in str(plan.get('error', '')).lower()) and provider == 'openai' and os.getenv('GROQ_API_KEY'):
-                ui_logger.log('INFO', '⚠️ OpenAI quota exceeded, retrying with Groq...')
-                planner = AIPlanner('groq')
-                plan = planner.plan_for_browser_use(prompt, target_url=url)
+            plan = _plan_with_failover(provider, 'plan_for_browser_use', prompt, target_url=url)
             if plan.get('error'):
                 ui_logger.log('ERROR', f'❌ Planning failed: {plan["error"]}')
                 socketio.emit('error', {'message': f'Planning failed: {plan["error"]}'})
@@ -439,7 +611,7 @@ def run_core_engine_task(url, prompt, provider):
         print(f"❌ Automation crash: {str(e)}")
         socketio.emit('error', {'message': f'Internal engine error: {str(e)}'})
     finally:
-        is_automation_running = False
+        _STATE.delete(_AUTOMATION_LOCK)
         socketio.emit('task_completed')
 
 
@@ -480,7 +652,6 @@ def handle_plan_task(data):
 def _plan_task_bg(prompt: str, url: str, provider: str) -> None:
     """Background task: run AI planning without browser execution."""
     try:
-        from spec2.ai_planner import AIPlanner, compare
         from spec2.intent_router import infer_intent
 
         ui_logger.log('INFO', f'🎯 Planning: {prompt}')
@@ -495,12 +666,7 @@ def _plan_task_bg(prompt: str, url: str, provider: str) -> None:
             _plan_compare_bg(prompt, url, intent)
             return
 
-        planner = AIPlanner(provider)
-        plan = planner.plan(prompt, url)
-        if plan.get('error') and ('429' in str(plan.get('error', '')) or 'insufficient_quota' in str(plan.get('error', '')).lower()) and provider == 'openai' and os.getenv('GROQ_API_KEY'):
-            ui_logger.log('INFO', '⚠️ OpenAI quota exceeded, retrying with Groq...')
-            planner = AIPlanner('groq')
-            plan = planner.plan(prompt, url)
+        plan = _plan_with_failover(provider, 'plan', prompt, url)
         if plan.get('error'):
             ui_logger.log('ERROR', f'❌ Planning failed: {plan["error"]}')
             socketio.emit('error', {'message': f'Planning failed: {plan["error"]}'})
@@ -524,15 +690,20 @@ def _plan_compare_bg(prompt: str, url: str, intent: str) -> None:
     try:
         from spec2.ai_planner import compare
         ui_logger.log('INFO', '🔄 Comparing all available providers...')
-        results = compare(prompt, url)
+        partial = {}
 
-        for prov, result in results.items():
+        def _on_result(prov, result):
             if result.get('error'):
                 ui_logger.log('ERROR', f'❌ {prov.upper()}: {result["error"]}')
             else:
                 n = len(result.get('steps', []))
                 ui_logger.log('INFO', f'✅ {prov.upper()}: {n} steps')
+            # Providers run concurrently - push each plan as soon as it lands
+            partial[prov] = result
+            socketio.emit('plan_partial', {'type': 'compare', 'provider': prov,
+                                           'results': dict(partial), 'intent': intent})
 
+        results = compare(prompt, url, on_result=_on_result)
         socketio.emit('plan_ready', {'type': 'compare', 'results': results, 'intent': intent})
 
     except Exception as exc:
@@ -564,19 +735,13 @@ def handle_enhance_plan(data):
 def _enhance_plan_bg(raw: str, filename: str, provider: str, url: str) -> None:
     """Background task: use AI to improve an uploaded plan."""
     try:
-        from spec2.ai_planner import AIPlanner
         ui_logger.log('INFO', f'📂 Enhancing plan: {filename}')
-        planner = AIPlanner(provider)
         prompt = (
             "Please read and improve this execution plan. Convert it into specific, "
             "actionable browser automation steps. Fix structure, rephrase steps, and "
             f"return detailed JSON with a steps list.\n\nFile: {filename}\n\nContent:\n\n{raw}"
         )
-        plan = planner.plan(prompt, url)
-        if plan.get('error') and ('429' in str(plan.get('error', '')) or 'insufficient_quota' in str(plan.get('error', '')).lower()) and provider == 'openai' and os.getenv('GROQ_API_KEY'):
-            ui_logger.log('INFO', '⚠️ OpenAI quota exceeded, retrying with Groq...')
-            planner = AIPlanner('groq')
-            plan = planner.plan(prompt, url)
+        plan = _plan_with_failover(provider, 'plan', prompt, url)
         if plan.get('error'):
             ui_logger.log('ERROR', f'❌ Enhancement failed: {plan["error"]}')
             socketio.emit('error', {'message': f'Enhancement failed: {plan["error"]}'})
@@ -721,31 +886,55 @@ def unsplash_random():
         return jsonify({"enabled": True, "error": str(e)}), 500
 
 
+# ─── Extracted-text cache ────────────────────────────────────────────────────
+# Keyed by sha256(file) + extractor version; bump the version suffix when the
+# extraction logic changes so stale text is never served.
+_TEXT_CACHE = ExtractionCache(
+    "data/text_cache",
+    max_memory_bytes=int(float(os.getenv("TEXT_CACHE_MEMORY_MB", "64")) * 1024 * 1024),
+    max_disk_bytes=int(float(os.getenv("TEXT_CACHE_DISK_MB", "1024")) * 1024 * 1024),
+)
+
+def _extract_docx_text(file_path):
+    from docx import Document
+    doc = Document(file_path)
+    content = []
+    for paragraph in doc.paragraphs:
+        if paragraph.text.strip():
+            content.append(paragraph.text.strip())
+    return '\n'.join(content)
+
+# PDF pages are extracted in worker processes, sharded by page range, so a large
+# PDF neither holds the GIL on a request thread nor runs past its budgets. Workers
+# are forked by the server entry point (__main__), not on import, so CLI runs and
+# tooling imports extract in-process instead of forking a pool.
+_PDF_ENGINE = PdfEngine(
+    workers=int(os.getenv("PDF_EXTRACT_WORKERS", "0")) or None,
+    pages_per_shard=int(os.getenv("PDF_EXTRACT_PAGES_PER_SHARD", "8")),
+    timeout=float(os.getenv("PDF_EXTRACT_TIMEOUT", "120")),
+    max_pages=int(os.getenv("PDF_EXTRACT_MAX_PAGES", "2000")),
+    max_chars=int(os.getenv("PDF_EXTRACT_MAX_CHARS", "5000000")),
+    max_worker_mb=int(os.getenv("PDF_WORKER_MAX_MB", "1024")),
+)
+atexit.register(_PDF_ENGINE.shutdown)
+
 def extract_docx_content(file_path):
-    """Extract text content from .docx files"""
+    """Extract text content from .docx files (cached by content hash)"""
     try:
-        from docx import Document
-        doc = Document(file_path)
-        content = []
-        for paragraph in doc.paragraphs:
-            if paragraph.text.strip():
-                content.append(paragraph.text.strip())
-        return '\n'.join(content)
+        import docx
+        version = f"docx{getattr(docx, '__version__', '')}.1"
+        return _TEXT_CACHE.get_or_extract(file_path, "docx", version, _extract_docx_text)
     except ImportError:
         return "Error: python-docx library not installed. Cannot read .docx files."
     except Exception as e:
         return f"Error reading .docx file: {str(e)}"
 
 def extract_pdf_content(file_path):
-    """Extract text content from PDF files"""
+    """Extract text content from PDF files (cached by content hash)"""
     try:
         import PyPDF2
-        content = []
-        with open(file_path, 'rb') as file:
-            pdf_reader = PyPDF2.PdfReader(file)
-            for page in pdf_reader.pages:
-                content.append(page.extract_text())
-        return '\n'.join(content)
+        version = f"pypdf2{PyPDF2.__version__}.1{_PDF_ENGINE.version}"
+        return _TEXT_CACHE.get_or_extract(file_path, "pdf", version, _PDF_ENGINE.extract)
     except ImportError:
         return "Error: PyPDF2 library not installed. Cannot read PDF files."
     except Exception as e:
@@ -789,30 +978,27 @@ def extract_image_content(file_path):
 def analyze_image_with_vision(file_path, prompt="Analyze this image and describe what you see"):
     """Analyze image using OpenAI Vision API (Gemini removed)"""
     try:
-        import base64
         image_content = extract_image_content(file_path)
         if not image_content:
             return "❌ Failed to extract image content"
         openai_key = CONFIG.get("OPENAI_API_KEY")
         if not openai_key:
             return "❌ OpenAI API key not configured for image analysis"
-        import openai as _oai
-        client = _oai.OpenAI(api_key=openai_key)
-        with open(file_path, "rb") as f:
-            b64 = base64.b64encode(f.read()).decode()
+        b64 = image_content["base64_data"]
         mime = image_content.get("mime_type", "image/jpeg")
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{
+        content = llm_gateway.complete(
+            "openai",
+            [{
                 "role": "user",
                 "content": [
                     {"type": "text", "text": prompt},
                     {"type": "image_url", "image_url": {"url": f"data:{mime};base64,{b64}"}}
                 ]
             }],
+            model="gpt-4o-mini",
+            temperature=None,
             max_tokens=1024
         )
-        content = response.choices[0].message.content
         print(f"✅ Image analysis completed: {len(content)} characters")
         return content
     except Exception as e:
@@ -1300,15 +1486,19 @@ def get_ai_provider():
 
 # ─── SQLite Chat Persistence ───────────────────────────────────────────────────
 import sqlite3
+from db_pool import ConnectionPool, WriteBehind
 
 _DB_PATH = os.path.join(os.path.dirname(__file__), "data", "chat_history.db")
-
-def _get_db():
-    os.makedirs(os.path.dirname(_DB_PATH), exist_ok=True)
-    conn = sqlite3.connect(_DB_PATH, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA journal_mode=WAL")
-    conn.execute("""
+_DB = ConnectionPool(_DB_PATH, max_size=int(os.getenv("DB_POOL_SIZE", "8")))
+# Email-flow state, automation lock and session versions. STATE_BACKEND=sqlite shares
+# them (through chat_history.db) between worker processes; the default is in-memory.
+_STATE = create_store(os.getenv("STATE_BACKEND", "memory"), pool=_DB)
+
+# Versioned schema: (version, description, statements). Applied once at startup;
+# add new entries at the end, never edit an applied one.
+_DB_MIGRATIONS = [
+    (1, "chat_messages and saved_items", [
+        """
         CREATE TABLE IF NOT EXISTS chat_messages (
             id        INTEGER PRIMARY KEY AUTOINCREMENT,
             session_id TEXT NOT NULL,
@@ -1316,73 +1506,406 @@ def _get_db():
             content   TEXT NOT NULL,
             ts        REAL NOT NULL
         )
-    """)
-    conn.execute("CREATE INDEX IF NOT EXISTS idx_session ON chat_messages(session_id, ts)")
-    conn.commit()
-    return conn
-
-def db_save_message(session_id: str, role: str, content: str):
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_session ON chat_messages(session_id, ts)",
+        """
+        CREATE TABLE IF NOT EXISTS saved_items (
+            id        INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id   TEXT NOT NULL DEFAULT 'anonymous',
+            tool      TEXT NOT NULL,
+            category  TEXT NOT NULL,
+            title     TEXT NOT NULL,
+            content   TEXT NOT NULL,
+            input_text TEXT NOT NULL DEFAULT '',
+            ts        REAL NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_saved_user ON saved_items(user_id, ts)",
+    ]),
+    (2, "chat_messages.user_id / short_session_id with per-user indexes", [
+        "ALTER TABLE chat_messages ADD COLUMN user_id TEXT",
+        "ALTER TABLE chat_messages ADD COLUMN short_session_id TEXT",
+        # Backfill from the "{user_id}:{session}" prefix; unscoped sessions keep user_id NULL
+        """
+        UPDATE chat_messages SET
+            user_id = CASE WHEN instr(session_id, ':') > 0
+                           THEN substr(session_id, 1, instr(session_id, ':') - 1) END,
+            short_session_id = substr(session_id, instr(session_id, ':') + 1)
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_chat_user_ts ON chat_messages(user_id, ts)",
+        "CREATE INDEX IF NOT EXISTS idx_chat_user_session ON chat_messages(user_id, session_id, ts)",
+    ]),
+    (3, "analytics_rollup counters", [
+        """
+        CREATE TABLE IF NOT EXISTS analytics_rollup (
+            user_id   TEXT NOT NULL,
+            dim       TEXT NOT NULL,
+            key       TEXT NOT NULL,
+            count     INTEGER NOT NULL DEFAULT 0,
+            last_ts   REAL,
+            PRIMARY KEY (user_id, dim, key)
+        ) WITHOUT ROWID
+        """,
+        lambda conn: analytics_rebuild(conn=conn),
+    ]),
+    (4, "documents table for uploaded-file metadata", [
+        """
+        CREATE TABLE IF NOT EXISTS documents (
+            file_id     TEXT PRIMARY KEY,
+            user_id     TEXT,
+            session_id  TEXT NOT NULL,
+            filename    TEXT NOT NULL,
+            path        TEXT NOT NULL,
+            size        INTEGER NOT NULL DEFAULT 0,
+            type        TEXT NOT NULL DEFAULT 'unknown',
+            extension   TEXT NOT NULL DEFAULT '',
+            uploaded_at REAL NOT NULL,
+            analyzed    INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_documents_session ON documents(user_id, session_id, uploaded_at)",
+        "CREATE INDEX IF NOT EXISTS idx_documents_user ON documents(user_id, uploaded_at)",
+    ]),
+    (5, "session_summary rolling conversation summaries", [
+        """
+        CREATE TABLE IF NOT EXISTS session_summary (
+            session_id TEXT PRIMARY KEY,
+            summary    TEXT NOT NULL,
+            through_ts REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        """,
+    ]),
+    (6, "chat_sessions summary and keyset pagination indexes", [
+        """
+        CREATE TABLE IF NOT EXISTS chat_sessions (
+            session_id       TEXT PRIMARY KEY,
+            user_id          TEXT,
+            short_session_id TEXT NOT NULL,
+            count            INTEGER NOT NULL DEFAULT 0,
+            last_ts          REAL NOT NULL
+        )
+        """,
+        """
+        INSERT OR IGNORE INTO chat_sessions(session_id,user_id,short_session_id,count,last_ts)
+        SELECT session_id, user_id, short_session_id, COUNT(*), MAX(ts) FROM chat_messages GROUP BY session_id
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_chat_sessions_user ON chat_sessions(user_id, last_ts, session_id)",
+        "CREATE INDEX IF NOT EXISTS idx_chat_sessions_ts ON chat_sessions(last_ts, session_id)",
+        "CREATE INDEX IF NOT EXISTS idx_saved_user_category ON saved_items(user_id, category, ts)",
+    ]),
+    (7, "FTS5 search over chat_messages and saved_items", [
+        lambda conn: _create_search_index(conn),
+    ]),
+    (8, "ingestion status on documents", [
+        "ALTER TABLE documents ADD COLUMN ingest_status TEXT NOT NULL DEFAULT 'none'",
+        "ALTER TABLE documents ADD COLUMN ingest_info TEXT",
+    ]),
+    (9, "content-addressed upload blobs", [
+        "ALTER TABLE documents ADD COLUMN sha256 TEXT",
+        "CREATE INDEX IF NOT EXISTS idx_documents_sha ON documents(sha256)",
+        """
+        CREATE TABLE IF NOT EXISTS blobs (
+            path       TEXT PRIMARY KEY,
+            sha256     TEXT NOT NULL,
+            size       INTEGER NOT NULL DEFAULT 0,
+            refcount   INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL
+        )
+        """,
+    ]),
+    (10, "lowercase saved_items.user_id to match the other per-user tables", [
+        "UPDATE saved_items SET user_id = lower(trim(user_id)) WHERE user_id != lower(trim(user_id))",
+        lambda conn: analytics_rebuild(conn=conn),
+    ]),
+]
+
+
+def _db():
+    """Pooled connection context manager: `with _db() as conn:` commits on success."""
+    return _DB.connection()
+
+
+# Chat messages are written behind: buffered and group-committed in one
+# transaction every CHAT_WRITE_BATCH_MS or CHAT_WRITE_BATCH_ROWS rows.
+_CHAT_WRITER = WriteBehind(
+    _DB, "INSERT INTO chat_messages(session_id,user_id,short_session_id,role,content,ts) VALUES(?,?,?,?,?,?)",
+    interval=int(os.getenv("CHAT_WRITE_BATCH_MS", "50")) / 1000,
+    max_batch=int(os.getenv("CHAT_WRITE_BATCH_ROWS", "200")),
+    name="chat-writer",
+    on_batch=lambda conn, rows: (_rollup_chat_batch(conn, rows), _chat_sessions_batch(conn, rows)),
+    on_commit=lambda rows: _chat_rows_committed(rows),
+)
+
+
+def _encode_cursor(*values) -> str:
+    """Opaque keyset cursor for the last row of a page."""
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip("=")
+
+def _decode_cursor(cursor: str, size: int = 2):
+    """Values from _encode_cursor, None for no cursor; ValueError if malformed."""
+    if not cursor:
+        return None
     try:
-        conn = _get_db()
-        conn.execute("INSERT INTO chat_messages(session_id,role,content,ts) VALUES(?,?,?,?)",
-                     (session_id, role, content, time.time()))
-        conn.commit()
-        conn.close()
-    except Exception as e:
-        print(f"⚠️ DB save error: {e}")
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError("Invalid cursor")
+    return values
+
+def _page_limit(value, default: int, maximum: int = 200) -> int:
+    try:
+        return max(1, min(int(value), maximum))
+    except (TypeError, ValueError):
+        return default
+
+
+def _split_session_id(session_id: str):
+    """(user_id, short_session_id) for a scoped "{user_id}:{session}" id; user_id is None if unscoped."""
+    user_id, sep, short_sid = (session_id or "").partition(":")
+    return (user_id, short_sid) if sep else (None, session_id)
+
+def db_save_message(session_id: str, role: str, content: str, ts: float = None):
+    """Queue a chat message for the background writer (no disk sync on the request thread)."""
+    user_id, short_sid = _split_session_id(session_id)
+    _CHAT_WRITER.add((session_id, user_id, short_sid, role, content, ts or time.time()))
 
 def db_load_session(session_id: str, limit: int = 60):
-    """Load the most recent `limit` messages for a session from DB."""
+    """Load the most recent `limit` messages for a session, including ones not yet flushed."""
+    pending = _CHAT_WRITER.pending(lambda r: r[0] == session_id)
     try:
-        conn = _get_db()
-        rows = conn.execute(
-            "SELECT role,content,ts FROM chat_messages WHERE session_id=? ORDER BY ts DESC LIMIT ?",
-            (session_id, limit)
-        ).fetchall()
-        conn.close()
-        return [{"role": r["role"], "content": r["content"], "timestamp": r["ts"]}
-                for r in reversed(rows)]
+        with _db() as conn:
+            rows = conn.execute(
+                "SELECT role,content,ts FROM chat_messages WHERE session_id=? ORDER BY ts DESC LIMIT ?",
+                (session_id, limit)
+            ).fetchall()
     except Exception as e:
         print(f"⚠️ DB load error: {e}")
-        return []
+        rows = []
+    messages = [{"role": r["role"], "content": r["content"], "timestamp": r["ts"]} for r in rows]
+    # A batch may commit between the two reads - skip rows already returned by the query
+    seen = {(m["timestamp"], m["role"], m["content"]) for m in messages}
+    messages += [{"role": role, "content": content, "timestamp": ts}
+                 for _, _, _, role, content, ts in pending if (ts, role, content) not in seen]
+    messages.sort(key=lambda m: m["timestamp"])
+    return messages[-limit:]
+
+def db_load_session_page(session_id: str, limit: int = 100, cursor: str = None):
+    """One page of a session's messages, newest page first, oldest-first within the page.
+
+    Keyset on (ts, id): pass the returned next_cursor to get the page before it.
+    Returns (messages, next_cursor or None).
+    """
+    before = _decode_cursor(cursor)
+    if before is None:
+        _CHAT_WRITER.flush()  # first page must include the latest turns
+    sql = "SELECT id,role,content,ts FROM chat_messages WHERE session_id=?"
+    args = [session_id]
+    if before:
+        sql += " AND (ts < ? OR (ts = ? AND id < ?))"
+        args += [before[0], before[0], before[1]]
+    sql += " ORDER BY ts DESC, id DESC LIMIT ?"
+    with _db() as conn:
+        rows = conn.execute(sql, args + [limit + 1]).fetchall()
+    next_cursor = _encode_cursor(rows[limit - 1]["ts"], rows[limit - 1]["id"]) if len(rows) > limit else None
+    messages = [{"id": r["id"], "role": r["role"], "content": r["content"], "timestamp": r["ts"]}
+                for r in reversed(rows[:limit])]
+    return messages, next_cursor
 
 def db_clear_session(session_id: str):
     """Clear all messages for a session from DB."""
     try:
-        conn = _get_db()
-        conn.execute("DELETE FROM chat_messages WHERE session_id=?", (session_id,))
-        conn.commit()
-        conn.close()
+        _CHAT_WRITER.flush()
+        with _db() as conn:
+            deleted = conn.execute("DELETE FROM chat_messages WHERE session_id=?", (session_id,)).rowcount
+            conn.execute("DELETE FROM session_summary WHERE session_id=?", (session_id,))
+            conn.execute("DELETE FROM chat_sessions WHERE session_id=?", (session_id,))
+            user_id, _ = _split_session_id(session_id)
+            if user_id and deleted:
+                _rollup_bump(conn, user_id, "chat", "", -deleted)
     except Exception as e:
         print(f"⚠️ DB clear error: {e}")
 
-def db_clear_session(session_id: str):
+# ─── Documents (uploaded-file metadata) ───────────────────────────────────────
+# The documents table is the source of truth; session["uploaded_files"] is a
+# cache of it filled by get_session and kept in step by the helpers below.
+
+def _document_from_row(r) -> dict:
+    return {"filename": r["filename"], "path": r["path"], "size": r["size"], "fileId": r["file_id"],
+            "type": r["type"], "extension": r["extension"], "upload_time": r["uploaded_at"],
+            "analyzed": bool(r["analyzed"]), "sha256": r["sha256"],
+            "ingest": {"status": r["ingest_status"], **json.loads(r["ingest_info"] or "{}")}}
+
+def db_save_document(session_id: str, doc: dict):
+    """Insert a document row (and its blob reference). Raises on failure: the upload must not report success."""
+    user_id, _ = _split_session_id(session_id)
+    with _db() as conn:
+        conn.execute("""
+            INSERT OR REPLACE INTO documents(file_id,user_id,session_id,filename,path,size,type,extension,uploaded_at,analyzed,sha256)
+            VALUES(?,?,?,?,?,?,?,?,?,?,?)
+        """, (doc["fileId"], user_id, session_id, doc["filename"], doc["path"], doc["size"],
+              doc.get("type", "unknown"), doc.get("extension", ""), doc["upload_time"], int(doc.get("analyzed", False)),
+              doc.get("sha256")))
+        if doc.get("sha256"):
+            # Reference the blob in the same transaction; see _store_upload for the ordering
+            conn.execute("""
+                INSERT INTO blobs(path, sha256, size, refcount, created_at) VALUES(?,?,?,1,?)
+                ON CONFLICT(path) DO UPDATE SET refcount = refcount + 1
+            """, (doc["path"], doc["sha256"], doc["size"], doc["upload_time"]))
+        if user_id:
+            _rollup_bump(conn, user_id, "document", "", 1, doc["upload_time"])
+
+def db_list_documents(session_id: str) -> list:
+    """Documents for a session, oldest first (the order uploaded_files has always had)."""
+    user_id, _ = _split_session_id(session_id)
     try:
-        conn = _get_db()
-        conn.execute("DELETE FROM chat_messages WHERE session_id=?", (session_id,))
-        conn.commit()
-        conn.close()
+        with _db() as conn:
+            rows = conn.execute(
+                "SELECT * FROM documents WHERE user_id IS ? AND session_id=? ORDER BY uploaded_at",
+                (user_id, session_id)
+            ).fetchall()
+        return [_document_from_row(r) for r in rows]
     except Exception as e:
-        print(f"⚠️ DB clear error: {e}")
+        print(f"⚠️ DB documents load error: {e}")
+        return []
 
-# ─── Saved Items DB helpers ───────────────────────────────────────────────────
+def db_get_document(session_id: str, file_id: str):
+    """Indexed lookup of one document, scoped to the session it was uploaded in."""
+    if not file_id:
+        return None
+    with _db() as conn:
+        row = conn.execute("SELECT * FROM documents WHERE file_id=? AND session_id=?",
+                           (file_id, session_id)).fetchone()
+    return _document_from_row(row) if row else None
+
+def db_mark_document_analyzed(session_id: str, file_id: str):
+    try:
+        with _db() as conn:
+            conn.execute("UPDATE documents SET analyzed=1 WHERE file_id=? AND session_id=?", (file_id, session_id))
+    except Exception as e:
+        print(f"⚠️ DB document update error: {e}")
 
-def _ensure_saved_items_table(conn):
+def db_set_document_ingest(session_id: str, file_id: str, status: str, info: dict = None):
+    """Record ingestion progress on the document row and its cached session entry."""
+    ingest = {"status": status, **(info or {})}
+    try:
+        with _db() as conn:
+            conn.execute("UPDATE documents SET ingest_status=?, ingest_info=? WHERE file_id=? AND session_id=?",
+                         (status, json.dumps(info or {}), file_id, session_id))
+    except Exception as e:
+        print(f"⚠️ DB document ingest update error: {e}")
+    cached = user_sessions.peek(session_id)  # background bookkeeping: don't refresh the session's LRU slot
+    if cached:
+        for f in cached["uploaded_files"]:
+            if f.get("fileId") == file_id:
+                f["ingest"] = ingest
+        user_sessions.touch(session_id)
+    _session_changed(session_id, cached or {})
+
+def db_find_ingest(sha256: str):
+    """Ingestion result of any ready document with this content, or None."""
+    with _db() as conn:
+        row = conn.execute("SELECT ingest_info FROM documents WHERE sha256=? AND ingest_status='ready' LIMIT 1",
+                           (sha256,)).fetchone()
+    return json.loads(row["ingest_info"] or "{}") if row else None
+
+def db_delete_document(session_id: str, file_id: str):
+    """Delete a document row; returns the removed document or None.
+
+    For a content-addressed upload the blob's refcount drops with it, and the blob
+    (plus its cached text) is removed once nothing references it - "blob_released".
+    """
+    user_id, _ = _split_session_id(session_id)
+    released = False
+    with _db() as conn:
+        row = conn.execute("SELECT * FROM documents WHERE file_id=? AND session_id=?",
+                           (file_id, session_id)).fetchone()
+        if not row:
+            return None
+        conn.execute("DELETE FROM documents WHERE file_id=?", (file_id,))
+        if user_id:
+            _rollup_bump(conn, user_id, "document", "", -1)
+        if row["sha256"]:
+            conn.execute("UPDATE blobs SET refcount = refcount - 1 WHERE path=?", (row["path"],))
+            blob = conn.execute("SELECT refcount FROM blobs WHERE path=?", (row["path"],)).fetchone()
+            if blob is None or blob["refcount"] <= 0:
+                conn.execute("DELETE FROM blobs WHERE path=?", (row["path"],))
+                # Still inside the write transaction, so no upload can re-reference it meanwhile
+                _TEXT_CACHE.forget_digest(row["sha256"])
+                if os.path.exists(row["path"]):
+                    os.remove(row["path"])
+                print(f"🗑️ Released blob: {row['path']}")
+                released = True
+    cached = user_sessions.get(session_id)
+    if cached:
+        cached["uploaded_files"][:] = [f for f in cached["uploaded_files"] if f.get("fileId") != file_id]
+        user_sessions.touch(session_id)
+    _session_changed(session_id, cached or {})
+    return {**_document_from_row(row), "blob_released": released}
+
+# ─── Analytics rollups ────────────────────────────────────────────────────────
+# analytics_rollup holds per-user counters keyed by (dim, key): dim is one of
+# total / tool / category / day (UTC date of saved items) / chat / document.
+# They are updated in the same transaction as the row they count, so
+# /api/analytics/summary reads one user's counters instead of aggregating.
+
+def _rollup_day(ts: float) -> str:
+    return time.strftime("%Y-%m-%d", time.gmtime(ts))
+
+def _rollup_bump(conn, user_id: str, dim: str, key: str, delta: int, ts: float = None):
     conn.execute("""
-        CREATE TABLE IF NOT EXISTS saved_items (
-            id        INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id   TEXT NOT NULL DEFAULT 'anonymous',
-            tool      TEXT NOT NULL,
-            category  TEXT NOT NULL,
-            title     TEXT NOT NULL,
-            content   TEXT NOT NULL,
-            input_text TEXT NOT NULL DEFAULT '',
-            ts        REAL NOT NULL
-        )
-    """)
-    conn.execute("CREATE INDEX IF NOT EXISTS idx_saved_user ON saved_items(user_id, ts)")
-    conn.commit()
+        INSERT INTO analytics_rollup(user_id,dim,key,count,last_ts) VALUES(?,?,?,?,?)
+        ON CONFLICT(user_id,dim,key) DO UPDATE SET
+            count = count + excluded.count,
+            last_ts = MAX(COALESCE(last_ts, 0), COALESCE(excluded.last_ts, 0))
+    """, (user_id, dim, key, delta, ts))
+
+def _rollup_saved_item(conn, user_id: str, tool: str, category: str, ts: float, delta: int):
+    """Count a saved item in (delta=1) or out (delta=-1). Removal keeps last-seen timestamps."""
+    seen = ts if delta > 0 else None
+    for dim, key in (("total", ""), ("tool", tool), ("category", category), ("day", _rollup_day(ts))):
+        _rollup_bump(conn, user_id, dim, key, delta, seen)
+
+def _rollup_chat_batch(conn, rows):
+    """Chat writer hook: count a flushed batch of (session_id, user_id, short, role, content, ts) rows."""
+    per_user = {}
+    for _, user_id, _, _, _, ts in rows:
+        if user_id:
+            count, last = per_user.get(user_id, (0, 0))
+            per_user[user_id] = (count + 1, max(last, ts))
+    for user_id, (count, last) in per_user.items():
+        _rollup_bump(conn, user_id, "chat", "", count, last)
+
+def analytics_rebuild(user_id: str = None, conn=None):
+    """Recompute analytics_rollup from saved_items / chat_messages (all users, or one)."""
+    if conn is None:
+        with _db() as conn:
+            return analytics_rebuild(user_id, conn)
+    where, args = ("WHERE user_id=?", (user_id,)) if user_id else ("", ())
+    conn.execute(f"DELETE FROM analytics_rollup {where}", args)
+    for dim, key_expr in (("total", "''"), ("tool", "tool"), ("category", "category"),
+                          ("day", "strftime('%Y-%m-%d', ts, 'unixepoch')")):
+        conn.execute(f"""
+            INSERT INTO analytics_rollup(user_id,dim,key,count,last_ts)
+            SELECT user_id, '{dim}', {key_expr}, COUNT(*), MAX(ts) FROM saved_items {where}
+            GROUP BY user_id, {key_expr}
+        """, args)
+    conn.execute(f"""
+        INSERT INTO analytics_rollup(user_id,dim,key,count,last_ts)
+        SELECT user_id, 'chat', '', COUNT(*), MAX(ts) FROM chat_messages
+        {where or "WHERE user_id IS NOT NULL"} GROUP BY user_id
+    """, args)
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='documents'").fetchone():
+        conn.execute(f"""
+            INSERT INTO analytics_rollup(user_id,dim,key,count,last_ts)
+            SELECT user_id, 'document', '', COUNT(*), MAX(uploaded_at) FROM documents
+            {where or "WHERE user_id IS NOT NULL"} GROUP BY user_id
+        """, args)
+    return conn.execute(f"SELECT COUNT(*) FROM analytics_rollup {where}", args).fetchone()[0]
+
 
+# ─── Saved Items DB helpers ───────────────────────────────────────────────────
 
 @app.route('/api/items/save', methods=['POST', 'OPTIONS'])
 def items_save():
@@ -1395,18 +1918,17 @@ def items_save():
         title      = (data.get('title') or tool or 'Untitled').strip()[:200]
         content    = json.dumps(data.get('content') or {})
         input_text = str(data.get('input_text') or '')[:2000]
-        user_id    = request.headers.get('X-User-Id') or 'anonymous'
+        user_id    = get_request_user_id() or 'anonymous'
         if not tool:
             return jsonify({'success': False, 'error': 'tool is required'}), 400
-        conn = _get_db()
-        _ensure_saved_items_table(conn)
-        cur = conn.execute(
-            "INSERT INTO saved_items(user_id,tool,category,title,content,input_text,ts) VALUES(?,?,?,?,?,?,?)",
-            (user_id, tool, category, title, content, input_text, time.time())
-        )
-        item_id = cur.lastrowid
-        conn.commit()
-        conn.close()
+        now = time.time()
+        with _db() as conn:
+            cur = conn.execute(
+                "INSERT INTO saved_items(user_id,tool,category,title,content,input_text,ts) VALUES(?,?,?,?,?,?,?)",
+                (user_id, tool, category, title, content, input_text, now)
+            )
+            item_id = cur.lastrowid
+            _rollup_saved_item(conn, user_id, tool, category, now, 1)
         return jsonify({'success': True, 'id': item_id})
     except Exception as e:
         traceback.print_exc()
@@ -1418,24 +1940,26 @@ def items_list():
     if request.method == 'OPTIONS':
         return '', 204
     try:
-        user_id  = request.headers.get('X-User-Id') or 'anonymous'
+        user_id  = get_request_user_id() or 'anonymous'
         category = (request.args.get('category') or '').strip()
-        conn = _get_db()
-        _ensure_saved_items_table(conn)
+        limit    = _page_limit(request.args.get('limit'), 200)
+        try:
+            before = _decode_cursor(request.args.get('cursor'))
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        sql, args = "SELECT id,tool,category,title,input_text,ts FROM saved_items WHERE user_id=?", [user_id]
         if category:
-            rows = conn.execute(
-                "SELECT id,tool,category,title,input_text,ts FROM saved_items WHERE user_id=? AND category=? ORDER BY ts DESC LIMIT 200",
-                (user_id, category)
-            ).fetchall()
-        else:
-            rows = conn.execute(
-                "SELECT id,tool,category,title,input_text,ts FROM saved_items WHERE user_id=? ORDER BY ts DESC LIMIT 200",
-                (user_id,)
-            ).fetchall()
-        conn.close()
+            sql += " AND category=?"
+            args.append(category)
+        if before:
+            sql += " AND (ts < ? OR (ts = ? AND id < ?))"
+            args += [before[0], before[0], before[1]]
+        with _db() as conn:
+            rows = conn.execute(sql + " ORDER BY ts DESC, id DESC LIMIT ?", args + [limit + 1]).fetchall()
+        next_cursor = _encode_cursor(rows[limit - 1]['ts'], rows[limit - 1]['id']) if len(rows) > limit else None
         items = [{'id': r['id'], 'tool': r['tool'], 'category': r['category'],
-                  'title': r['title'], 'input_text': r['input_text'], 'ts': r['ts']} for r in rows]
-        return jsonify({'success': True, 'items': items})
+                  'title': r['title'], 'input_text': r['input_text'], 'ts': r['ts']} for r in rows[:limit]]
+        return jsonify({'success': True, 'items': items, 'next_cursor': next_cursor})
     except Exception as e:
         traceback.print_exc()
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -1445,19 +1969,20 @@ def items_list():
 def items_detail(item_id):
     if request.method == 'OPTIONS':
         return '', 204
-    user_id = request.headers.get('X-User-Id') or 'anonymous'
+    user_id = get_request_user_id() or 'anonymous'
     try:
-        conn = _get_db()
-        _ensure_saved_items_table(conn)
-        if request.method == 'DELETE':
-            conn.execute("DELETE FROM saved_items WHERE id=? AND user_id=?", (item_id, user_id))
-            conn.commit()
-            conn.close()
-            return jsonify({'success': True})
-        row = conn.execute(
-            "SELECT * FROM saved_items WHERE id=? AND user_id=?", (item_id, user_id)
-        ).fetchone()
-        conn.close()
+        with _db() as conn:
+            if request.method == 'DELETE':
+                row = conn.execute(
+                    "SELECT tool,category,ts FROM saved_items WHERE id=? AND user_id=?", (item_id, user_id)
+                ).fetchone()
+                if row:
+                    conn.execute("DELETE FROM saved_items WHERE id=? AND user_id=?", (item_id, user_id))
+                    _rollup_saved_item(conn, user_id, row['tool'], row['category'], row['ts'], -1)
+                return jsonify({'success': True})
+            row = conn.execute(
+                "SELECT * FROM saved_items WHERE id=? AND user_id=?", (item_id, user_id)
+            ).fetchone()
         if not row:
             return jsonify({'success': False, 'error': 'Not found'}), 404
         return jsonify({'success': True, 'item': {
@@ -1470,51 +1995,161 @@ def items_detail(item_id):
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+# ─── Full-text search (SQLite FTS5) ──────────────────────────────────────────
+# External-content FTS5 tables mirror chat_messages.content and saved_items
+# (title, input_text, content); triggers keep them in sync. The owner is indexed
+# as a single token (user_key = 'u' || hex(user_id), via a view) so a search
+# only walks the caller's postings rather than filtering every match.
+
+_SEARCH_TABLES = {   # fts table -> (source table, text columns, bm25 weights used as rank)
+    "chat_messages_fts": ("chat_messages", ("content",), "bm25(1.0, 0.0)"),
+    "saved_items_fts": ("saved_items", ("title", "input_text", "content"), "bm25(10.0, 3.0, 1.0, 0.0)"),
+}
+_HL_OPEN, _HL_CLOSE = "\x02", "\x03"   # placeholders, turned into <mark> after HTML-escaping
+
+def _create_search_index(conn):
+    try:
+        conn.execute("CREATE VIRTUAL TABLE temp._fts5_probe USING fts5(x)")
+        conn.execute("DROP TABLE temp._fts5_probe")
+    except sqlite3.OperationalError:
+        print("⚠️ SQLite was built without FTS5 - /api/search disabled")
+        return
+    for fts, (table, cols, rank) in _SEARCH_TABLES.items():
+        col_list = ", ".join(cols) + ", user_key"
+        new_vals = ", ".join(f"new.{c}" for c in cols) + ", 'u' || hex(new.user_id)"
+        old_vals = ", ".join(f"old.{c}" for c in cols) + ", 'u' || hex(old.user_id)"
+        conn.execute(f"""
+            CREATE VIEW IF NOT EXISTS {table}_search AS
+            SELECT id, {", ".join(cols)}, 'u' || hex(user_id) AS user_key FROM {table}
+        """)
+        conn.execute(f"""
+            CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(
+                {col_list}, content='{table}_search', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2')
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_fts_ai AFTER INSERT ON {table} BEGIN
+                INSERT INTO {fts}(rowid, {col_list}) VALUES (new.id, {new_vals});
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_fts_ad AFTER DELETE ON {table} BEGIN
+                INSERT INTO {fts}({fts}, rowid, {col_list}) VALUES ('delete', old.id, {old_vals});
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_fts_au AFTER UPDATE ON {table} BEGIN
+                INSERT INTO {fts}({fts}, rowid, {col_list}) VALUES ('delete', old.id, {old_vals});
+                INSERT INTO {fts}(rowid, {col_list}) VALUES (new.id, {new_vals});
+            END
+        """)
+        conn.execute(f"INSERT INTO {fts}({fts}, rank) VALUES ('rank', '{rank}')")
+        conn.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+
+
+def _fts_phrase(text: str) -> str:
+    return '"' + text.replace('"', '""') + '"'
+
+def _fts_query(q: str, user_id: str) -> str:
+    """Safe FTS5 query: every word must match (last one as a prefix), within the user's rows."""
+    words = re.findall(r"\w+", q)
+    if not words:
+        return ""
+    terms = [_fts_phrase(w) for w in words[:-1]] + [_fts_phrase(words[-1]) + "*"]
+    user_key = "u" + user_id.encode().hex().upper()
+    return f"user_key : {user_key} AND ({' '.join(terms)})"
+
+def _highlighted(text: str) -> str:
+    escaped = html.escape(text or "")
+    return escaped.replace(_HL_OPEN, "<mark>").replace(_HL_CLOSE, "</mark>")
+
+
+@app.route('/api/search', methods=['GET', 'OPTIONS'])
+def search():
+    """Ranked full-text search over the caller's chat messages and saved items.
+    ?q=terms&scope=all|chat|items&limit=20. Snippets are HTML-escaped with <mark> around matches."""
+    if request.method == 'OPTIONS':
+        return '', 204
+    q = (request.args.get('q') or '').strip()
+    scope = request.args.get('scope', 'all')
+    limit = _page_limit(request.args.get('limit'), 20, maximum=100)
+    if not q:
+        return jsonify({'success': False, 'error': 'q is required'}), 400
+    results = []
+    try:
+        with _db() as conn:
+            if not conn.execute("SELECT 1 FROM sqlite_master WHERE name='saved_items_fts'").fetchone():
+                return jsonify({'success': False, 'error': 'Full-text search is not available'}), 501
+            chat_user = get_request_user_id()
+            if scope in ('all', 'chat') and chat_user and _fts_query(q, chat_user):
+                _CHAT_WRITER.flush()
+                rows = conn.execute(f"""
+                    SELECT m.id, m.short_session_id, m.role, m.ts, chat_messages_fts.rank AS score,
+                           snippet(chat_messages_fts, 0, '{_HL_OPEN}', '{_HL_CLOSE}', '…', 16) AS snip
+                    FROM chat_messages_fts JOIN chat_messages m ON m.id = chat_messages_fts.rowid
+                    WHERE chat_messages_fts MATCH ? AND m.user_id = ?
+                    ORDER BY chat_messages_fts.rank LIMIT ?
+                """, (_fts_query(q, chat_user), chat_user, limit)).fetchall()
+                results += [{'type': 'chat', 'id': r['id'], 'session_id': r['short_session_id'], 'role': r['role'],
+                             'ts': r['ts'], 'score': round(-r['score'], 6), 'snippet': _highlighted(r['snip'])}
+                            for r in rows]
+            items_user = get_request_user_id() or 'anonymous'
+            if scope in ('all', 'items') and _fts_query(q, items_user):
+                rows = conn.execute(f"""
+                    SELECT i.id, i.tool, i.category, i.ts,
+                           saved_items_fts.rank AS score,
+                           highlight(saved_items_fts, 0, '{_HL_OPEN}', '{_HL_CLOSE}') AS title,
+                           snippet(saved_items_fts, 1, '{_HL_OPEN}', '{_HL_CLOSE}', '…', 16) AS snip_input,
+                           snippet(saved_items_fts, 2, '{_HL_OPEN}', '{_HL_CLOSE}', '…', 16) AS snip_content
+                    FROM saved_items_fts JOIN saved_items i ON i.id = saved_items_fts.rowid
+                    WHERE saved_items_fts MATCH ? AND i.user_id = ?
+                    ORDER BY saved_items_fts.rank LIMIT ?
+                """, (_fts_query(q, items_user), items_user, limit)).fetchall()
+                results += [{'type': 'item', 'id': r['id'], 'tool': r['tool'], 'category': r['category'],
+                             'ts': r['ts'], 'score': round(-r['score'], 6), 'title': _highlighted(r['title']),
+                             'snippet': _highlighted(r['snip_input'] if _HL_OPEN in (r['snip_input'] or '')
+                                                     else r['snip_content'])}
+                            for r in rows]
+        results.sort(key=lambda r: -r['score'])
+        return jsonify({'success': True, 'query': q, 'results': results[:limit], 'total': len(results[:limit])})
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
 @app.route('/api/analytics/summary', methods=['GET', 'OPTIONS'])
 def analytics_summary():
     if request.method == 'OPTIONS':
         return '', 204
     try:
-        user_id = request.headers.get('X-User-Id') or 'anonymous'
-        conn = _get_db()
-        _ensure_saved_items_table(conn)
-
-        total = conn.execute("SELECT COUNT(*) FROM saved_items WHERE user_id=?", (user_id,)).fetchone()[0]
-
-        week_ago = time.time() - 7 * 86400
-        this_week = conn.execute(
-            "SELECT COUNT(*) FROM saved_items WHERE user_id=? AND ts>=?", (user_id, week_ago)
-        ).fetchone()[0]
-
-        by_category = conn.execute(
-            "SELECT category, COUNT(*) as cnt FROM saved_items WHERE user_id=? GROUP BY category ORDER BY cnt DESC",
-            (user_id,)
-        ).fetchall()
-
-        by_tool = conn.execute(
-            "SELECT tool, COUNT(*) as cnt FROM saved_items WHERE user_id=? GROUP BY tool ORDER BY cnt DESC LIMIT 10",
-            (user_id,)
-        ).fetchall()
-
-        recent = conn.execute(
-            "SELECT tool,category,title,input_text,ts FROM saved_items WHERE user_id=? ORDER BY ts DESC LIMIT 20",
-            (user_id,)
-        ).fetchall()
-
-        # Chat messages count
-        chat_total = conn.execute(
-            "SELECT COUNT(*) FROM chat_messages WHERE session_id LIKE ?",
-            (f"{user_id}:%",)
-        ).fetchone()[0]
+        user_id = get_request_user_id() or 'anonymous'
+        with _db() as conn:
+            counters = conn.execute(
+                "SELECT dim,key,count,last_ts FROM analytics_rollup WHERE user_id=? AND count>0", (user_id,)
+            ).fetchall()
+            recent = conn.execute(
+                "SELECT tool,category,title,input_text,ts FROM saved_items WHERE user_id=? ORDER BY ts DESC LIMIT 20",
+                (user_id,)
+            ).fetchall()
+
+        dims = {}
+        for r in counters:
+            dims.setdefault(r['dim'], {})[r['key']] = (r['count'], r['last_ts'])
+        total = dims.get('total', {}).get('', (0, None))[0]
+        chat_total, chat_last_ts = dims.get('chat', {}).get('', (0, None))
+        docs_count, docs_last_ts = dims.get('document', {}).get('', (0, None))
+        # Day buckets are UTC dates, so "this week" is the last 7 calendar days
+        week_start = _rollup_day(time.time() - 6 * 86400)
+        this_week = sum(c for day, (c, _) in dims.get('day', {}).items() if day >= week_start)
+        by_category = sorted(dims.get('category', {}).items(), key=lambda kv: -kv[1][0])
+        by_tool = sorted(dims.get('tool', {}).items(), key=lambda kv: -kv[1][0])[:10]
 
         # Key stat cards: count + last activity timestamp per tool group
         def _stat(tools):
-            placeholders = ','.join('?' * len(tools))
-            row = conn.execute(
-                f"SELECT COUNT(*) as cnt, MAX(ts) as last_ts FROM saved_items WHERE user_id=? AND tool IN ({placeholders})",
-                [user_id] + list(tools)
-            ).fetchone()
-            return {'count': row['cnt'] or 0, 'last_ts': row['last_ts']}
+            hits = [dims.get('tool', {}).get(t) for t in tools]
+            hits = [h for h in hits if h]
+            return {'count': sum(c for c, _ in hits),
+                    'last_ts': max((ts for _, ts in hits if ts), default=None)}
 
         test_cases_stat  = _stat(['test-case-generate', 'api-test-generate'])
         test_data_stat   = _stat(['test-data-generate'])
@@ -1522,20 +2157,6 @@ def analytics_summary():
         security_stat    = _stat(['sec-threat-model', 'sec-test-cases', 'sec-vuln-advisor', 'sec-auth-review', 'sec-api-check'])
         strategy_stat    = _stat(['regression-impact', 'risk-advisor'])
 
-        # Documents analyzed from documents table (if available) - fall back to chat count
-        try:
-            docs_count = conn.execute(
-                "SELECT COUNT(*) FROM documents WHERE user_id=?", (user_id,)
-            ).fetchone()[0]
-            docs_last_ts = conn.execute(
-                "SELECT MAX(uploaded_at) FROM documents WHERE user_id=?", (user_id,)
-            ).fetchone()[0]
-        except Exception:
-            docs_count = 0
-            docs_last_ts = None
-
-        conn.close()
-
         # Build action descriptions for recent activity
         _tool_action = {
             'test-case-generate': 'Test cases generated for',
@@ -1566,8 +2187,8 @@ def analytics_summary():
             'total_saved': total,
             'this_week': this_week,
             'chat_messages': chat_total,
-            'by_category': [{'category': r['category'], 'count': r['cnt']} for r in by_category],
-            'by_tool': [{'tool': r['tool'], 'count': r['cnt']} for r in by_tool],
+            'by_category': [{'category': k, 'count': c} for k, (c, _) in by_category],
+            'by_tool': [{'tool': k, 'count': c} for k, (c, _) in by_tool],
             'recent': recent_list,
             'key_stats': {
                 'test_cases':   test_cases_stat,
@@ -1576,7 +2197,7 @@ def analytics_summary():
                 'security':     security_stat,
                 'strategy':     strategy_stat,
                 'documents':    {'count': docs_count, 'last_ts': docs_last_ts},
-                'chats':        {'count': chat_total, 'last_ts': None},
+                'chats':        {'count': chat_total, 'last_ts': chat_last_ts},
             }
         })
     except Exception as e:
@@ -1586,48 +2207,70 @@ def analytics_summary():
 
 # ─────────────────────────────────────────────────────────────────────────────
 
-def db_all_sessions(user_id=None):
-    """Return list of {session_id, count, last_ts} for the history view. Filter by user_id for isolation."""
+def _chat_sessions_batch(conn, rows):
+    """Chat writer hook: keep chat_sessions (count, last_ts per session) in step with chat_messages."""
+    per_session = {}
+    for session_id, user_id, short_sid, _, _, ts in rows:
+        _, _, count, last = per_session.get(session_id, (None, None, 0, 0))
+        per_session[session_id] = (user_id, short_sid, count + 1, max(last, ts))
+    for session_id, (user_id, short_sid, count, last) in per_session.items():
+        conn.execute("""
+            INSERT INTO chat_sessions(session_id,user_id,short_session_id,count,last_ts) VALUES(?,?,?,?,?)
+            ON CONFLICT(session_id) DO UPDATE SET
+                count = count + excluded.count,
+                last_ts = MAX(last_ts, excluded.last_ts)
+        """, (session_id, user_id, short_sid, count, last))
+
+def db_all_sessions(user_id=None, limit: int = 50, cursor: str = None, with_cursor: bool = False):
+    """Return list of {session_id, count, last_ts} for the history view, most recent first.
+    Filter by user_id for isolation. Keyset-paginated on (last_ts, session_id) over the
+    chat_sessions summary table; with_cursor=True returns (sessions, next_cursor)."""
+    after = _decode_cursor(cursor)
+    sessions, next_cursor = [], None
     try:
-        conn = _get_db()
+        _CHAT_WRITER.flush()
+        sql, args = "SELECT session_id, short_session_id, count, last_ts FROM chat_sessions WHERE 1=1", []
         if user_id:
-            prefix = f"{user_id}:"
-            like_pattern = prefix + "%"
-            rows = conn.execute("""
-                SELECT session_id, COUNT(*) as cnt, MAX(ts) as last_ts
-                FROM chat_messages WHERE session_id LIKE ?
-                GROUP BY session_id ORDER BY last_ts DESC LIMIT 50
-            """, (like_pattern,)).fetchall()
-            # Return short session_id (without user prefix) for frontend
-            result = []
-            for r in rows:
-                sid = r["session_id"]
-                short_sid = sid[len(prefix):] if sid.startswith(prefix) else sid
-                result.append({"session_id": short_sid, "count": r["cnt"], "last_ts": r["last_ts"]})
-            conn.close()
-            return result
-        rows = conn.execute("""
-            SELECT session_id, COUNT(*) as cnt, MAX(ts) as last_ts
-            FROM chat_messages GROUP BY session_id ORDER BY last_ts DESC LIMIT 50
-        """).fetchall()
-        conn.close()
-        return [{"session_id": r["session_id"], "count": r["cnt"], "last_ts": r["last_ts"]} for r in rows]
+            sql += " AND user_id=?"
+            args.append(user_id)
+        if after:
+            sql += " AND (last_ts < ? OR (last_ts = ? AND session_id < ?))"
+            args += [after[0], after[0], after[1]]
+        sql += " ORDER BY last_ts DESC, session_id DESC LIMIT ?"
+        with _db() as conn:
+            rows = conn.execute(sql, args + [limit + 1]).fetchall()
+        if len(rows) > limit:
+            next_cursor = _encode_cursor(rows[limit - 1]["last_ts"], rows[limit - 1]["session_id"])
+        # Return short session_id (without user prefix) for frontend when scoped to a user
+        sessions = [{"session_id": r["short_session_id"] if user_id else r["session_id"],
+                     "count": r["count"], "last_ts": r["last_ts"]} for r in rows[:limit]]
     except Exception as e:
         print(f"⚠️ DB sessions error: {e}")
-        return []
+    return (sessions, next_cursor) if with_cursor else sessions
 
-# Bootstrap DB on import
+# Apply schema migrations once on startup
 try:
-    _get_db().close()
-except Exception:
-    pass
+    _DB.migrate(_DB_MIGRATIONS)
+except Exception as e:
+    print(f"⚠️ DB migration error: {e}")
+atexit.register(_DB.close_all)
+atexit.register(_CHAT_WRITER.close)  # runs first (atexit is LIFO): flush pending messages
 
 # ─── Smart Context Summarisation ──────────────────────────────────────────────
 _SUMMARIZE_THRESHOLD = 30   # summarize when history exceeds this many messages
 _SUMMARIZE_KEEP      = 10   # keep the N most recent messages verbatim
 
-def _summarize_old_messages(old_messages: list) -> str:
-    """Call the active AI to produce a short summary of older conversation turns."""
+_SUMMARY_PREFIX      = "[Earlier conversation summary]\n"
+_SUMMARY_RETRY_AFTER = 60   # seconds before retrying a session whose summarisation failed
+_SUMMARY_LOCK        = threading.Lock()   # guards in-place edits of conversation_history
+_SUMMARY_POOL        = ThreadPoolExecutor(max_workers=2, thread_name_prefix="summarizer")
+_summary_state_lock  = threading.Lock()   # guards _summary_pending and _summary_failed_at
+_summary_pending     = set()
+_summary_failed_at   = {}   # session_id -> last failure time; expired entries are pruned on each failure
+
+def _summarize_old_messages(old_messages: list, previous: str = "") -> str:
+    """Call the active AI to produce a short summary of older conversation turns,
+    extending `previous` (the rolling summary so far) when given."""
     if not old_messages:
         return ""
     try:
@@ -1637,32 +2280,91 @@ def _summarize_old_messages(old_messages: list) -> str:
         prompt = (
             "Summarize this conversation so far in 3-5 bullet points. "
             "Be concise; preserve important facts, decisions, and files mentioned.\n\n"
+            + (f"Summary of the earlier part:\n{previous}\n\nNewer messages:\n" if previous else "")
             + combined
         )
-        provider = get_ai_provider()
-        if provider == "openai":
-            import openai as _oai
-            _client = _oai.OpenAI(api_key=CONFIG["OPENAI_API_KEY"])
-            r = _client.chat.completions.create(
-                model=CONFIG.get("OPENAI_MODEL", "o4-mini-2025-04-16"),
-                messages=[{"role":"user","content":prompt}],
-                max_tokens=300, temperature=0.3
-            )
-            return r.choices[0].message.content.strip()
-        else:  # groq (default)
-            r = requests.post(
-                "https://api.groq.com/openai/v1/chat/completions",
-                headers={"Authorization": f"Bearer {CONFIG['GROQ_API_KEY']}", "Content-Type":"application/json"},
-                json={"model": CONFIG.get("GROQ_MODEL","llama-3.3-70b-versatile"),
-                      "messages":[{"role":"user","content":prompt}],
-                      "max_tokens":300,"temperature":0.3},
-                timeout=30
-            )
-            return r.json()["choices"][0]["message"]["content"].strip()
+        return llm_gateway.complete(
+            get_ai_provider(), [{"role": "user", "content": prompt}],
+            max_tokens=300, temperature=0.3, timeout=30,
+            priority=llm_gateway.PRIORITY_BATCH
+        ).strip()
     except Exception as e:
         print(f"⚠️ Smart context summarise error: {e}")
         return ""
 
+def db_load_summary(session_id: str):
+    """(summary, through_ts) for a session, or (None, 0)."""
+    try:
+        with _db() as conn:
+            row = conn.execute("SELECT summary,through_ts FROM session_summary WHERE session_id=?",
+                               (session_id,)).fetchone()
+        return (row["summary"], row["through_ts"]) if row else (None, 0)
+    except Exception as e:
+        print(f"⚠️ DB summary load error: {e}")
+        return None, 0
+
+def _summary_message(summary: str, through_ts: float) -> dict:
+    return {"role": "system", "content": _SUMMARY_PREFIX + summary, "timestamp": through_ts}
+
+def _history_with_summary(session_id: str, history: list) -> list:
+    """Replace messages already folded into the stored rolling summary with that summary."""
+    summary, through_ts = db_load_summary(session_id)
+    if not summary:
+        return history
+    return [_summary_message(summary, through_ts)] + [m for m in history if m["timestamp"] > through_ts]
+
+def _schedule_summary(session_id: str, session: dict):
+    """Queue a background roll-up of the session's older messages (one job per session at a time)."""
+    with _summary_state_lock:
+        if session_id in _summary_pending or time.time() - _summary_failed_at.get(session_id, 0) < _SUMMARY_RETRY_AFTER:
+            return
+        _summary_pending.add(session_id)
+    _SUMMARY_POOL.submit(_with_llm_tags(_roll_summary), session_id, session)
+
+def _summary_failed(session_id: str):
+    """Hold off retries for this session; failures past the retry window are forgotten."""
+    now = time.time()
+    with _summary_state_lock:
+        for sid in [k for k, at in _summary_failed_at.items() if now - at >= _SUMMARY_RETRY_AFTER]:
+            del _summary_failed_at[sid]
+        _summary_failed_at[session_id] = now
+
+def _forget_summary_state(session_id: str):
+    with _summary_state_lock:
+        _summary_failed_at.pop(session_id, None)
+
+def _roll_summary(session_id: str, session: dict):
+    try:
+        history = list(session["conversation_history"])
+        previous = ""
+        if history and history[0]["role"] == "system" and history[0]["content"].startswith(_SUMMARY_PREFIX):
+            previous = history.pop(0)["content"][len(_SUMMARY_PREFIX):]
+        old = history[:-_SUMMARIZE_KEEP]
+        if not old:
+            return
+        summary = _summarize_old_messages(old, previous)
+        if not summary:
+            _summary_failed(session_id)
+            return
+        through_ts = old[-1]["timestamp"]
+        with _db() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO session_summary(session_id,summary,through_ts,updated_at) VALUES(?,?,?,?)",
+                (session_id, summary, through_ts, time.time()))
+        _forget_summary_state(session_id)
+        with _SUMMARY_LOCK:
+            session["conversation_history"][:] = [_summary_message(summary, through_ts)] + [
+                m for m in session["conversation_history"] if m["timestamp"] > through_ts]
+        user_sessions.touch(session_id)
+        _session_changed(session_id, session)
+        print(f"🧠 Rolled up {len(old)} messages into summary for {session_id}")
+    except Exception as e:
+        _summary_failed(session_id)
+        print(f"⚠️ Background summarise error: {e}")
+    finally:
+        with _summary_state_lock:
+            _summary_pending.discard(session_id)
+
 # Calendar Events Data Storage
 CALENDAR_EVENTS_FILE = "data/calendar_events.json"
 CALENDAR_IMAGES_DIR = "uploads/calendar"
@@ -2045,30 +2747,17 @@ FORMATTING RULES (strict):
 {knowledge}
 """
 
-        headers = {
-            "Authorization": f"Bearer {groq_key}",
-            "Content-Type": "application/json"
-        }
-        payload = {
-            "model": CONFIG.get("GROQ_MODEL", "llama-3.3-70b-versatile"),
-            "messages": [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": question}
-            ],
-            "temperature": 0.5,
-            "max_tokens": 512
-        }
-        response = requests.post(
-            "https://api.groq.com/openai/v1/chat/completions",
-            headers=headers,
-            json=payload,
-            timeout=30
-        )
-        if response.status_code != 200:
-            return jsonify({"success": False, "error": f"AI service error: {response.status_code}"}), 502
-
-        result = response.json()
-        answer = result["choices"][0]["message"]["content"]
+        try:
+            answer = llm_gateway.complete(
+                "groq",
+                [
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": question}
+                ],
+                temperature=0.5, max_tokens=512, timeout=30
+            )
+        except llm_gateway.LLMError as e:
+            return jsonify({"success": False, "error": f"AI service error: {e.status_code}"}), 502
         return jsonify({"success": True, "answer": answer})
     except Exception as e:
         print(f"❌ nexora-ask error: {e}")
@@ -2089,35 +2778,208 @@ L-2, -1 Floor, Thejaswini Building, Technopark, Trivandrum, Kerala, India
 Disclaimer: The information in this email is confidential and is intended solely for the addressee. Access to this mail by anyone else is unauthorized."""
 
 
-def _hr_llm_completion(prompt: str, max_tokens: int = 2000) -> str:
-    """Call LLM (Groq or OpenAI) for HR analysis."""
-    provider = get_ai_provider()
+# ─── LLM response cache (QA / Security / BA / HR tools) ───────────────────────
+import llm_cache
+
+_LLM_CACHE = llm_cache.LLMCache(
+    os.path.join(os.path.dirname(__file__), "data", "llm_cache.db"),
+    max_memory_entries=int(os.getenv("LLM_CACHE_MEMORY_ENTRIES", "256")),
+    max_disk_entries=int(os.getenv("LLM_CACHE_DISK_ENTRIES", "5000")),
+)
+
+# TTL in seconds per tool route. Only routes listed here are cached; all of them
+# build a deterministic prompt from their input and expect a JSON reply.
+_LLM_CACHE_TTLS = {
+    '/api/qa/test-case-generate':             24 * 3600,
+    '/api/qa/test-data-generate':             3600,
+    '/api/qa/api-test-generate':              24 * 3600,
+    '/api/qa/bug-log-analyze':                24 * 3600,
+    '/api/qa/root-cause-detect':              24 * 3600,
+    '/api/qa/regression-impact':              24 * 3600,
+    '/api/qa/risk-advisor':                   24 * 3600,
+    '/api/security/threat-model':             24 * 3600,
+    '/api/security/test-cases':               24 * 3600,
+    '/api/security/vulnerability-advisor':    24 * 3600,
+    '/api/security/auth-review':              24 * 3600,
+    '/api/security/api-security-check':       24 * 3600,
+    '/api/ba-requirement-analyze':            24 * 3600,
+    '/api/ba-user-story-generate':            24 * 3600,
+    '/api/hr/jd-keywords':                    7 * 86400,
+    '/api/hr/resume-analyze':                 7 * 86400,
+    '/api/hr/resume-analyze-by-id':           7 * 86400,
+    '/api/hr/screen':                         3600,
+}
+
+
+def _llm_cache_tool():
+    """Return (tool, ttl) for the current request; ttl 0 means do not cache."""
+    if not has_request_context():
+        return "", 0
+    return request.path, _LLM_CACHE_TTLS.get(request.path, 0)
+
+
+def _llm_cache_bypassed() -> bool:
+    """Per-request bypass: `X-Cache-Bypass: 1` or `Cache-Control: no-cache`."""
+    if request.headers.get("X-Cache-Bypass", "").strip().lower() in ("1", "true", "yes"):
+        return True
+    return "no-cache" in request.headers.get("Cache-Control", "").lower()
+
+
+def _is_json_reply(raw: str) -> bool:
     try:
-        if provider == "openai":
-            import openai as _oai
-            client = _oai.OpenAI(api_key=CONFIG["OPENAI_API_KEY"])
-            r = client.chat.completions.create(
-                model=CONFIG.get("OPENAI_MODEL", "gpt-4o-mini"),
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=max_tokens,
-                temperature=0.3
-            )
-            return r.choices[0].message.content.strip()
+        json.loads(_qa_strip_json(raw))
+        return True
+    except (ValueError, TypeError):
+        return False
+
+
+@app.after_request
+def _add_llm_cache_header(response):
+    status = g.get("llm_cache")
+    if status:
+        response.headers["X-Cache"] = status
+    return response
+
+
+@app.route('/api/llm/health', methods=['GET'])
+def llm_health():
+    """Circuit breaker state per provider/model."""
+    return jsonify({"success": True, "breakers": llm_gateway.breaker_stats(),
+                    "healthy_providers": llm_gateway.healthy_providers()})
+
+
+@app.route('/api/llm-cache/stats', methods=['GET'])
+def llm_cache_stats():
+    """Hit/miss counters and tier sizes for the LLM response cache."""
+    return jsonify({"success": True, "stats": _LLM_CACHE.stats(),
+                    "singleflight": llm_gateway.singleflight_stats()})
+
+
+# ─── LLM usage / latency metrics ─────────────────────────────────────────────
+import llm_metrics
+
+_LLM_METRICS = llm_metrics.MetricsRegistry(user_window=int(os.getenv("LLM_METRICS_USER_WINDOW", "3600")))
+
+
+def _llm_call_tags() -> dict:
+    """Endpoint/user labels for LLM calls made on behalf of the current request."""
+    tags = llm_metrics.current_tags()
+    if tags or not has_request_context():
+        return tags
+    rule = request.url_rule.rule if request.url_rule else request.path
+    return {"endpoint": rule, "user": get_request_user_id() or "anonymous"}
+
+
+def _with_llm_tags(fn):
+    """Wrap fn so LLM calls it makes from a worker thread keep this request's labels."""
+    tags = _llm_call_tags()
+
+    def _run(*args, **kwargs):
+        with llm_metrics.tags(**tags):
+            return fn(*args, **kwargs)
+    return _run
+
+
+def _record_llm_call(record: dict) -> None:
+    tags = _llm_call_tags()
+    error = record.get("error")
+    _LLM_METRICS.record(
+        endpoint=tags.get("endpoint", "background"),
+        provider=record.get("provider"), model=record.get("model"),
+        user=tags.get("user", "system"),
+        prompt_tokens=record.get("prompt_tokens", 0),
+        completion_tokens=record.get("completion_tokens", 0),
+        latency=record.get("latency", 0.0), ttft=record.get("ttft"),
+        error=llm_metrics.error_class(error) if error else None,
+    )
+
+
+llm_gateway.add_observer(_record_llm_call)
+llm_gateway.set_call_wrapper(_with_llm_tags)
+
+
+@app.route('/api/metrics', methods=['GET'])
+def metrics():
+    """Prometheus scrape endpoint: LLM tokens, latency, TTFT and errors per endpoint/provider/model."""
+    from flask import Response
+    cache = _LLM_CACHE.stats()
+    flight = llm_gateway.singleflight_stats()
+    sessions = user_sessions.stats()
+    texts = _TEXT_CACHE.stats()
+    extra = {
+        "llm_cache_hits_total": ("LLM response cache hits.", cache["memory_hits"] + cache["disk_hits"]),
+        "llm_cache_misses_total": ("LLM response cache misses.", cache["misses"]),
+        "llm_singleflight_coalesced_total": ("Calls served by an identical in-flight request.", flight["coalesced"]),
+        "chat_db_write_batches_total": ("Group commits of chat messages.", _CHAT_WRITER.batches),
+        "chat_db_write_rows_total": ("Chat messages persisted by the write-behind queue.", _CHAT_WRITER.rows),
+        "chat_db_write_dropped_total": ("Chat messages dropped because they could not be written.", _CHAT_WRITER.dropped),
+        "chat_db_write_hook_errors_total": ("Chat batches whose analytics/session counters failed to update "
+                                            "(run --rebuild-analytics).", _CHAT_WRITER.hook_errors),
+        "session_cache_hits_total": ("Session lookups served from memory.", sessions["hits"]),
+        "session_cache_misses_total": ("Session lookups reloaded from SQLite.", sessions["misses"]),
+        "session_cache_entries": ("Sessions held in memory.", sessions["entries"], "gauge"),
+        "session_cache_bytes": ("Approximate bytes held by in-memory sessions.", sessions["bytes"], "gauge"),
+        "text_cache_hits_total": ("Document text extractions served from cache.", texts["memory_hits"] + texts["disk_hits"]),
+        "text_cache_misses_total": ("Document text extractions parsed from the file.", texts["misses"]),
+        "pdf_extract_pages_total": ("PDF pages extracted by the worker pool.", _PDF_ENGINE.pages),
+        "pdf_extract_budget_exceeded_total": ("PDFs abandoned past their time budget.", _PDF_ENGINE.timeouts),
+    }
+    for reason, count in sessions["evictions"].items():
+        extra[f"session_cache_evictions_{reason}_total"] = (f"Sessions evicted ({reason}).", count)
+    return Response(_LLM_METRICS.render_prometheus(extra), mimetype="text/plain; version=0.0.4")
+
+
+@app.route('/api/metrics/users', methods=['GET'])
+def metrics_users():
+    """Rolling per-user, per-endpoint LLM usage (JSON)."""
+    return jsonify({"success": True, "window_seconds": _LLM_METRICS.user_window,
+                    "users": _LLM_METRICS.user_breakdown()})
+
+
+@app.errorhandler(llm_gateway.RateLimitExceeded)
+def _rate_limited(e):
+    """Tool routes re-raise limiter rejections so they answer like chat(): 429 + retry_after."""
+    print(f"⏳ {e}")
+    response = jsonify({"success": False, "error": str(e), "type": "rate_limited", "retry_after": round(e.wait, 1)})
+    response.headers["Retry-After"] = str(max(1, int(e.wait + 0.999)))
+    return response, 429
+
+
+@app.errorhandler(llm_gateway.RequestTooLarge)
+def _request_too_large(e):
+    print(f"⚠️ {e}")
+    return jsonify({"success": False, "error": str(e), "type": "request_too_large"}), 413
+
+
+def _hr_llm_completion(prompt: str, max_tokens: int = 2000, priority: int = llm_gateway.PRIORITY_INTERACTIVE) -> str:
+    """Call LLM (Groq or OpenAI) for HR analysis. Tool routes are served from the response cache."""
+    provider = get_ai_provider()
+    tool, ttl = _llm_cache_tool()
+    key = None
+    if ttl:
+        key = llm_cache.make_key(prompt, llm_gateway.default_model(provider), 0.3, max_tokens, provider)
+        if _llm_cache_bypassed():
+            _LLM_CACHE.note_bypass()
+            g.llm_cache = "BYPASS"
         else:
-            r = requests.post(
-                "https://api.groq.com/openai/v1/chat/completions",
-                headers={"Authorization": f"Bearer {CONFIG['GROQ_API_KEY']}", "Content-Type": "application/json"},
-                json={
-                    "model": CONFIG.get("GROQ_MODEL", "llama-3.3-70b-versatile"),
-                    "messages": [{"role": "user", "content": prompt}],
-                    "max_tokens": max_tokens,
-                    "temperature": 0.3
-                },
-                timeout=60
-            )
-            return r.json()["choices"][0]["message"]["content"].strip()
+            cached = _LLM_CACHE.get(key, tool)
+            if cached is not None:
+                g.llm_cache = "HIT"
+                return cached
+            g.llm_cache = "MISS"
+    try:
+        result = llm_gateway.complete(
+            provider, [{"role": "user", "content": prompt}],
+            max_tokens=max_tokens, temperature=0.3, timeout=60, priority=priority
+        ).strip()
+    except (llm_gateway.RateLimitExceeded, llm_gateway.RequestTooLarge):
+        raise
     except Exception as e:
         raise RuntimeError(f"LLM error: {e}")
+    # Never pin a malformed reply for the whole TTL
+    if key and _is_json_reply(result):
+        _LLM_CACHE.set(key, result, ttl, tool)
+    return result
 
 
 def _analyze_single_resume(file, tmp_path, ext):
@@ -2148,7 +3010,8 @@ For "strengths": List 3-6 key strengths of this candidate based on the resume (e
 Resume content:
 {content[:12000]}
 """
-    result = _hr_llm_completion(prompt, max_tokens=1500)
+    # Resume parsing is batch work: it queues behind interactive chat for provider capacity
+    result = _hr_llm_completion(prompt, max_tokens=1500, priority=llm_gateway.PRIORITY_BATCH)
     result = result.strip()
     if result.startswith("```"):
         result = result.split("\n", 1)[1] if "\n" in result else result[3:]
@@ -2167,12 +3030,7 @@ def hr_resume_analyze_by_id():
         session_id = get_effective_session_id(data.get("session_id") or "default_session", user_id)
         if not file_id:
             return jsonify({"success": False, "error": "file_id required"}), 400
-        session = ContextManager.get_session(session_id)
-        doc = None
-        for f in session.get("uploaded_files", []):
-            if f.get("fileId") == file_id:
-                doc = f
-                break
+        doc = db_get_document(session_id, file_id)
         if not doc:
             return jsonify({"success": False, "error": "File not found in session"}), 404
         path = doc.get("path")
@@ -2187,6 +3045,8 @@ def hr_resume_analyze_by_id():
             return jsonify({"success": False, "error": "Could not extract text"}), 400
         data["filename"] = filename
         return jsonify({"success": True, "profiles": [data]})
+    except (llm_gateway.RateLimitExceeded, llm_gateway.RequestTooLarge):
+        raise  # mapped to 429/413 by the app error handlers
     except Exception as e:
         traceback.print_exc()
         return jsonify({"success": False, "error": str(e)}), 500
@@ -2220,12 +3080,13 @@ def hr_resume_analyze():
             if ext not in ('.pdf', '.docx', '.txt'):
                 profiles.append({"filename": file.filename, "error": "Unsupported format"})
                 continue
-            file_id = str(uuid.uuid4())
-            unique_filename = f"{file_id}{ext}"
-            file_path = os.path.join(upload_dir, unique_filename)
-            file_data = file.read()
-            with open(file_path, 'wb') as f:
-                f.write(file_data)
+            if session_id and session_id != "default_session":
+                # Saved to Documents too (content-addressed, so re-sent resumes share one blob)
+                file_path = _store_upload(session_id, file.filename, file.stream.size, file.stream.sha256,
+                                          file.stream.save_to)["path"]
+            else:
+                file_path = os.path.join(upload_dir, f"{uuid.uuid4()}{ext}")
+                file.save(file_path)
             try:
                 data = _analyze_single_resume(file, file_path, ext)
                 if data:
@@ -2233,19 +3094,15 @@ def hr_resume_analyze():
                     profiles.append(data)
                 else:
                     profiles.append({"filename": file.filename, "error": "Could not extract text"})
+            except llm_gateway.RateLimitExceeded:
+                raise  # the remaining files would be rejected too
             except Exception as e:
                 profiles.append({"filename": file.filename, "error": str(e)})
-            if session_id and session_id != "default_session":
-                file_info = {
-                    "filename": file.filename,
-                    "path": file_path,
-                    "size": len(file_data),
-                    "fileId": file_id,
-                    "type": "document",
-                    "extension": ext
-                }
-                ContextManager.add_file_context(session_id, file_info)
         return jsonify({"success": True, "profiles": profiles})
+    except RequestEntityTooLarge as e:
+        return jsonify({"success": False, "error": e.description}), 413
+    except (llm_gateway.RateLimitExceeded, llm_gateway.RequestTooLarge):
+        raise  # mapped to 429/413 by the app error handlers
     except Exception as e:
         traceback.print_exc()
         return jsonify({"success": False, "error": str(e)}), 500
@@ -2274,6 +3131,8 @@ Job Description:
         if not isinstance(keywords, list):
             keywords = [str(keywords)]
         return jsonify({"success": True, "keywords": keywords})
+    except (llm_gateway.RateLimitExceeded, llm_gateway.RequestTooLarge):
+        raise  # mapped to 429/413 by the app error handlers
     except Exception as e:
         traceback.print_exc()
         return jsonify({"success": False, "error": str(e)}), 500
@@ -2292,6 +3151,10 @@ def hr_screen():
         if not candidates:
             return jsonify({"success": False, "error": "At least one candidate required"}), 400
 
+        candidates_text, included = prompt_encode_records(candidates[:20], 8000, "candidates")
+        candidates_note = "TOON format" if TOON_AVAILABLE else "JSON"
+        if included < len(candidates[:20]):
+            print(f"⚠️ HR screen: {included} of {len(candidates[:20])} candidates fit the prompt budget")
         prompt = f"""You are an HR screening expert. Given the job description and candidate profiles, rank each candidate. For each candidate, also provide "skill_match": array of {{"skill": "skill name", "matched": true/false}} for key JD skills - true if candidate has it, false if missing.
 
 Return ONLY valid JSON (no markdown):
@@ -2315,8 +3178,8 @@ Return ONLY valid JSON (no markdown):
 Job Description:
 {job_description[:4000]}
 
-Candidates:
-{json.dumps(candidates[:20], ensure_ascii=False)[:8000]}
+Candidates ({candidates_note}):
+{candidates_text}
 """
         result = _hr_llm_completion(prompt, max_tokens=3500)
         result = result.strip()
@@ -2343,6 +3206,8 @@ Candidates:
         return jsonify({"success": True, "ranked": ranked, "job_role": job_role, "keywords": keywords})
     except json.JSONDecodeError as e:
         return jsonify({"success": False, "error": f"Invalid AI response: {e}"}), 500
+    except (llm_gateway.RateLimitExceeded, llm_gateway.RequestTooLarge):
+        raise  # mapped to 429/413 by the app error handlers
     except Exception as e:
         traceback.print_exc()
         return jsonify({"success": False, "error": str(e)}), 500
@@ -2406,6 +3271,8 @@ Return ONLY the email body (no subject line, no extra text). Use the variables w
         sub_prompt = f"Generate a short subject line for: {subject_prompts.get(template, 'HR email')}. Variables: {variables}. Reply with ONLY the subject, no quotes."
         subject = _hr_llm_completion(sub_prompt, max_tokens=50)
         return jsonify({"success": True, "subject": subject.strip(), "body": body.strip()})
+    except (llm_gateway.RateLimitExceeded, llm_gateway.RequestTooLarge):
+        raise  # mapped to 429/413 by the app error handlers
     except Exception as e:
         traceback.print_exc()
         return jsonify({"success": False, "error": str(e)}), 500
@@ -2486,6 +3353,8 @@ Requirements:
         return jsonify({"success": True, "analysis": out})
     except json.JSONDecodeError as e:
         return jsonify({"success": False, "error": f"Invalid AI response: {e}"}), 500
+    except (llm_gateway.RateLimitExceeded, llm_gateway.RequestTooLarge):
+        raise  # mapped to 429/413 by the app error handlers
     except Exception as e:
         traceback.print_exc()
         return jsonify({"success": False, "error": str(e)}), 500
@@ -2537,6 +3406,8 @@ Requirements:
         return jsonify({"success": True, "stories": stories})
     except json.JSONDecodeError as e:
         return jsonify({"success": False, "error": f"Invalid AI response: {e}"}), 500
+    except (llm_gateway.RateLimitExceeded, llm_gateway.RequestTooLarge):
+        raise  # mapped to 429/413 by the app error handlers
     except Exception as e:
         traceback.print_exc()
         return jsonify({"success": False, "error": str(e)}), 500
@@ -2603,6 +3474,8 @@ Now generate the diagram for:
             return f'--> {safe_id}([{label}])'
         result = _re.sub(r'-->\s*\(([^)]+)\)', _fix_bare_paren_target, result)
         return jsonify({"success": True, "mermaid": result})
+    except (llm_gateway.RateLimitExceeded, llm_gateway.RequestTooLarge):
+        raise  # mapped to 429/413 by the app error handlers
     except Exception as e:
         traceback.print_exc()
         return jsonify({"success": False, "error": str(e)}), 500
@@ -2708,6 +3581,8 @@ Generate at least 8-12 test cases covering: happy path, edge cases, negative cas
         return jsonify({"success": True, "result": out})
     except json.JSONDecodeError as e:
         return jsonify({"success": False, "error": f"AI response parsing failed: {e}"}), 500
+    except (llm_gateway.RateLimitExceeded, llm_gateway.RequestTooLarge):
+        raise  # mapped to 429/413 by the app error handlers
     except Exception as e:
         traceback.print_exc()
         return jsonify({"success": False, "error": str(e)}), 500
@@ -2787,6 +3662,8 @@ Generate {record_count} records per category. Make field values realistic and sp
         return jsonify({"success": True, "result": out})
     except json.JSONDecodeError as e:
         return jsonify({"success": False, "error": f"AI response parsing failed: {e}"}), 500
+    except (llm_gateway.RateLimitExceeded, llm_gateway.RequestTooLarge):
+        raise  # mapped to 429/413 by the app error handlers
     except Exception as e:
         traceback.print_exc()
         return jsonify({"success": False, "error": str(e)}), 500
@@ -2805,6 +3682,7 @@ def qa_api_test_generate():
         if not description and not endpoint:
             return jsonify({"success": False, "error": "Endpoint URL or description required"}), 400
 
+        description = prompt_compact_text(description, "openapi")
         prompt = f"""You are a senior API QA engineer. Generate thorough API test scenarios.
 
 Endpoint: {method} {endpoint}
@@ -2838,6 +3716,8 @@ Include: success cases, error cases (4xx, 5xx), auth failures, boundary inputs,
         return jsonify({"success": True, "result": out})
     except json.JSONDecodeError as e:
         return jsonify({"success": False, "error": f"AI response parsing failed: {e}"}), 500
+    except (llm_gateway.RateLimitExceeded, llm_gateway.RequestTooLarge):
+        raise  # mapped to 429/413 by the app error handlers
     except Exception as e:
         traceback.print_exc()
         return jsonify({"success": False, "error": str(e)}), 500
@@ -2889,6 +3769,8 @@ Return ONLY valid JSON with no markdown:
         return jsonify({"success": True, "result": out})
     except json.JSONDecodeError as e:
         return jsonify({"success": False, "error": f"AI response parsing failed: {e}"}), 500
+    except (llm_gateway.RateLimitExceeded, llm_gateway.RequestTooLarge):
+        raise  # mapped to 429/413 by the app error handlers
     except Exception as e:
         traceback.print_exc()
         return jsonify({"success": False, "error": str(e)}), 500
@@ -2989,6 +3871,8 @@ Return ONLY valid JSON with no markdown:
         return jsonify({"success": True, "result": out})
     except json.JSONDecodeError as e:
         return jsonify({"success": False, "error": f"AI response parsing failed: {e}"}), 500
+    except (llm_gateway.RateLimitExceeded, llm_gateway.RequestTooLarge):
+        raise  # mapped to 429/413 by the app error handlers
     except Exception as e:
         traceback.print_exc()
         return jsonify({"success": False, "error": str(e)}), 500
@@ -3040,6 +3924,8 @@ Return ONLY valid JSON with no markdown:
         return jsonify({"success": True, "result": out})
     except json.JSONDecodeError as e:
         return jsonify({"success": False, "error": f"AI response parsing failed: {e}"}), 500
+    except (llm_gateway.RateLimitExceeded, llm_gateway.RequestTooLarge):
+        raise  # mapped to 429/413 by the app error handlers
     except Exception as e:
         traceback.print_exc()
         return jsonify({"success": False, "error": str(e)}), 500
@@ -3095,6 +3981,8 @@ Return ONLY valid JSON with no markdown:
         return jsonify({"success": True, "result": out})
     except json.JSONDecodeError as e:
         return jsonify({"success": False, "error": f"AI response parsing failed: {e}"}), 500
+    except (llm_gateway.RateLimitExceeded, llm_gateway.RequestTooLarge):
+        raise  # mapped to 429/413 by the app error handlers
     except Exception as e:
         traceback.print_exc()
         return jsonify({"success": False, "error": str(e)}), 500
@@ -3157,6 +4045,8 @@ Generate 5-8 relevant threats. Be specific and actionable."""
         return jsonify({"success": True, "result": out})
     except json.JSONDecodeError as e:
         return jsonify({"success": False, "error": f"AI response parsing failed: {e}"}), 500
+    except (llm_gateway.RateLimitExceeded, llm_gateway.RequestTooLarge):
+        raise  # mapped to 429/413 by the app error handlers
     except Exception as e:
         traceback.print_exc()
         return jsonify({"success": False, "error": str(e)}), 500
@@ -3210,6 +4100,8 @@ Generate 8-12 security test cases. Be specific with payloads and steps."""
         return jsonify({"success": True, "result": out})
     except json.JSONDecodeError as e:
         return jsonify({"success": False, "error": f"AI response parsing failed: {e}"}), 500
+    except (llm_gateway.RateLimitExceeded, llm_gateway.RequestTooLarge):
+        raise  # mapped to 429/413 by the app error handlers
     except Exception as e:
         traceback.print_exc()
         return jsonify({"success": False, "error": str(e)}), 500
@@ -3250,6 +4142,8 @@ Return ONLY valid JSON with no markdown fences:
         return jsonify({"success": True, "result": out})
     except json.JSONDecodeError as e:
         return jsonify({"success": False, "error": f"AI response parsing failed: {e}"}), 500
+    except (llm_gateway.RateLimitExceeded, llm_gateway.RequestTooLarge):
+        raise  # mapped to 429/413 by the app error handlers
     except Exception as e:
         traceback.print_exc()
         return jsonify({"success": False, "error": str(e)}), 500
@@ -3297,6 +4191,8 @@ Be thorough — check for broken authentication, insecure direct object referenc
         return jsonify({"success": True, "result": out})
     except json.JSONDecodeError as e:
         return jsonify({"success": False, "error": f"AI response parsing failed: {e}"}), 500
+    except (llm_gateway.RateLimitExceeded, llm_gateway.RequestTooLarge):
+        raise  # mapped to 429/413 by the app error handlers
     except Exception as e:
         traceback.print_exc()
         return jsonify({"success": False, "error": str(e)}), 500
@@ -3313,6 +4209,7 @@ def security_api_check():
         if not api_description:
             return jsonify({"success": False, "error": "API description is required"}), 400
 
+        api_description = prompt_compact_text(api_description, "openapi")
         prompt = f"""You are an API security expert. Evaluate the API description below against the OWASP API Security Top 10 (2023 edition).
 
 API Description: {api_description[:5000]}
@@ -3342,6 +4239,8 @@ Evaluate all applicable OWASP API Top 10 risks. Only include those that are rele
         return jsonify({"success": True, "result": out})
     except json.JSONDecodeError as e:
         return jsonify({"success": False, "error": f"AI response parsing failed: {e}"}), 500
+    except (llm_gateway.RateLimitExceeded, llm_gateway.RequestTooLarge):
+        raise  # mapped to 429/413 by the app error handlers
     except Exception as e:
         traceback.print_exc()
         return jsonify({"success": False, "error": str(e)}), 500
@@ -3394,10 +4293,6 @@ def chat():
         # Add user message to conversation history (TonniFy preprocessed for token efficiency)
         cleaned = tonnify_preprocess(user_message)
         ContextManager.add_message(session_id, "user", cleaned if cleaned else user_message)
-        
-        # Clean up old sessions periodically
-        if len(user_sessions) > 100:
-            ContextManager.cleanup_old_sessions()
 
         # Check if this is an email send command
         email_command = detect_email_command(user_message)
@@ -3454,69 +4349,18 @@ def chat():
             ai_response = "Vise-AI fallback: Please provide your data files or a specific BI question."
             return jsonify({"response": ai_response})
 
-        # OpenAI throttling (if using OpenAI)
-        global last_openai_call
-        if get_ai_provider() == 'openai':
-            gap = 5.0 - (time.time() - last_openai_call)
-            if gap > 0:
-                print(f"⏳ OpenAI throttling: waiting {gap:.2f} seconds")
-                time.sleep(gap)
-
         # Get conversation context with history
         messages = ContextManager.get_conversation_context(session_id, include_files=True)
         print(f"📚 Context: {len(messages)} messages in conversation")
 
-        # --- API call for chat (OpenAI, Groq, or Gemini based on config) ---
-        if get_ai_provider() == 'openai':
-            headers = {
-                "Authorization": f"Bearer {CONFIG['OPENAI_API_KEY']}",
-                "Content-Type": "application/json"
-            }
-            api_url = "https://api.openai.com/v1/chat/completions"
-            model = CONFIG.get("OPENAI_MODEL", "o4-mini-2025-04-16")
-            
-            payload = {
-                "model": model,
-                "messages": messages,
-                "temperature": 0.6,
-                "max_tokens": 8192
-            }
-            
-            print(f"🔄 Making OpenAI API call to {api_url}...")
-            response = requests.post(api_url, headers=headers, json=payload, timeout=CONFIG.get('API_TIMEOUT', 120))
-            print(f"📊 API Response Status: {response.status_code}")
-            
-            if response.status_code == 200:
-                result = response.json()
-                ai_response = result["choices"][0]["message"]["content"]
-                last_openai_call = time.time()  # Update throttling timestamp
-            else:
-                raise Exception(f"OpenAI API Error {response.status_code}: {response.text}")
-                
-        else:  # Default to Groq
-            headers = {
-                "Authorization": f"Bearer {CONFIG['GROQ_API_KEY']}",
-                "Content-Type": "application/json"
-            }
-            api_url = "https://api.groq.com/openai/v1/chat/completions"
-            model = CONFIG.get("GROQ_MODEL", "llama-3.3-70b-versatile")
-            
-            payload = {
-                "model": model,
-                "messages": messages,
-                "temperature": 0.6,
-                "max_tokens": 8192
-            }
-            
-            print(f"🔄 Making Groq API call to {api_url}...")
-            response = requests.post(api_url, headers=headers, json=payload, timeout=CONFIG.get('API_TIMEOUT', 120))
-            print(f"📊 Groq API Response Status: {response.status_code}")
-            
-            if response.status_code == 200:
-                result = response.json()
-                ai_response = result["choices"][0]["message"]["content"]
-            else:
-                raise Exception(f"Groq API Error {response.status_code}: {response.text}")
+        # --- API call for chat (pooled session + shared rate limiter + breaker failover) ---
+        provider = get_ai_provider()
+        print(f"🔄 Making {provider} chat API call...")
+        ai_response = llm_gateway.complete(
+            provider, messages, temperature=0.6, max_tokens=8192,
+            timeout=CONFIG.get('API_TIMEOUT', 120),
+            priority=llm_gateway.PRIORITY_INTERACTIVE, hedge=True
+        )
 
         print(f"✅ AI Response generated: {len(ai_response)} characters")
         
@@ -3538,30 +4382,17 @@ def chat():
                 messages.append({"role": "user", "content": retry_prompt})
 
                 # Retry with the same active provider (not hard-coded Gemini)
-                active_provider = get_ai_provider()
-                retry_response = None
-
-                if active_provider == 'openai':
-                    retry_response = requests.post(
-                        "https://api.openai.com/v1/chat/completions",
-                        headers={"Authorization": f"Bearer {CONFIG['OPENAI_API_KEY']}", "Content-Type": "application/json"},
-                        json={"model": CONFIG.get("OPENAI_MODEL", "o4-mini-2025-04-16"), "messages": messages, "temperature": 0.3, "max_tokens": 4096},
-                        timeout=CONFIG.get('API_TIMEOUT', 120)
-                    )
-                    if retry_response.status_code == 200:
-                        ai_response = retry_response.json()["choices"][0]["message"]["content"]
-
-                else:  # groq (default)
-                    retry_response = requests.post(
-                        "https://api.groq.com/openai/v1/chat/completions",
-                        headers={"Authorization": f"Bearer {CONFIG['GROQ_API_KEY']}", "Content-Type": "application/json"},
-                        json={"model": CONFIG.get("GROQ_MODEL", "llama-3.3-70b-versatile"), "messages": messages, "temperature": 0.3, "max_tokens": 4096},
+                retry_ok = False
+                try:
+                    ai_response = llm_gateway.complete(
+                        get_ai_provider(), messages, temperature=0.3, max_tokens=4096,
                         timeout=CONFIG.get('API_TIMEOUT', 120)
                     )
-                    if retry_response.status_code == 200:
-                        ai_response = retry_response.json()["choices"][0]["message"]["content"]
+                    retry_ok = True
+                except llm_gateway.LLMError as e:
+                    print(f"⚠️ Table retry failed: {e}")
 
-                if retry_response and retry_response.status_code == 200:
+                if retry_ok:
                     
                     # --- ADVANCED STRUCTURAL REPAIR ---
                     def fix_table_hallucination(text):
@@ -3610,6 +4441,12 @@ def chat():
             "session_id": short_sid
         })
 
+    except llm_gateway.RateLimitExceeded as e:
+        print(f"⏳ {e}")
+        return jsonify({"error": str(e), "type": "rate_limited", "retry_after": round(e.wait, 1)}), 429
+    except llm_gateway.RequestTooLarge as e:
+        print(f"⚠️ {e}")
+        return jsonify({"error": str(e), "type": "request_too_large"}), 413
     except requests.exceptions.RequestException as e:
         error_msg = f"API request failed: {str(e)}"
         print(f"❌ Request error: {error_msg}")
@@ -3636,8 +4473,152 @@ def get_file_type(extension):
     else:
         return 'other'
 
-@app.route('/api/upload', methods=['POST'])
-def upload():
+# ─── Upload ingestion ───
+# Right after an upload is saved, a worker extracts its text (warming the text cache),
+# counts pages and estimates language and tokens - or thumbnails an image - so Analyze
+# only has the LLM call left. Progress is on the document's "ingest" entry:
+# queued -> processing -> ready | failed.
+_INGEST_POOL = ThreadPoolExecutor(max_workers=int(os.getenv("INGEST_WORKERS", "2")), thread_name_prefix="ingest")
+THUMBNAIL_DIR = "uploads/thumbnails"
+THUMBNAIL_SIZE = (256, 256)
+
+_STOPWORDS = {
+    "en": {"the", "and", "of", "to", "is", "in", "that", "for", "with", "this"},
+    "es": {"el", "la", "de", "que", "y", "en", "los", "las", "por", "para"},
+    "fr": {"le", "la", "les", "de", "et", "est", "des", "que", "pour", "dans"},
+    "de": {"der", "die", "das", "und", "ist", "nicht", "mit", "den", "von", "zu"},
+    "pt": {"o", "a", "de", "que", "e", "do", "da", "em", "para", "com"},
+    "it": {"il", "di", "che", "e", "la", "per", "un", "non", "con", "sono"},
+}
+_SCRIPTS = [("hi", 0x0900, 0x097F), ("ar", 0x0600, 0x06FF), ("ru", 0x0400, 0x04FF),
+            ("zh", 0x4E00, 0x9FFF), ("ja", 0x3040, 0x30FF), ("ko", 0xAC00, 0xD7AF)]
+
+def _detect_language(text: str) -> str:
+    """ISO 639-1 guess from the first few KB (langdetect when installed, else script/stopword heuristics)."""
+    sample = text[:5000]
+    if not sample.strip():
+        return "unknown"
+    if LANGDETECT_AVAILABLE:
+        try:
+            return _langdetect(sample)
+        except Exception:
+            pass
+    letters = [c for c in sample if c.isalpha()]
+    for lang, lo, hi in _SCRIPTS:
+        if letters and sum(lo <= ord(c) <= hi for c in letters) > len(letters) * 0.3:
+            return lang
+    words = re.findall(r"[^\W\d_]+", sample.lower())
+    scores = {lang: sum(w in stop for w in words) for lang, stop in _STOPWORDS.items()}
+    lang, score = max(scores.items(), key=lambda kv: kv[1])
+    return lang if score else "unknown"
+
+def _make_thumbnail(name: str, path: str) -> dict:
+    if not PIL_AVAILABLE:
+        return {"thumbnail": None}
+    os.makedirs(THUMBNAIL_DIR, exist_ok=True)
+    thumb_path = os.path.join(THUMBNAIL_DIR, f"{name}.png")
+    with PILImage.open(path) as img:
+        width, height = img.size
+        img.thumbnail(THUMBNAIL_SIZE)
+        img.save(thumb_path, "PNG")
+    return {"thumbnail": thumb_path, "width": width, "height": height}
+
+def _ingest_document(session_id: str, document: dict):
+    file_id, path = document["fileId"], document["path"]
+    started = time.time()
+    db_set_document_ingest(session_id, file_id, "processing")
+    try:
+        known = db_find_ingest(document["sha256"]) if document.get("sha256") else None
+        if known is not None:
+            info = {**known, "reused": True}  # same bytes were already ingested for another upload
+        elif document.get("type") == "image":
+            info = _make_thumbnail(document.get("sha256") or file_id, path)
+        else:
+            text = _read_analysis_content(document["filename"], path)
+            if text.startswith("Error"):  # extractors report failures in-band
+                raise RuntimeError(text)
+            info = {"chars": len(text), "tokens": llm_gateway.estimate_tokens(text),
+                    "language": _detect_language(text)}
+            if document.get("extension") == ".pdf":
+                info["pages"] = _PDF_ENGINE.page_count(path)
+        info["seconds"] = round(time.time() - started, 3)
+        db_set_document_ingest(session_id, file_id, "ready", info)
+        print(f"📥 Ingested {document['filename']} in {info['seconds']}s")
+    except Exception as e:
+        print(f"⚠️ Ingestion failed for {document['filename']}: {e}")
+        db_set_document_ingest(session_id, file_id, "failed", {"error": str(e)[:500]})
+
+def _schedule_ingest(session_id: str, document: dict):
+    db_set_document_ingest(session_id, document["fileId"], "queued")
+    _INGEST_POOL.submit(_ingest_document, session_id, document)
+
+# Uploads are stored content-addressed: uploads/blobs/<sha[:2]>/<sha256><ext> holds the
+# bytes once, each upload gets its own file_id/documents row pointing at it, and the
+# blobs table refcounts it so delete_document removes it with the last reference.
+BLOB_DIR = "uploads/blobs"
+
+def _blob_path(sha256: str, extension: str) -> str:
+    return os.path.join(BLOB_DIR, sha256[:2], f"{sha256}{extension}")
+
+def _store_upload(session_id: str, filename: str, size: int, sha256: str, write_to) -> dict:
+    """Register a fully received upload and make sure its blob exists; write_to(path) writes the bytes.
+
+    The reference is committed before the blob is checked, and a blob is only removed
+    inside the transaction that drops its last reference, so a concurrent delete can
+    never remove a blob this upload relies on.
+    """
+    file_extension = os.path.splitext(filename)[1] if '.' in filename else '.txt'
+    file_type = get_file_type(file_extension)
+    print(f"📂 File type: {file_type}")
+    file_id = str(uuid.uuid4())
+    file_path = _blob_path(sha256, file_extension.lower())
+
+    file_info = {
+        "filename": filename,
+        "path": file_path,
+        "size": size,
+        "fileId": file_id,
+        "type": file_type,
+        "extension": file_extension.lower(),
+        "sha256": sha256
+    }
+    document = ContextManager.add_file_context(session_id, file_info)
+    print(f"📚 Added file to context for session: {session_id}")
+    if os.path.exists(file_path):
+        print(f"♻️ Upload deduplicated: {filename} -> {file_path}")
+    else:
+        tmp_path = f"{file_path}.{file_id}.tmp"
+        try:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            write_to(tmp_path)
+            os.replace(tmp_path, file_path)
+        except Exception:
+            # Undo the reference so no document points at a blob that was never written
+            db_delete_document(session_id, file_id)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        print(f"✅ Upload successful: {filename} -> {file_path}")
+    _schedule_ingest(session_id, document)
+    return file_info
+
+def _upload_response(file_info: dict, short_sid: str):
+    return jsonify({
+        "success": True,
+        "message": f"File uploaded successfully: {file_info['filename']}",
+        "fileId": file_info["fileId"],
+        "filename": file_info["filename"],
+        "size": file_info["size"],
+        "path": file_info["path"],
+        "type": file_info["type"],
+        "extension": file_info["extension"],
+        "sha256": file_info["sha256"],
+        "ingest_status": "queued",
+        "session_id": short_sid
+    })
+
+@app.route('/api/upload', methods=['POST'])
+def upload():
     try:
         print("📤 Received upload request")
         
@@ -3654,166 +4635,408 @@ def upload():
             print("❌ No file selected")
             return jsonify({"error": "No file selected"}), 400
         
-        print(f"📄 File: {file.filename} ({file.content_type})")
-        
-        # Read file data
-        file_data = file.read()
-        print(f"📊 Read {len(file_data)} bytes")
-        
-        # Determine file type
-        file_extension = os.path.splitext(file.filename)[1] if '.' in file.filename else '.txt'
-        file_type = get_file_type(file_extension)
-        print(f"📂 File type: {file_type}")
-        
-        # Create appropriate uploads directory
-        if file_type == 'image':
-            upload_dir = "uploads/images"
-        else:
-            upload_dir = "uploads/documents"
-        os.makedirs(upload_dir, exist_ok=True)
-        
-        # Generate unique filename
-        file_id = str(uuid.uuid4())
-        unique_filename = f"{file_id}{file_extension}"
-        file_path = os.path.join(upload_dir, unique_filename)
-        
-        # Save file
-        with open(file_path, 'wb') as f:
-            f.write(file_data)
-        
-        print(f"✅ Upload successful: {file.filename} -> {unique_filename}")
-        
-        # Add file to context
-        file_info = {
-            "filename": file.filename,
-            "path": file_path,
-            "size": len(file_data),
-            "fileId": file_id,
-            "type": file_type,
-            "extension": file_extension.lower()
-        }
-        ContextManager.add_file_context(session_id, file_info)
-        print(f"📚 Added file to context for session: {session_id}")
-        
-        short_sid = request.form.get("session_id", "default_session")
-        return jsonify({
-            "success": True,
-            "message": f"File uploaded successfully: {file.filename}",
-            "fileId": file_id,
-            "filename": file.filename,
-            "size": len(file_data),
-            "path": file_path,
-            "type": file_type,
-            "extension": file_extension.lower(),
-            "session_id": short_sid
-        })
+        # The body has already been streamed to a spooled temp file (size-capped, hashed)
+        spool = file.stream
+        print(f"📄 File: {file.filename} ({file.content_type}), {spool.size} bytes")
+        file_info = _store_upload(session_id, file.filename, spool.size, spool.sha256, spool.save_to)
+        spool.close()
+        return _upload_response(file_info, request.form.get("session_id", "default_session"))
         
+    except RequestEntityTooLarge as e:
+        print(f"❌ Upload rejected: {e.description}")
+        return jsonify({"error": e.description}), 413
     except Exception as e:
         print(f"❌ Upload error: {str(e)}")
         traceback.print_exc()
         return jsonify({"error": f"Upload failed: {str(e)}"}), 500
 
-@app.route('/api/analyze', methods=['POST'])
-def analyze():
+
+# ─── Resumable chunked uploads ───
+# POST /api/upload/chunked {filename, size, session_id} -> upload_id
+# PUT  /api/upload/chunked/<id>?offset=N   raw body = next chunk (409 + received on a gap)
+# GET  /api/upload/chunked/<id>            -> received (where to resume)
+# POST /api/upload/chunked/<id>/complete   -> same response as /api/upload
+# DELETE /api/upload/chunked/<id>          abort
+# Upload state lives in the shared state store, so any worker can take the next chunk;
+# appends to one upload are serialised by a claim in the same store. The running sha256
+# is kept in-process and recomputed at completion if it was lost or an append conflicted.
+UPLOAD_PARTIAL_DIR = "uploads/partial"
+UPLOAD_CHUNK_BYTES = int(float(os.getenv("UPLOAD_CHUNK_MB", "8")) * 1024 * 1024)
+UPLOAD_SESSION_TTL = int(os.getenv("UPLOAD_SESSION_TTL", str(24 * 3600)))
+_UPLOAD_APPEND_TTL = 600  # frees the append claim if a worker dies mid-chunk
+_UPLOAD_HASHERS = {}  # upload_id -> (bytes hashed, sha256 object, last used)
+
+def _sweep_chunked_uploads():
+    """Drop partial files and in-process hashers of uploads abandoned for UPLOAD_SESSION_TTL."""
+    now = time.time()
+    sweep_stale(UPLOAD_PARTIAL_DIR, UPLOAD_SESSION_TTL, now)
+    for upload_id, entry in list(_UPLOAD_HASHERS.items()):
+        if now - entry[2] > UPLOAD_SESSION_TTL:
+            _UPLOAD_HASHERS.pop(upload_id, None)
+
+def _chunked_state(upload_id: str):
+    state = _STATE.get(f"upload:{upload_id}")
+    if not state or state["user_id"] != get_request_user_id():
+        return None
+    return state
+
+def _partial_path(upload_id: str) -> str:
+    return os.path.join(UPLOAD_PARTIAL_DIR, f"{secure_filename(upload_id)}.part")
+
+def _link_or_copy(src: str, dest: str):
+    """Hard-link src to dest (copy across filesystems); src stays in place for a retry."""
+    try:
+        os.link(src, dest)
+    except OSError:
+        with open(src, "rb") as f, open(dest, "wb") as out:
+            copy_stream(f, out)
+
+@app.route('/api/upload/chunked', methods=['POST'])
+def upload_chunked_init():
     try:
-        print("🔍 Received analysis request")
         data = request.get_json(silent=True) or {}
-        filename = data.get("filename")
-        file_path = data.get("file_path")
+        filename = (data.get("filename") or "").strip()
+        try:
+            size = int(data.get("size") or 0)
+        except (TypeError, ValueError):
+            size = 0
+        if not filename or size <= 0:
+            return jsonify({"success": False, "error": "filename and size are required"}), 400
+        limit = upload_limit_bytes(filename)
+        if size > limit:
+            return jsonify({"success": False, "error": UploadTooLarge(limit, filename).description}), 413
+
         user_id = get_request_user_id()
-        session_id = get_effective_session_id(data.get("session_id", "default_session"), user_id)
-        
-        print(f"📄 Analyzing: {filename}")
-        print(f"📂 File path: {file_path}")
-        print(f"🔑 Session ID: {session_id}")
+        short_sid = data.get("session_id", "default_session")
+        upload_id = uuid.uuid4().hex
+        os.makedirs(UPLOAD_PARTIAL_DIR, exist_ok=True)
+        _sweep_chunked_uploads()
+        open(_partial_path(upload_id), "wb").close()
+        _STATE.set(f"upload:{upload_id}", {
+            "user_id": user_id, "session_id": get_effective_session_id(short_sid, user_id),
+            "short_session_id": short_sid, "filename": filename, "size": size, "received": 0,
+        }, ttl=UPLOAD_SESSION_TTL)
+        _UPLOAD_HASHERS[upload_id] = (0, hashlib.sha256(), time.time())
+        return jsonify({"success": True, "upload_id": upload_id, "chunk_size": UPLOAD_CHUNK_BYTES,
+                        "size": size, "received": 0})
+    except Exception as e:
+        print(f"❌ Chunked upload init error: {str(e)}")
+        return jsonify({"success": False, "error": str(e)}), 500
 
-        # Determine file type and read content accordingly
-        if file_path and os.path.exists(file_path):
-            try:
-                file_ext = os.path.splitext(filename)[1].lower()
-                file_type = get_file_type(file_ext)
-                
-                if file_type == 'image':
-                    print("🖼️ Analyzing image with Gemini Vision...")
-                    # For images, analyze directly with Gemini Vision API
-                    analysis = analyze_image_with_vision(file_path, "Analyze this image in detail and describe what you see")
-                    
-                    # Mark file as analyzed in context
-                    ContextManager.mark_file_analyzed(session_id, filename)
-                    ContextManager.add_message(session_id, "assistant", f"Image Analysis: {analysis}")
-                    
-                    return jsonify({
-                        "filename": filename,
-                        "analysis": analysis,
-                        "file_type": "image",
-                        "session_id": session_id
-                    })
-                    
-                elif filename.lower().endswith('.docx'):
-                    print("📄 Extracting DOCX content...")
-                    content = extract_docx_content(file_path)
-                elif filename.lower().endswith('.pdf'):
-                    print("📄 Extracting PDF content...")
-                    content = extract_pdf_content(file_path)
-                elif filename.lower().endswith(('.txt', '.md', '.csv')):
-                    print("📄 Reading text file...")
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        content = f.read()
-                else:
-                    print("📄 Reading file as text...")
-                    # For other file types, try to read as text
-                    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                        content = f.read()
-            except Exception as e:
-                content = f"Error reading file content: {str(e)}"
-                print(f"❌ File reading error: {e}")
-        else:
-            return jsonify({"error": "File not found or no file path provided"}), 400
+@app.route('/api/upload/chunked/<upload_id>', methods=['GET'])
+def upload_chunked_status(upload_id):
+    state = _chunked_state(upload_id)
+    if not state:
+        return jsonify({"success": False, "error": "Upload not found or expired"}), 404
+    return jsonify({"success": True, "upload_id": upload_id, "filename": state["filename"],
+                    "size": state["size"], "received": state["received"]})
+
+def _append_chunk(upload_id: str, key: str, offset: int, max_bytes: int):
+    """Write the request body at offset (caller holds the append claim) and advance received."""
+    state = _STATE.get(key)  # re-read under the claim: a previous holder may have advanced it
+    if not state or state["received"] != offset:
+        return jsonify({"success": False, "error": "Offset does not match received bytes",
+                        "received": (state or {}).get("received")}), 409
+    entry = _UPLOAD_HASHERS.pop(upload_id, None)
+    hasher = entry[1] if entry and entry[0] == offset else None
+    with open(_partial_path(upload_id), "r+b") as f:
+        f.seek(offset)
+        written = copy_stream(request.stream, f, max_bytes=max_bytes, hasher=hasher,
+                              filename=state["filename"])
+        f.truncate()  # drop bytes left over from an interrupted earlier attempt
+
+    received = offset + written
+    state = _STATE.update(key, lambda s: s and ({**s, "received": received} if s["received"] == offset else s),
+                          ttl=UPLOAD_SESSION_TTL)
+    if not state or state["received"] != received:
+        # Only possible if the claim expired mid-write: the part file may mix two writers,
+        # so completion must hash the file instead of trusting any running digest
+        _STATE.update(key, lambda s: s and {**s, "rehash": True}, ttl=UPLOAD_SESSION_TTL)
+        return jsonify({"success": False, "error": "Concurrent write to this upload",
+                        "received": (state or {}).get("received")}), 409
+    if hasher:
+        _UPLOAD_HASHERS[upload_id] = (received, hasher, time.time())
+    return jsonify({"success": True, "upload_id": upload_id, "size": state["size"], "received": received})
+
+@app.route('/api/upload/chunked/<upload_id>', methods=['PUT'])
+def upload_chunked_append(upload_id):
+    key = f"upload:{upload_id}"
+    try:
+        state = _chunked_state(upload_id)
+        if not state:
+            return jsonify({"success": False, "error": "Upload not found or expired"}), 404
+        offset = request.args.get("offset", type=int)
+        if offset != state["received"]:
+            return jsonify({"success": False, "error": "Offset does not match received bytes",
+                            "received": state["received"]}), 409
+        max_bytes = min(UPLOAD_CHUNK_BYTES, state["size"] - offset)
+        if request.content_length and request.content_length > max_bytes:
+            return jsonify({"success": False, "error": f"Chunk larger than {max_bytes} bytes"}), 413
+        if not _STATE.add(f"upload_append:{upload_id}", 1, ttl=_UPLOAD_APPEND_TTL):
+            return jsonify({"success": False, "error": "Another chunk of this upload is being written",
+                            "received": state["received"]}), 409
+        try:
+            return _append_chunk(upload_id, key, offset, max_bytes)
+        finally:
+            _STATE.delete(f"upload_append:{upload_id}")
+    except RequestEntityTooLarge as e:
+        return jsonify({"success": False, "error": e.description}), 413
+    except Exception as e:
+        print(f"❌ Chunked upload append error: {str(e)}")
+        return jsonify({"success": False, "error": str(e)}), 500
 
-        # Check if using fallback mode
-        if get_ai_provider() == 'fallback':
-            print("🔄 Using fallback analysis mode")
-            fallback_response = get_fallback_analysis(filename)
-            return jsonify({
-                "filename": filename,
-                "analysis": fallback_response
-            })
-        
-        # Increase content length limit for more detailed analysis
-        # Use a smarter approach: keep more content but warn if very large
-        max_content_length = 50000  # Increased from 8000 to allow more detailed analysis
-        original_length = len(content)
-        content_truncated = False
-        
-        if len(content) > max_content_length:
-            # Try to keep important parts - take from beginning and end
-            half_limit = max_content_length // 2
-            content = content[:half_limit] + "\n\n[... CONTENT TRUNCATED ...]\n\n" + content[-half_limit:]
-            content_truncated = True
-            print(f"📏 Content truncated from {original_length} to ~{max_content_length} characters (keeping start and end)")
+@app.route('/api/upload/chunked/<upload_id>/complete', methods=['POST'])
+def upload_chunked_complete(upload_id):
+    try:
+        state = _chunked_state(upload_id)
+        if not state:
+            return jsonify({"success": False, "error": "Upload not found or expired"}), 404
+        if state["received"] != state["size"]:
+            return jsonify({"success": False, "error": "Upload incomplete", "received": state["received"]}), 409
+        part_path = _partial_path(upload_id)
+        entry = _UPLOAD_HASHERS.pop(upload_id, None)
+        if entry and entry[0] == state["size"] and not state.get("rehash"):
+            sha256 = entry[1].hexdigest()
         else:
-            print(f"📏 Analyzing full document content: {original_length} characters")
-        
-        # Determine document type for specialized analysis
-        doc_type_hint = ""
-        if any(keyword in filename.lower() for keyword in ['test', 'case', 'scenario', 'spec']):
-            doc_type_hint = "This appears to be a test case or specification document."
-        elif any(keyword in filename.lower() for keyword in ['api', 'endpoint', 'rest', 'swagger']):
-            doc_type_hint = "This appears to be an API documentation or specification."
-        elif any(keyword in filename.lower() for keyword in ['readme', 'guide', 'manual', 'tutorial']):
-            doc_type_hint = "This appears to be a guide or documentation."
-        elif any(keyword in filename.lower() for keyword in ['code', 'script', 'program', '.py', '.js', '.java']):
-            doc_type_hint = "This appears to be a code file or technical document."
-        
-        # Build enhanced analysis prompt for detailed analysis
-        prompt = f"""
+            sha256 = file_sha256(part_path)
+        expected = ((request.get_json(silent=True) or {}).get("sha256") or "").lower()
+        if expected and expected != sha256:
+            return jsonify({"success": False, "error": "sha256 mismatch", "sha256": sha256}), 400
+        # Claimed only while storing, so two concurrent completes cannot both register the file;
+        # released on failure so the client can retry (the part file is kept until success)
+        if not _STATE.add(f"upload_done:{upload_id}", 1, ttl=UPLOAD_SESSION_TTL):
+            return jsonify({"success": False, "error": "Upload is already being completed"}), 409
+        try:
+            file_info = _store_upload(state["session_id"], state["filename"], state["size"], sha256,
+                                      lambda dest: _link_or_copy(part_path, dest))
+        except Exception:
+            _STATE.delete(f"upload_done:{upload_id}")
+            raise
+        _STATE.delete(f"upload:{upload_id}")
+        try:
+            os.remove(part_path)
+        except OSError:
+            pass
+        return _upload_response(file_info, state["short_session_id"])
+    except Exception as e:
+        print(f"❌ Chunked upload complete error: {str(e)}")
+        traceback.print_exc()
+        return jsonify({"success": False, "error": str(e)}), 500
+
+@app.route('/api/upload/chunked/<upload_id>', methods=['DELETE'])
+def upload_chunked_abort(upload_id):
+    if not _chunked_state(upload_id):
+        return jsonify({"success": False, "error": "Upload not found or expired"}), 404
+    _STATE.delete(f"upload:{upload_id}")
+    _UPLOAD_HASHERS.pop(upload_id, None)
+    try:
+        os.remove(_partial_path(upload_id))
+    except OSError:
+        pass
+    return jsonify({"success": True})
+
+
+# ─── Map-reduce analysis for large documents ───
+# Documents over ANALYZE_MAX_CHARS are split into token-budgeted chunks, each chunk is
+# condensed into notes concurrently, and the 7-section report is written from the notes.
+# Chunk notes are cached by content hash, so re-analysing an edited document only
+# re-processes chunks whose text changed.
+ANALYZE_MAX_CHARS = 50000
+ANALYZE_MAP_REDUCE = os.getenv("ANALYZE_MAP_REDUCE", "true").lower() == "true"
+ANALYZE_CHUNK_TOKENS = int(os.getenv("ANALYZE_CHUNK_TOKENS", "6000"))
+ANALYZE_MAP_WORKERS = int(os.getenv("ANALYZE_MAP_WORKERS", "4"))
+ANALYZE_NOTES_TOKENS = 900
+ANALYZE_CHUNK_CACHE_TTL = 30 * 24 * 3600
+
+_ANALYZE_MAP_PROMPT = """You are reading part {index} of {total} of the document "{filename}".
+Write detailed analysis notes for THIS PART ONLY, to be merged with notes from the other parts.
+Keep: purpose and topics, key concepts and terminology, requirements and specifications,
+configuration and parameters, code (what it does), step-by-step processes, numbers, dates,
+metrics, tables, examples, risks, action items and references. Quote exact values.
+Use compact bullet points. Do not add an introduction or conclusion.
+
+--- PART {index}/{total} ---
+{chunk}"""
+
+
+def _split_analysis_chunks(text: str, max_tokens: int = None) -> list:
+    """Split text into chunks of at most ~max_tokens, cutting on paragraph boundaries.
+
+    Cut points are content-defined (a paragraph whose hash matches, once the chunk is at
+    least half full), so an edit only moves boundaries near the edit and the remaining
+    chunks - and their cached notes - stay identical.
+    """
+    import hashlib
+    max_chars = (max_tokens or ANALYZE_CHUNK_TOKENS) * 4
+    min_chars = max_chars // 2
+    chunks, current, size = [], [], 0
+    for para in text.split("\n\n"):
+        # Paragraphs bigger than a whole chunk are cut into fixed windows
+        pieces = [para[i:i + max_chars] for i in range(0, len(para), max_chars)] or [""]
+        for piece in pieces:
+            if current and size + len(piece) > max_chars:
+                chunks.append("\n\n".join(current))
+                current, size = [], 0
+            current.append(piece)
+            size += len(piece) + 2
+            if size >= min_chars and hashlib.md5(piece.encode("utf-8")).digest()[0] % 4 == 0:
+                chunks.append("\n\n".join(current))
+                current, size = [], 0
+    if current:
+        chunks.append("\n\n".join(current))
+    return [c for c in chunks if c.strip()]
+
+
+def _analyze_chunk_notes(provider: str, filename: str, index: int, total: int, chunk: str):
+    """Condense one chunk into notes. Returns (notes, cached)."""
+    # Position/filename stay out of the cache key so shifted chunks still hit
+    model = llm_gateway.default_model(provider)
+    key = llm_cache.make_key("analyze-chunk\n" + chunk, model, 0.2, ANALYZE_NOTES_TOKENS, provider)
+    cached = _LLM_CACHE.get(key, "analyze-chunk")
+    if cached is not None:
+        return cached, True
+    prompt = _ANALYZE_MAP_PROMPT.format(index=index, total=total, filename=filename, chunk=chunk)
+    notes = llm_gateway.complete(
+        provider, [{"role": "user", "content": prompt}],
+        temperature=0.2, max_tokens=ANALYZE_NOTES_TOKENS,
+        timeout=CONFIG.get('API_TIMEOUT', 120), priority=llm_gateway.PRIORITY_BATCH
+    ).strip()
+    if notes:
+        _LLM_CACHE.set(key, notes, ANALYZE_CHUNK_CACHE_TTL, "analyze-chunk")
+    return notes, False
+
+
+def _iter_map_reduce_notes(filename: str, content: str):
+    """Map step of map-reduce analysis, as a generator of progress events.
+
+    Yields {'stage': 'chunked', ...} and one {'stage': 'chunk', 'chunks_done': n, ...} per finished chunk,
+    then {'stage': 'mapped', 'notes': str}. Notes that are still too long for the reduce
+    prompt are condensed again with the same map step. A chunk whose map call fails is
+    marked as missing in the notes; only a level where every chunk failed raises. Closing
+    the generator (client disconnect) cancels the chunks that have not started yet.
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    provider = get_ai_provider()
+    text, level = content, 0
+    while True:
+        chunks = _split_analysis_chunks(text)
+        total = len(chunks)
+        print(f"🧩 Map-reduce analysis: {total} chunks (level {level})")
+        yield {'stage': 'chunked', 'chunks': total, 'level': level}
+        notes = [None] * total
+        chunks_done, failed, last_error = 0, 0, None
+        pool = ThreadPoolExecutor(max_workers=max(1, min(ANALYZE_MAP_WORKERS, total)),
+                                  thread_name_prefix="analyze-map")
+        try:
+            futures = {
+                pool.submit(_with_llm_tags(_analyze_chunk_notes), provider, filename, i + 1, total, chunk): i
+                for i, chunk in enumerate(chunks)
+            }
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    notes[i], cached = future.result()
+                except Exception as e:
+                    print(f"⚠️ Map step failed for chunk {i + 1}/{total}: {e}")
+                    notes[i], cached = "[This part could not be analysed]", False
+                    failed, last_error = failed + 1, e
+                chunks_done += 1
+                # not 'done': in the SSE contract 'done': True means the stream has finished
+                yield {'stage': 'chunk', 'chunks_done': chunks_done, 'total': total, 'cached': cached,
+                       'failed': failed, 'level': level}
+        finally:
+            # Normal exit: everything is done already. GeneratorExit: don't wait for queued chunks
+            pool.shutdown(wait=False, cancel_futures=True)
+        if failed == total:
+            raise last_error
+        merged = "\n\n".join(f"### Part {i + 1}/{total}\n{n}" for i, n in enumerate(notes))
+        # Stop when notes fit the reduce prompt, or when condensing no longer helps
+        if len(merged) <= ANALYZE_MAX_CHARS or total == 1 or len(merged) >= len(text):
+            yield {'stage': 'mapped', 'notes': merged, 'chunks': total}
+            return
+        text, level = merged, level + 1
+
+
+def _map_reduce_notes(filename: str, content: str) -> str:
+    """Blocking wrapper around _iter_map_reduce_notes. Returns the merged chunk notes."""
+    notes = ""
+    for event in _iter_map_reduce_notes(filename, content):
+        if event['stage'] == 'mapped':
+            notes = event['notes']
+    return notes
+
+
+def _use_map_reduce(content: str) -> bool:
+    return ANALYZE_MAP_REDUCE and len(content) > ANALYZE_MAX_CHARS and get_ai_provider() in llm_gateway.PROVIDERS
+
+
+def _read_analysis_content(filename: str, file_path: str) -> str:
+    """Extract text from a non-image upload for /api/analyze."""
+    if filename.lower().endswith('.docx'):
+        print("📄 Extracting DOCX content...")
+        return extract_docx_content(file_path)
+    if filename.lower().endswith('.pdf'):
+        print("📄 Extracting PDF content...")
+        return extract_pdf_content(file_path)
+    if filename.lower().endswith(('.txt', '.md', '.csv')):
+        print("📄 Reading text file...")
+        with open(file_path, 'r', encoding='utf-8') as f:
+            return f.read()
+    print("📄 Reading file as text...")
+    # For other file types, try to read as text
+    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+        return f.read()
+
+
+def _build_analysis_messages(filename: str, content: str, chunk_notes: str = None):
+    """Build the 7-section analysis prompt.
+
+    With chunk_notes (map-reduce mode) the report is written from the per-chunk notes
+    instead of the raw text. Returns (messages, original_length, analyzed_length,
+    content_truncated).
+    """
+    # Increase content length limit for more detailed analysis
+    # Use a smarter approach: keep more content but warn if very large
+    max_content_length = ANALYZE_MAX_CHARS  # Increased from 8000 to allow more detailed analysis
+    original_length = len(content)
+    content_truncated = False
+    content_note = ' (full content)'
+
+    if chunk_notes:
+        content = chunk_notes
+        content_note = ' (full document, condensed into per-part notes)'
+        print(f"📏 Analyzing {original_length} characters via {len(chunk_notes)} characters of chunk notes")
+    elif len(content) > max_content_length:
+        # Try to keep important parts - take from beginning and end
+        half_limit = max_content_length // 2
+        content = content[:half_limit] + "\n\n[... CONTENT TRUNCATED ...]\n\n" + content[-half_limit:]
+        content_truncated = True
+        content_note = ' (truncated for analysis)'
+        print(f"📏 Content truncated from {original_length} to ~{max_content_length} characters (keeping start and end)")
+    else:
+        print(f"📏 Analyzing full document content: {original_length} characters")
+    
+    # Determine document type for specialized analysis
+    doc_type_hint = ""
+    if any(keyword in filename.lower() for keyword in ['test', 'case', 'scenario', 'spec']):
+        doc_type_hint = "This appears to be a test case or specification document."
+    elif any(keyword in filename.lower() for keyword in ['api', 'endpoint', 'rest', 'swagger']):
+        doc_type_hint = "This appears to be an API documentation or specification."
+    elif any(keyword in filename.lower() for keyword in ['readme', 'guide', 'manual', 'tutorial']):
+        doc_type_hint = "This appears to be a guide or documentation."
+    elif any(keyword in filename.lower() for keyword in ['code', 'script', 'program', '.py', '.js', '.java']):
+        doc_type_hint = "This appears to be a code file or technical document."
+    
+    # Build enhanced analysis prompt for detailed analysis
+    prompt = f"""
 You are Vise-AI, an expert document analyst with deep expertise in technical documentation, business documents, and various content types. 
 Your task is to provide a COMPREHENSIVE, DETAILED, and THOROUGH analysis of the following document.
 
 {doc_type_hint}
 
 **Document Filename:** {filename}
-**Content Length:** {original_length} characters{' (truncated for analysis)' if content_truncated else ' (full content)'}
+**Content Length:** {original_length} characters{content_note}
 
 **Document Content:**
 {content}
@@ -3886,75 +5109,95 @@ Your task is to provide a COMPREHENSIVE, DETAILED, and THOROUGH analysis of the
 Begin your detailed analysis now:
 """
 
-        # --- API call for analysis (OpenAI, Groq, or Gemini based on config) ---
-        analysis_messages = [
-            {"role": "system", "content": "You are Vise-AI, an expert document analyst. Provide detailed, comprehensive analysis. Use COMPACT formatting: minimal blank lines, tight spacing between sections and bullet points. No extra vertical space."},
-            {"role": "user", "content": prompt}
-        ]
+    analysis_messages = [
+        {"role": "system", "content": "You are Vise-AI, an expert document analyst. Provide detailed, comprehensive analysis. Use COMPACT formatting: minimal blank lines, tight spacing between sections and bullet points. No extra vertical space."},
+        {"role": "user", "content": prompt}
+    ]
+    return analysis_messages, original_length, len(content), content_truncated
+
+
+def _store_analysis(session_id: str, filename: str, ai_response: str) -> None:
+    """Persist a finished analysis into the session like a chat turn."""
+    # Mark file as analyzed in context
+    ContextManager.mark_file_analyzed(session_id, filename)
+
+    # Store the user's implicit analysis request and the FULL analysis result in
+    # conversation history so follow-up messages (e.g. "create test cases",
+    # "summarise this", "write a report") have the complete document context.
+    ContextManager.add_message(
+        session_id, "user",
+        f"I uploaded the document '{filename}'. Please analyse it in detail."
+    )
+    ContextManager.add_message(session_id, "assistant", ai_response)
+
+
+@app.route('/api/analyze', methods=['POST'])
+def analyze():
+    try:
+        print("🔍 Received analysis request")
+        data = request.get_json(silent=True) or {}
+        filename = data.get("filename")
+        file_path = data.get("file_path")
+        user_id = get_request_user_id()
+        session_id = get_effective_session_id(data.get("session_id", "default_session"), user_id)
         
-        if get_ai_provider() == 'openai':
-            headers = {
-                "Authorization": f"Bearer {CONFIG['OPENAI_API_KEY']}",
-                "Content-Type": "application/json"
-            }
-            api_url = "https://api.openai.com/v1/chat/completions"
-            model = CONFIG.get("OPENAI_MODEL", "o4-mini-2025-04-16")
-            
-            payload = {
-                "model": model,
-                "messages": analysis_messages,
-                "temperature": 0.3,
-                "max_tokens": 4000  # Increased from 2000 to allow more detailed responses
-            }
-            
-            print(f"🔄 Making OpenAI analysis API call...")
-            response = requests.post(api_url, headers=headers, json=payload, timeout=CONFIG.get('API_TIMEOUT', 120))
-            print(f"📊 Analysis API Response Status: {response.status_code}")
-            
-            if response.status_code == 200:
-                result = response.json()
-                ai_response = result["choices"][0]["message"]["content"]
-            else:
-                raise Exception(f"OpenAI Analysis API Error {response.status_code}: {response.text}")
+        print(f"📄 Analyzing: {filename}")
+        print(f"📂 File path: {file_path}")
+        print(f"🔑 Session ID: {session_id}")
+
+        # Determine file type and read content accordingly
+        if file_path and os.path.exists(file_path):
+            try:
+                file_ext = os.path.splitext(filename)[1].lower()
+                file_type = get_file_type(file_ext)
                 
-        else:  # Default to Groq
-            headers = {
-                "Authorization": f"Bearer {CONFIG['GROQ_API_KEY']}",
-                "Content-Type": "application/json"
-            }
-            api_url = "https://api.groq.com/openai/v1/chat/completions"
-            model = CONFIG.get("GROQ_MODEL", "llama-3.3-70b-versatile")
-            
-            payload = {
-                "model": model,
-                "messages": analysis_messages,
-                "temperature": 0.3,
-                "max_tokens": 4000  # Increased from 2000 to allow more detailed responses
-            }
-            
-            print(f"🔄 Making Groq analysis API call...")
-            response = requests.post(api_url, headers=headers, json=payload, timeout=CONFIG.get('API_TIMEOUT', 120))
-            print(f"📊 Groq Analysis API Response Status: {response.status_code}")
-            
-            if response.status_code == 200:
-                result = response.json()
-                ai_response = result["choices"][0]["message"]["content"]
-            else:
-                raise Exception(f"Groq Analysis API Error {response.status_code}: {response.text}")
+                if file_type == 'image':
+                    print("🖼️ Analyzing image with Gemini Vision...")
+                    # For images, analyze directly with Gemini Vision API
+                    analysis = analyze_image_with_vision(file_path, "Analyze this image in detail and describe what you see")
+                    
+                    # Mark file as analyzed in context
+                    ContextManager.mark_file_analyzed(session_id, filename)
+                    ContextManager.add_message(session_id, "assistant", f"Image Analysis: {analysis}")
+                    
+                    return jsonify({
+                        "filename": filename,
+                        "analysis": analysis,
+                        "file_type": "image",
+                        "session_id": session_id
+                    })
+                    
+                else:
+                    content = _read_analysis_content(filename, file_path)
+            except Exception as e:
+                content = f"Error reading file content: {str(e)}"
+                print(f"❌ File reading error: {e}")
+        else:
+            return jsonify({"error": "File not found or no file path provided"}), 400
 
-        print("✅ Analysis completed successfully")
-        
-        # Mark file as analyzed in context
-        ContextManager.mark_file_analyzed(session_id, filename)
+        # Check if using fallback mode
+        if get_ai_provider() == 'fallback':
+            print("🔄 Using fallback analysis mode")
+            fallback_response = get_fallback_analysis(filename)
+            return jsonify({
+                "filename": filename,
+                "analysis": fallback_response
+            })
         
-        # Store the user's implicit analysis request and the FULL analysis result in
-        # conversation history so follow-up messages (e.g. "create test cases",
-        # "summarise this", "write a report") have the complete document context.
-        ContextManager.add_message(
-            session_id, "user",
-            f"I uploaded the document '{filename}'. Please analyse it in detail."
+        chunk_notes = _map_reduce_notes(filename, content) if _use_map_reduce(content) else None
+        analysis_messages, _, _, _ = _build_analysis_messages(filename, content, chunk_notes)
+
+        # --- API call for analysis (pooled session for the active provider) ---
+        provider = get_ai_provider()
+        print(f"🔄 Making {provider} analysis API call...")
+        ai_response = llm_gateway.complete(
+            provider, analysis_messages, temperature=0.3,
+            max_tokens=4000,  # Increased from 2000 to allow more detailed responses
+            timeout=CONFIG.get('API_TIMEOUT', 120)
         )
-        ContextManager.add_message(session_id, "assistant", ai_response)
+
+        print("✅ Analysis completed successfully")
+        _store_analysis(session_id, filename, ai_response)
         
         return jsonify({
             "filename": filename,
@@ -3987,6 +5230,110 @@ Begin your detailed analysis now:
             "fallback": True
         })
 
+@app.route('/api/analyze/stream', methods=['POST'])
+def analyze_stream():
+    """Streaming version of /api/analyze — progress events then text chunks via SSE.
+
+    Events: {'stage': 'started'}, {'stage': 'extracted', ...}, for large documents
+    {'stage': 'chunked'/'chunk', ...} map-reduce progress, {'stage': 'prepared', ...},
+    then {'chunk': ...} text and {'done': True, ...}.
+    """
+    from flask import Response, stream_with_context
+
+    data       = request.get_json(silent=True) or {}
+    filename   = data.get("filename")
+    file_path  = data.get("file_path")
+    user_id    = get_request_user_id()
+    session_id = get_effective_session_id(data.get("session_id", "default_session"), user_id)
+    short_sid  = data.get("session_id", "default_session")
+
+    if not filename or not file_path or not os.path.exists(file_path):
+        return jsonify({"error": "File not found or no file path provided"}), 400
+
+    def _event(payload):
+        return f"data: {json.dumps(payload)}\n\n"
+
+    def _generate():
+        full_response = []
+        try:
+            # First byte goes out before extraction so clients and proxies see progress
+            yield _event({'stage': 'started', 'filename': filename})
+            print(f"🔍 Streaming analysis: {filename} ({session_id})")
+
+            file_type = get_file_type(os.path.splitext(filename)[1].lower())
+            if file_type == 'image':
+                yield _event({'stage': 'extracted', 'file_type': 'image'})
+                analysis = analyze_image_with_vision(file_path, "Analyze this image in detail and describe what you see")
+                ContextManager.mark_file_analyzed(session_id, filename)
+                ContextManager.add_message(session_id, "assistant", f"Image Analysis: {analysis}")
+                yield _event({'chunk': analysis})
+                yield _event({'done': True, 'session_id': short_sid, 'filename': filename, 'file_type': 'image'})
+                return
+
+            try:
+                content = _read_analysis_content(filename, file_path)
+            except Exception as e:
+                content = f"Error reading file content: {str(e)}"
+                print(f"❌ File reading error: {e}")
+            yield _event({'stage': 'extracted', 'file_type': file_type, 'chars': len(content)})
+
+            if get_ai_provider() == 'fallback':
+                print("🔄 Using fallback analysis mode")
+                yield _event({'chunk': get_fallback_analysis(filename)})
+                yield _event({'done': True, 'session_id': short_sid, 'filename': filename, 'fallback': True})
+                return
+
+            chunk_notes = None
+            if _use_map_reduce(content):
+                for event in _iter_map_reduce_notes(filename, content):
+                    if event['stage'] == 'mapped':
+                        chunk_notes = event['notes']
+                    else:
+                        yield _event(event)
+
+            analysis_messages, original_length, analyzed_length, truncated = _build_analysis_messages(filename, content, chunk_notes)
+            yield _event({
+                'stage': 'prepared',
+                'original_length': original_length,
+                'analyzed_length': analyzed_length,
+                'truncated': truncated,
+                'map_reduce': bool(chunk_notes)
+            })
+
+            provider = get_ai_provider()
+            for delta in llm_gateway.stream(
+                provider, analysis_messages, temperature=0.3, max_tokens=4000,
+                timeout=CONFIG.get('API_TIMEOUT', 120)
+            ):
+                full_response.append(delta)
+                yield _event({'chunk': delta})
+
+            ai_response = "".join(full_response)
+            print("✅ Streaming analysis completed")
+            _store_analysis(session_id, filename, ai_response)
+            yield _event({'done': True, 'session_id': short_sid, 'filename': filename})
+
+        except Exception as e:
+            print(f"❌ Streaming analysis error: {e}")
+            traceback.print_exc()
+            if full_response:
+                yield _event({'error': str(e)})
+            else:
+                # Nothing streamed yet - degrade like the blocking endpoint
+                yield _event({'chunk': f"⚠️ Analysis error occurred: {str(e)}\n\n{get_fallback_analysis(filename)}"})
+                yield _event({'done': True, 'session_id': short_sid, 'filename': filename, 'fallback': True})
+
+    return Response(
+        stream_with_context(_generate()),
+        mimetype="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+            "Connection": "keep-alive"
+        }
+    )
+
+
 @app.route('/api/context', methods=['GET'])
 def get_context():
     """Get conversation context and file history (isolated per user)"""
@@ -4026,6 +5373,7 @@ def sync_context():
             m for m in session["conversation_history"]
             if m.get("role") == "system"
         ]
+        user_sessions.touch(session_id)
         for m in messages:
             role = m.get("role")
             content = m.get("content", "")
@@ -4109,12 +5457,21 @@ def _is_email_option_selection(msg, options):
     return msg.strip() in options
 
 
+_EMAIL_FLOW_DEFAULT = {"active": False, "step": None, "choice": None, "need_help": None, "email_content": None}
+_EMAIL_FLOW_TTL = 86400
+
 def _get_email_flow(session_id):
-    """Get or init email flow state for session"""
-    session = ContextManager.get_session(session_id)
-    if "email_flow" not in session:
-        session["email_flow"] = {"active": False, "step": None, "choice": None, "need_help": None, "email_content": None}
-    return session["email_flow"]
+    """Get email flow state for session (a local copy; change it with _update_email_flow)"""
+    return _STATE.get(f"email_flow:{session_id}") or dict(_EMAIL_FLOW_DEFAULT)
+
+
+def _update_email_flow(session_id, email_flow, **changes):
+    """Atomically apply changes to the session's stored email flow and refresh the local copy."""
+    updated = _STATE.update(f"email_flow:{session_id}", lambda cur: {**cur, **changes},
+                            default=dict(_EMAIL_FLOW_DEFAULT), ttl=_EMAIL_FLOW_TTL)
+    email_flow.clear()
+    email_flow.update(updated)
+    return email_flow
 
 
 def _get_last_assistant_content(session_id):
@@ -4167,8 +5524,7 @@ def chat_stream():
                 content = "No content"
             body = create_simple_email_body(content, session_id)
             success, msg = send_email(recipient, "Message from Vise-AI", body)
-            email_flow["active"] = False
-            email_flow["step"] = None
+            _update_email_flow(session_id, email_flow, active=False, step=None)
             ContextManager.add_message(session_id, "user", user_msg)
             result_msg = f"Email sent successfully to {recipient}!" if success else f"Failed to send: {msg}"
             ContextManager.add_message(session_id, "assistant", result_msg)
@@ -4220,8 +5576,7 @@ def chat_stream():
     # ─── Email flow handling ─────────────────────────────────────────────────
     if _is_email_request(user_msg) and not email_flow.get("active"):
         ContextManager.add_message(session_id, "user", user_msg)
-        email_flow["active"] = True
-        email_flow["step"] = "generate_choice"
+        _update_email_flow(session_id, email_flow, active=True, step="generate_choice")
         choice_msg = "Should I generate the email for you?"
         stored_msg = f"{choice_msg}\n\n{EMAIL_GENERATE_CHOICE_MARKER}\n\nSelect one of the options above."
         ContextManager.add_message(session_id, "assistant", stored_msg)
@@ -4237,9 +5592,8 @@ def chat_stream():
 
     if _is_email_option_selection(user_msg, EMAIL_GENERATE_OPTIONS) and EMAIL_GENERATE_CHOICE_MARKER in last_assistant:
         ContextManager.add_message(session_id, "user", user_msg)
-        email_flow["choice"] = user_msg.strip()
         if user_msg.strip() == "Generate it for me":
-            email_flow["step"] = "waiting_generate_content"
+            _update_email_flow(session_id, email_flow, choice=user_msg.strip(), step="waiting_generate_content")
             prompt_msg = "Please share the content of the email (what you want to say, who it's for, purpose, etc.). I won't write a blind email."
             stored_msg = prompt_msg
             ContextManager.add_message(session_id, "assistant", stored_msg)
@@ -4253,7 +5607,7 @@ def chat_stream():
                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "Connection": "keep-alive"}
             )
         else:
-            email_flow["step"] = "rephrase_choice"
+            _update_email_flow(session_id, email_flow, choice=user_msg.strip(), step="rephrase_choice")
             choice_msg = "Should I rephrase or help you with your email?"
             stored_msg = f"{choice_msg}\n\n{EMAIL_REPHRASE_CHOICE_MARKER}\n\nSelect one of the options above."
             ContextManager.add_message(session_id, "assistant", stored_msg)
@@ -4269,8 +5623,7 @@ def chat_stream():
 
     if _is_email_option_selection(user_msg, EMAIL_REPHRASE_OPTIONS) and EMAIL_REPHRASE_CHOICE_MARKER in last_assistant:
         ContextManager.add_message(session_id, "user", user_msg)
-        email_flow["need_help"] = user_msg.strip().startswith("Yes")
-        email_flow["step"] = "waiting_content"
+        _update_email_flow(session_id, email_flow, need_help=user_msg.strip().startswith("Yes"), step="waiting_content")
         hint = "Type your email content below. I'll help rephrase it." if email_flow["need_help"] else "Type your email content below."
         stored_msg = f"{hint}\n\nWhen you're done, you'll get an option to send."
         ContextManager.add_message(session_id, "assistant", stored_msg)
@@ -4288,9 +5641,8 @@ def chat_stream():
     if _is_email_option_selection(user_msg, EMAIL_SEND_CONFIRM_OPTIONS) and EMAIL_SEND_CONFIRM_MARKER in last_assistant:
         ContextManager.add_message(session_id, "user", user_msg)
         if user_msg.strip() == "Yes, send it":
-            email_flow["step"] = "recipient_needed"
             draft = _extract_email_draft_from_history(session_id) or email_flow.get("email_content")
-            email_flow["email_content"] = draft
+            _update_email_flow(session_id, email_flow, step="recipient_needed", email_content=draft)
             prompt_msg = "What email address should this be sent to?"
             stored_msg = f"{prompt_msg}\n\n{EMAIL_RECIPIENT_NEEDED_MARKER}"
             ContextManager.add_message(session_id, "assistant", stored_msg)
@@ -4304,8 +5656,7 @@ def chat_stream():
                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "Connection": "keep-alive"}
             )
         else:
-            email_flow["active"] = False
-            email_flow["step"] = None
+            _update_email_flow(session_id, email_flow, active=False, step=None)
             stored_msg = "Email not sent. You can start a new email anytime with /email"
             ContextManager.add_message(session_id, "assistant", stored_msg)
             def _email_cancel_stream():
@@ -4320,15 +5671,13 @@ def chat_stream():
     # Email: user shared content for "Generate it for me" -> now generate
     if email_flow.get("step") == "waiting_generate_content":
         ContextManager.add_message(session_id, "user", user_msg)
-        email_flow["step"] = "generating"
-        email_flow["generate_request"] = user_msg
+        _update_email_flow(session_id, email_flow, step="generating", generate_request=user_msg)
         # Fall through to AI with inject
 
     # Email: user wrote content without help - show send confirm directly
     if email_flow.get("step") == "waiting_content" and not email_flow.get("need_help"):
         ContextManager.add_message(session_id, "user", user_msg)
-        email_flow["email_content"] = user_msg
-        email_flow["step"] = "send_confirm"
+        _update_email_flow(session_id, email_flow, email_content=user_msg, step="send_confirm")
         confirm_msg = "Send email?"
         stored_msg = f"{confirm_msg}\n\n{EMAIL_SEND_CONFIRM_MARKER}\n\nSelect one of the options above."
         ContextManager.add_message(session_id, "assistant", stored_msg)
@@ -4408,31 +5757,12 @@ def chat_stream():
     def _generate():
         full_response = []
         try:
-            if provider == "openai":
-                import openai as _oai
-                _oai_client = _oai.OpenAI(api_key=CONFIG["OPENAI_API_KEY"])
-                stream = _oai_client.chat.completions.create(
-                    model=CONFIG.get("OPENAI_MODEL", "o4-mini-2025-04-16"),
-                    messages=messages, temperature=0.6, max_tokens=8192, stream=True
-                )
-                for chunk in stream:
-                    delta = chunk.choices[0].delta.content or ""
-                    if delta:
-                        full_response.append(delta)
-                        yield f"data: {json.dumps({'chunk': delta})}\n\n"
-
-            else:  # groq
-                from groq import Groq as _Groq
-                gclient = _Groq(api_key=CONFIG["GROQ_API_KEY"])
-                stream = gclient.chat.completions.create(
-                    model=CONFIG.get("GROQ_MODEL", "llama-3.3-70b-versatile"),
-                    messages=messages, temperature=0.6, max_tokens=8192, stream=True
-                )
-                for chunk in stream:
-                    delta = chunk.choices[0].delta.content or ""
-                    if delta:
-                        full_response.append(delta)
-                        yield f"data: {json.dumps({'chunk': delta})}\n\n"
+            for delta in llm_gateway.stream(
+                provider, messages, temperature=0.6, max_tokens=8192,
+                timeout=CONFIG.get('API_TIMEOUT', 120)
+            ):
+                full_response.append(delta)
+                yield f"data: {json.dumps({'chunk': delta})}\n\n"
 
             ai_response = "".join(full_response)
 
@@ -4442,8 +5772,7 @@ def chat_stream():
                 (email_flow.get("step") == "waiting_content" and email_flow.get("need_help"))
             )
             if show_send_confirm:
-                email_flow["email_content"] = ai_response
-                email_flow["step"] = "send_confirm"
+                _update_email_flow(session_id, email_flow, email_content=ai_response, step="send_confirm")
                 confirm_msg = "Send email?"
                 full_msg = f"{ai_response}\n\n{confirm_msg}\n\n{EMAIL_SEND_CONFIRM_MARKER}"
                 ContextManager.add_message(session_id, "assistant", full_msg)
@@ -4471,20 +5800,30 @@ def chat_stream():
 
 @app.route('/api/chat/history', methods=['GET'])
 def chat_history_list():
-    """Return all persisted sessions with message counts for the History view (isolated per user)."""
+    """Return persisted sessions with message counts for the History view (isolated per user).
+    Paginated: ?limit=N (default 50) and ?cursor=<next_cursor from the previous page>."""
     user_id = get_request_user_id()
-    sessions = db_all_sessions(user_id)
-    return jsonify({"sessions": sessions, "total": len(sessions)})
+    try:
+        sessions, next_cursor = db_all_sessions(user_id, limit=_page_limit(request.args.get("limit"), 50),
+                                                cursor=request.args.get("cursor"), with_cursor=True)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"sessions": sessions, "total": len(sessions), "next_cursor": next_cursor})
 
 
 @app.route('/api/chat/history/<session_id>', methods=['GET'])
 def chat_history_session(session_id):
-    """Return full message history for one session from DB (isolated per user)."""
+    """Return message history for one session from DB (isolated per user).
+    Newest page first (?limit=N, max 200); pass next_cursor as ?cursor= to load older messages."""
     user_id = get_request_user_id()
     effective_sid = get_effective_session_id(session_id, user_id)
-    limit = int(request.args.get("limit", 100))
-    messages = db_load_session(effective_sid, limit=limit)
-    return jsonify({"session_id": session_id, "messages": messages, "total": len(messages)})
+    try:
+        messages, next_cursor = db_load_session_page(effective_sid, _page_limit(request.args.get("limit"), 100),
+                                                     request.args.get("cursor"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"session_id": session_id, "messages": messages, "total": len(messages),
+                    "next_cursor": next_cursor})
 
 
 @app.route('/api/summarize-files', methods=['POST'])
@@ -4526,6 +5865,7 @@ def summarize_files():
         "content": f"[Multi-file context loaded]\n{combined}",
         "timestamp": time.time()
     })
+    user_sessions.touch(session_id, added=session["conversation_history"][-1])
     return jsonify({"success": True, "files_loaded": len(files), "preview": combined[:300]})
 
 
@@ -4553,9 +5893,11 @@ def clear_context():
         user_id = get_request_user_id()
         session_id = get_effective_session_id(data.get("session_id", "default_session"), user_id)
         
-        if session_id in user_sessions:
-            del user_sessions[session_id]
+        user_sessions.pop(session_id)
+        _forget_summary_state(session_id)
         db_clear_session(session_id)
+        _STATE.delete(f"email_flow:{session_id}")
+        _session_changed(session_id, {})
         print(f"🗑️ Cleared context for session: {session_id}")
         
         return jsonify({
@@ -4820,11 +6162,10 @@ def get_documents():
     try:
         user_id = get_request_user_id()
         session_id = get_effective_session_id(request.args.get('session_id', 'default_session'), user_id)
-        session = ContextManager.get_session(session_id)
         
         # Get uploaded files with additional details
         documents = []
-        for file_info in session["uploaded_files"]:
+        for file_info in db_list_documents(session_id):
             file_path = file_info["path"]
             file_exists = os.path.exists(file_path)
             
@@ -4851,6 +6192,7 @@ def get_documents():
                 "extension": file_info.get("extension", ""),
                 "upload_time": file_info["upload_time"],
                 "analyzed": file_info["analyzed"],
+                "ingest": file_info["ingest"],
                 "exists": file_exists,
                 "stats": file_stats
             }
@@ -4879,14 +6221,9 @@ def get_document_details(file_id):
     try:
         user_id = get_request_user_id()
         session_id = get_effective_session_id(request.args.get('session_id', 'default_session'), user_id)
-        session = ContextManager.get_session(session_id)
         
         # Find the document
-        document = None
-        for file_info in session["uploaded_files"]:
-            if file_info.get("fileId") == file_id:
-                document = file_info
-                break
+        document = db_get_document(session_id, file_id)
         
         if not document:
             return jsonify({"error": "Document not found"}), 404
@@ -4904,6 +6241,7 @@ def get_document_details(file_id):
             "extension": document.get("extension", ""),
             "upload_time": document["upload_time"],
             "analyzed": document["analyzed"],
+            "ingest": document["ingest"],
             "exists": file_exists
         }
         
@@ -4937,12 +6275,7 @@ def get_document_content(file_id):
     try:
         user_id = get_request_user_id()
         session_id = get_effective_session_id(request.args.get('session_id', 'default_session'), user_id)
-        session = ContextManager.get_session(session_id)
-        document = None
-        for f in session["uploaded_files"]:
-            if f.get("fileId") == file_id:
-                document = f
-                break
+        document = db_get_document(session_id, file_id)
         if not document:
             return jsonify({"error": "Document not found"}), 404
         path = document.get("path")
@@ -4968,35 +6301,48 @@ def get_document_content(file_id):
         print(f"❌ Document content error: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/documents/<file_id>/thumbnail', methods=['GET'])
+def get_document_thumbnail(file_id):
+    """Thumbnail generated at ingestion for an uploaded image (isolated per user)"""
+    user_id = get_request_user_id()
+    session_id = get_effective_session_id(request.args.get('session_id', 'default_session'), user_id)
+    document = db_get_document(session_id, file_id)
+    thumb = (document or {}).get("ingest", {}).get("thumbnail")
+    if not thumb or not os.path.exists(thumb):
+        return jsonify({"error": "Thumbnail not available"}), 404
+    return send_file(thumb, mimetype="image/png")
+
 @app.route('/api/documents/<file_id>/delete', methods=['DELETE'])
 def delete_document(file_id):
     """Delete a specific document (isolated per user)"""
     try:
         user_id = get_request_user_id()
         session_id = get_effective_session_id(request.args.get('session_id', 'default_session'), user_id)
-        session = ContextManager.get_session(session_id)
         
-        # Find and remove the document from session
-        document = None
-        for i, file_info in enumerate(session["uploaded_files"]):
-            if file_info.get("fileId") == file_id:
-                document = file_info
-                session["uploaded_files"].pop(i)
-                break
+        # Remove the document record (and from the cached session list)
+        document = db_delete_document(session_id, file_id)
         
         if not document:
             return jsonify({"error": "Document not found in session"}), 404
         
-        # Delete the physical file
+        # Delete the physical file (and the text extracted from it). Content-addressed
+        # blobs were already released by db_delete_document if this was the last reference.
         file_path = document["path"]
-        file_deleted = False
-        if os.path.exists(file_path):
+        file_deleted = document["blob_released"]
+        if not document.get("sha256") and os.path.exists(file_path):
+            _TEXT_CACHE.forget(file_path)
             try:
                 os.remove(file_path)
                 file_deleted = True
                 print(f"🗑️ Deleted file: {file_path}")
             except Exception as e:
                 print(f"❌ Failed to delete file {file_path}: {str(e)}")
+        thumb = document["ingest"].get("thumbnail")
+        if file_deleted and thumb and os.path.exists(thumb):
+            try:
+                os.remove(thumb)
+            except OSError:
+                pass
         
         short_sid = strip_user_prefix(session_id, user_id) or request.args.get("session_id", "default_session")
         return jsonify({
@@ -5304,7 +6650,13 @@ def serve_static(filename):
 
 
 if __name__ == '__main__':
+    if '--rebuild-analytics' in sys.argv:
+        # Backfill / repair analytics_rollup from saved_items and chat_messages, then exit
+        _CHAT_WRITER.flush()
+        print(f"📊 Rebuilt analytics rollups: {analytics_rebuild()} counters")
+        sys.exit(0)
     print("Starting Vise-AI Flask Server...")
+    _PDF_ENGINE.start()  # fork extraction workers before the server takes requests
     p = get_ai_provider()
     names = {"groq": "Groq", "openai": "OpenAI"}
     print(f"AI Provider: {names.get(p, p)}")
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+Content-addressed LLM response cache for Viser AI.
+
+Two tiers: an in-memory LRU in front of a SQLite table (data/llm_cache.db).
+Entries are keyed on a sha256 of provider, model, temperature, max_tokens and
+prompt, carry a per-entry TTL, and both tiers are size bounded.
+
+Memory lookups never wait on SQLite: the disk tier has its own lock, a disk hit is
+a plain read, and the time an entry was last used from memory is written to its
+last_access when it leaves the memory tier (batched into the next disk write).
+The disk row count is kept as a running total rather than counted on every insert.
+"""
+import os
+import time
+import json
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+def make_key(prompt: str, model: str, temperature, max_tokens: int, provider: str = "") -> str:
+    """Stable content hash for one completion request."""
+    material = json.dumps([provider, model, temperature, max_tokens, prompt], ensure_ascii=False)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    """In-memory LRU + SQLite disk tier with TTLs and hit/miss counters."""
+
+    def __init__(self, db_path: str, max_memory_entries: int = 256,
+                 max_memory_bytes: int = 32 * 1024 * 1024, max_disk_entries: int = 5000):
+        self.db_path = db_path
+        self.max_memory_entries = max_memory_entries
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_entries = max_disk_entries
+        self._mem = OrderedDict()  # key -> (value, expires_at, tool, last hit or None)
+        self._mem_bytes = 0
+        self._lock = threading.Lock()       # memory tier and counters
+        self._disk_lock = threading.Lock()  # the SQLite connection
+        self._conn = None
+        self._disk_rows = 0
+        self._accessed = {}  # key -> last hit of entries that left the memory tier, not yet on disk
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0,
+                         "writes": 0, "evictions": 0, "bypasses": 0}
+        self.by_tool = {}  # tool -> {"hits": n, "misses": n}
+
+    # ── disk tier ─────────────────────────────────────────────────────────────
+
+    def _db(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    key         TEXT PRIMARY KEY,
+                    tool        TEXT NOT NULL DEFAULT '',
+                    value       TEXT NOT NULL,
+                    expires_at  REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_access ON llm_cache(last_access)")
+            conn.commit()
+            self._disk_rows = conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+            self._conn = conn
+        return self._conn
+
+    def _disk_get(self, key: str, now: float):
+        conn = self._db()
+        row = conn.execute("SELECT value, expires_at, tool FROM llm_cache WHERE key=?", (key,)).fetchone()
+        if not row:
+            return None
+        if row[1] <= now:
+            self._disk_rows -= conn.execute("DELETE FROM llm_cache WHERE key=?", (key,)).rowcount
+            conn.commit()
+            return None
+        return row  # the hit reaches last_access when the entry leaves the memory tier
+
+    def _disk_set(self, key: str, value: str, expires_at: float, tool: str, now: float, accessed: dict,
+                  hot: list) -> int:
+        """Write one entry plus deferred last_access updates in one commit; returns rows evicted.
+
+        Keys in `hot` (the memory tier, whose disk last_access may be stale) are never evicted.
+        """
+        conn = self._db()
+        if accessed:
+            conn.executemany("UPDATE llm_cache SET last_access=? WHERE key=?",
+                             [(ts, k) for k, ts in accessed.items()])
+        exists = conn.execute("SELECT 1 FROM llm_cache WHERE key=?", (key,)).fetchone()
+        conn.execute(
+            "INSERT OR REPLACE INTO llm_cache(key,tool,value,expires_at,last_access) VALUES(?,?,?,?,?)",
+            (key, tool, value, expires_at, now)
+        )
+        if not exists:
+            self._disk_rows += 1
+        evicted = 0
+        if self._disk_rows > self.max_disk_entries:
+            self._disk_rows -= conn.execute("DELETE FROM llm_cache WHERE expires_at<=?", (now,)).rowcount
+            overflow = self._disk_rows - self.max_disk_entries
+            if overflow > 0:
+                keep = f"WHERE key NOT IN ({','.join('?' * len(hot))})" if hot else ""
+                evicted = conn.execute(
+                    f"DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache {keep} ORDER BY last_access LIMIT ?)",
+                    (*hot, overflow)
+                ).rowcount
+                self._disk_rows -= evicted
+        conn.commit()
+        return evicted
+
+    # ── memory tier ───────────────────────────────────────────────────────────
+
+    def _mem_put(self, key: str, value: str, expires_at: float, tool: str, hit_at: float = None):
+        old = self._mem.pop(key, None)
+        if old:
+            self._mem_bytes -= len(old[0])
+        self._mem[key] = (value, expires_at, tool, hit_at)
+        self._mem_bytes += len(value)
+        while self._mem and (len(self._mem) > self.max_memory_entries or self._mem_bytes > self.max_memory_bytes):
+            evicted_key, (evicted, _, _, hit_at) = self._mem.popitem(last=False)
+            self._mem_bytes -= len(evicted)
+            if hit_at:
+                self._accessed[evicted_key] = hit_at
+            self.counters["evictions"] += 1
+
+    def _count(self, tool: str, hit: bool):
+        stats = self.by_tool.setdefault(tool or "unknown", {"hits": 0, "misses": 0})
+        stats["hits" if hit else "misses"] += 1
+
+    # ── public API ────────────────────────────────────────────────────────────
+
+    def get(self, key: str, tool: str = ""):
+        """Return cached value or None. Promotes disk hits into memory."""
+        now = time.time()
+        with self._lock:
+            entry = self._mem.get(key)
+            if entry:
+                if entry[1] > now:
+                    self._mem[key] = entry[:3] + (now,)
+                    self._mem.move_to_end(key)
+                    self.counters["memory_hits"] += 1
+                    self._count(tool, True)
+                    return entry[0]
+                self._mem.pop(key)
+                self._mem_bytes -= len(entry[0])
+        try:
+            with self._disk_lock:
+                row = self._disk_get(key, now)
+        except sqlite3.Error as e:
+            print(f"⚠️ LLM cache read error: {e}")
+            row = None
+        with self._lock:
+            if row:
+                self._mem_put(key, row[0], row[1], row[2], now)
+                self.counters["disk_hits"] += 1
+                self._count(tool, True)
+                return row[0]
+            self.counters["misses"] += 1
+            self._count(tool, False)
+            return None
+
+    def set(self, key: str, value: str, ttl: float, tool: str = ""):
+        """Store a value in both tiers for `ttl` seconds."""
+        if not value or ttl <= 0:
+            return
+        now = time.time()
+        expires_at = now + ttl
+        with self._lock:
+            self._mem_put(key, value, expires_at, tool)
+            self.counters["writes"] += 1
+            accessed, self._accessed = self._accessed, {}
+            hot = list(self._mem) if self._disk_rows >= self.max_disk_entries else []
+        try:
+            with self._disk_lock:
+                evicted = self._disk_set(key, value, expires_at, tool, now, accessed, hot)
+        except sqlite3.Error as e:
+            print(f"⚠️ LLM cache write error: {e}")
+            return
+        if evicted:
+            with self._lock:
+                self.counters["evictions"] += evicted
+
+    def note_bypass(self):
+        with self._lock:
+            self.counters["bypasses"] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits = self.counters["memory_hits"] + self.counters["disk_hits"]
+            lookups = hits + self.counters["misses"]
+            return {
+                **self.counters,
+                "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+                "memory_entries": len(self._mem),
+                "memory_bytes": self._mem_bytes,
+                "disk_entries": self._disk_rows,
+                "by_tool": {k: dict(v) for k, v in self.by_tool.items()},
+            }
@@ -0,0 +1,718 @@
+#!/usr/bin/env python3
+"""
+LLM gateway for Viser AI - one pooled, keep-alive HTTP session per provider.
+
+Every chat-completion call in flask_server.py goes through complete() or
+stream() so TCP/TLS connections to Groq and OpenAI are reused across requests
+instead of being set up again for every call.
+
+Calls also pass through a shared per-provider/model rate limiter (token
+buckets for requests/min and tokens/min with a bounded priority wait queue),
+which spec2.ai_planner uses too so the limits hold process-wide.
+
+Identical blocking calls that are already in flight are coalesced
+(single-flight): concurrent callers wait on one upstream request.
+
+Each upstream call is reported to registered observers (add_observer) with
+token usage, latency, time-to-first-token and error class; callers that use a
+provider SDK directly (spec2.ai_planner) report theirs with report_call().
+
+A circuit breaker per provider/model trips on 429/5xx/timeouts; calls are routed
+to the next healthy provider automatically, and interactive calls can hedge
+with a second provider after a latency threshold (LLM_HEDGE_AFTER).
+"""
+import os
+import json
+import time
+import hashlib
+import heapq
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FuturesTimeout
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Both providers speak the OpenAI chat-completions wire format.
+PROVIDERS = {
+    "groq": {
+        "label": "Groq",
+        "url": "https://api.groq.com/openai/v1/chat/completions",
+        "key_env": "GROQ_API_KEY",
+        "model_env": "GROQ_MODEL",
+        "default_model": "llama-3.3-70b-versatile",
+    },
+    "openai": {
+        "label": "OpenAI",
+        "url": "https://api.openai.com/v1/chat/completions",
+        "key_env": "OPENAI_API_KEY",
+        "model_env": "OPENAI_MODEL",
+        "default_model": "o4-mini-2025-04-16",
+    },
+}
+
+# Max pooled keep-alive connections per provider host
+POOL_SIZE = int(os.getenv("LLM_POOL_SIZE", "20"))
+DEFAULT_TIMEOUT = int(os.getenv("API_TIMEOUT", "120"))
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+# Rate limiting: lower number = served first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 10
+# Longest a caller will queue before failing fast (or falling back)
+MAX_WAIT = {
+    PRIORITY_INTERACTIVE: float(os.getenv("LLM_MAX_WAIT_INTERACTIVE", "5")),
+    PRIORITY_BATCH: float(os.getenv("LLM_MAX_WAIT_BATCH", "60")),
+}
+MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "64"))
+# Flat rate-limit cost of one image part (base64 payload size says nothing about tokens)
+IMAGE_TOKENS = int(os.getenv("LLM_IMAGE_TOKENS", "1000"))
+# Per-provider limits, applied to each model separately. OpenAI default keeps the
+# old "one call per 5 s" budget from chat().
+RATE_LIMITS = {
+    "groq": {"rpm": int(os.getenv("GROQ_RPM", "30")), "tpm": int(os.getenv("GROQ_TPM", "300000"))},
+    "openai": {"rpm": int(os.getenv("OPENAI_RPM", "12")), "tpm": int(os.getenv("OPENAI_TPM", "200000"))},
+}
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+# Circuit breaker: consecutive failures before a provider/model is skipped, and how
+# long it stays open before a single half-open probe is let through
+BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "3"))
+BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+# Seconds before an interactive hedged call also asks the next provider (0 = off)
+HEDGE_AFTER = float(os.getenv("LLM_HEDGE_AFTER", "0"))
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+_hedge_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="llm-hedge")
+
+
+class LLMError(Exception):
+    """Provider answered with a non-200 status."""
+
+    def __init__(self, provider: str, status_code: int, body: str = ""):
+        self.provider = provider
+        self.status_code = status_code
+        self.body = body
+        label = PROVIDERS.get(provider, {}).get("label", provider)
+        super().__init__(f"{label} API Error {status_code}: {body}")
+
+
+class RateLimitExceeded(Exception):
+    """Caller would have to wait longer than allowed for a provider slot."""
+
+    def __init__(self, provider: str, model: str, wait: float):
+        self.provider = provider
+        self.model = model
+        self.wait = wait
+        super().__init__(f"Rate limit reached for {provider}/{model}; retry in {wait:.1f}s")
+
+
+class RequestTooLarge(LLMError):
+    """Estimated cost exceeds the provider's whole tokens-per-minute budget; no wait would help."""
+
+    def __init__(self, provider: str, model: str, cost: float, capacity: float):
+        self.model = model
+        self.cost = cost
+        self.capacity = capacity
+        super().__init__(provider, 413, f"request needs ~{cost:.0f} tokens, above the {capacity:.0f}/min budget for {model}")
+
+
+class CircuitOpen(LLMError):
+    """Provider/model is tripped and still cooling down; no request was sent."""
+
+    def __init__(self, provider: str, model: str, retry_in: float):
+        self.model = model
+        self.retry_in = retry_in
+        super().__init__(provider, 503, f"circuit open for {model}; retry in {retry_in:.0f}s")
+
+
+class TokenBucket:
+    """Classic token bucket refilled continuously at `per_minute` / 60 per second."""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(max(1, per_minute))
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_for(self, amount: float) -> float:
+        """Seconds until `amount` (<= capacity) tokens are available (0 if available now)."""
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """Requests/min + tokens/min buckets with a bounded, priority-ordered wait queue."""
+
+    def __init__(self, rpm: int, tpm: int, max_queue: int = MAX_QUEUE):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_queue = max_queue
+        self._waiters = []  # heap of (priority, seq)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def _wait_needed(self, cost: float) -> float:
+        now = time.monotonic()
+        self.requests.refill(now)
+        self.tokens.refill(now)
+        return max(self.requests.wait_for(1), self.tokens.wait_for(cost))
+
+    def acquire(self, cost: float, priority: int = PRIORITY_INTERACTIVE, max_wait: float = None) -> float:
+        """Block until a slot is free. Raises RateLimitExceeded instead of waiting past max_wait.
+
+        Only the head of the queue may consume, so interactive callers overtake
+        queued batch work. Returns the seconds spent waiting.
+        """
+        if cost > self.tokens.capacity:
+            raise RequestTooLarge("", "", cost, self.tokens.capacity)
+        if max_wait is None:
+            max_wait = MAX_WAIT.get(priority, MAX_WAIT[PRIORITY_BATCH])
+        start = time.monotonic()
+        deadline = start + max_wait
+        with self._cond:
+            if len(self._waiters) >= self.max_queue:
+                raise RateLimitExceeded("", "", self._wait_needed(cost))
+            ticket = (priority, next(self._seq))
+            heapq.heappush(self._waiters, ticket)
+            try:
+                while True:
+                    wait = self._wait_needed(cost)
+                    now = time.monotonic()
+                    if self._waiters[0] == ticket:
+                        if wait <= 0:
+                            self.requests.tokens -= 1
+                            self.tokens.tokens -= cost
+                            return now - start
+                        if now + wait > deadline:
+                            raise RateLimitExceeded("", "", wait)
+                    elif now >= deadline:
+                        raise RateLimitExceeded("", "", wait)
+                    self._cond.wait(min(wait or 0.05, deadline - now))
+            finally:
+                self._waiters.remove(ticket)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+
+
+def get_limiter(provider: str, model: str) -> RateLimiter:
+    key = (provider.lower(), model)
+    limiter = _limiters.get(key)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _limiters.get(key)
+            if limiter is None:
+                limits = RATE_LIMITS.get(provider.lower(), {"rpm": 60, "tpm": 100000})
+                limiter = RateLimiter(limits["rpm"], limits["tpm"])
+                _limiters[key] = limiter
+    return limiter
+
+
+def _content_cost(content) -> tuple:
+    """(chars, images) of one message's content: a string or a list of text/image parts."""
+    if not isinstance(content, list):
+        return len(json.dumps(content, ensure_ascii=False)), 0
+    chars = images = 0
+    for part in content:
+        if isinstance(part, dict) and part.get("type") in ("image_url", "image"):
+            images += 1
+        elif isinstance(part, dict) and "text" in part:
+            chars += len(part["text"] or "")
+        else:
+            chars += len(json.dumps(part, ensure_ascii=False))
+    return chars, images
+
+
+def estimate_tokens(messages_or_text, max_tokens: int = 0) -> int:
+    """Rough token estimate (~4 chars/token, IMAGE_TOKENS per image part) of the prompt plus the completion budget."""
+    if isinstance(messages_or_text, str):
+        chars, images = len(messages_or_text), 0
+    else:
+        costs = [_content_cost(m.get("content", "")) for m in messages_or_text]
+        chars, images = sum(c for c, _ in costs), sum(i for _, i in costs)
+    return chars // 4 + images * IMAGE_TOKENS + (max_tokens or 0)
+
+
+def acquire(provider: str, model: str, cost: int, priority: int = PRIORITY_INTERACTIVE, max_wait: float = None) -> float:
+    """Reserve one request and `cost` tokens against the shared limiter for provider/model."""
+    try:
+        return get_limiter(provider, model).acquire(cost, priority, max_wait)
+    except RateLimitExceeded as e:
+        raise RateLimitExceeded(provider, model, e.wait) from None
+    except RequestTooLarge as e:
+        raise RequestTooLarge(provider, model, e.cost, e.capacity) from None
+
+
+class CircuitBreaker:
+    """closed -> open after N consecutive failures -> half-open (one probe) after cooldown."""
+
+    def __init__(self, failures: int = BREAKER_FAILURES, cooldown: float = BREAKER_COOLDOWN):
+        self.max_failures = max(1, failures)
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def retry_in(self) -> float:
+        return max(0.0, self.opened_at + self.cooldown - time.monotonic())
+
+    def is_open(self) -> bool:
+        """True while tripped and cooling down (does not take the half-open probe)."""
+        with self._lock:
+            return self.state == "open" and self.retry_in() > 0
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and self.retry_in() <= 0:
+                self.state = "half_open"
+            if self.state == "half_open" and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def release(self):
+        """Call finished without telling us anything about provider health."""
+        with self._lock:
+            self._probing = False
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._probing = False
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.max_failures:
+                if self.state != "open":
+                    self.trips += 1
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"state": self.state, "failures": self.failures, "trips": self.trips,
+                    "retry_in": round(self.retry_in(), 1) if self.state == "open" else 0.0}
+
+
+def get_breaker(provider: str, model: str) -> CircuitBreaker:
+    key = (provider.lower(), model)
+    breaker = _breakers.get(key)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.setdefault(key, CircuitBreaker())
+    return breaker
+
+
+def breaker_stats() -> dict:
+    """State of every circuit breaker seen so far, keyed "provider/model"."""
+    with _breakers_lock:
+        items = list(_breakers.items())
+    return {f"{p}/{m}": b.snapshot() for (p, m), b in items}
+
+
+def is_failover_error(exc) -> bool:
+    """Errors that say "this provider is unhealthy right now": 429, 5xx, timeouts,
+    connection failures, local rate-limit waits and open circuits. Works for
+    requests exceptions and the groq/openai SDK errors."""
+    if isinstance(exc, (RateLimitExceeded, CircuitOpen)):
+        return True
+    status = getattr(exc, "status_code", None)
+    if status:
+        return status == 429 or status >= 500
+    if "insufficient_quota" in str(exc).lower():
+        return True
+    name = type(exc).__name__
+    return "Timeout" in name or "Connection" in name
+
+
+def healthy_providers(exclude: str = None) -> list:
+    """Providers with a configured key whose default model's breaker is not open."""
+    return [
+        name for name, cfg in PROVIDERS.items()
+        if name != exclude and os.getenv(cfg["key_env"])
+        and not get_breaker(name, default_model(name)).is_open()
+    ]
+
+
+def _route(provider: str, model, fallback: bool) -> list:
+    """Ordered (provider, model) candidates. An explicit model pins the provider
+    (e.g. vision requests), so there is no failover for it."""
+    provider = provider.lower()
+    candidates = [(provider, model or default_model(provider))]
+    if fallback and not model:
+        candidates += [(alt, default_model(alt)) for alt in healthy_providers(exclude=provider)]
+    return candidates
+
+
+class SingleFlight:
+    """Collapse concurrent calls with the same key into one execution.
+
+    The first caller (leader) runs the function; callers arriving while it is in
+    flight wait and receive the same result or exception. Nothing is kept after
+    the call finishes - this dedupes in-flight work only, it is not a cache.
+    """
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.counters = {"leaders": 0, "coalesced": 0, "errors": 0}
+        self.by_provider = {}  # provider -> {"leaders": n, "coalesced": n}
+
+    def do(self, key: str, fn, label: str = ""):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+            self.counters["leaders" if leader else "coalesced"] += 1
+            stats = self.by_provider.setdefault(label or "unknown", {"leaders": 0, "coalesced": 0})
+            stats["leaders" if leader else "coalesced"] += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            with self._lock:
+                self.counters["errors"] += 1
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.counters["leaders"] + self.counters["coalesced"]
+            return {
+                **self.counters,
+                "in_flight": len(self._calls),
+                "coalesced_rate": round(self.counters["coalesced"] / total, 4) if total else 0.0,
+                "by_provider": {k: dict(v) for k, v in self.by_provider.items()},
+            }
+
+
+_single_flight = SingleFlight()
+
+_observers = []
+
+
+def add_observer(fn):
+    """Register fn(record) to be called after every upstream call.
+
+    record keys: provider, model, stream, prompt_tokens, completion_tokens,
+    latency, ttft (streams only), error (exception or None).
+    """
+    _observers.append(fn)
+
+
+def report_call(record: dict):
+    """Report an upstream call made outside this module (e.g. through a provider SDK) to
+    the observers; missing keys default as for calls made here."""
+    _notify({"stream": False, "prompt_tokens": 0, "completion_tokens": 0, "latency": 0.0,
+             "ttft": None, "error": None, **record})
+
+
+_call_wrapper = None
+
+
+def set_call_wrapper(fn):
+    """Register fn(callable) -> callable, applied on the caller's thread before work moves to
+    the hedging pool, so thread-local request state (e.g. metrics labels) follows the call."""
+    global _call_wrapper
+    _call_wrapper = fn
+
+
+def _in_caller_context(fn):
+    return _call_wrapper(fn) if _call_wrapper else fn
+
+
+def _notify(record: dict):
+    for fn in _observers:
+        try:
+            fn(record)
+        except Exception as e:
+            print(f"⚠️ LLM observer error: {e}")
+
+
+def _usage_tokens(usage: dict, messages: list, text: str):
+    """(prompt, completion) tokens from a provider usage block, estimated if absent."""
+    if usage:
+        return usage.get("prompt_tokens", 0) or 0, usage.get("completion_tokens", 0) or 0
+    return estimate_tokens(messages), len(text or "") // 4
+
+
+def singleflight_stats() -> dict:
+    """Counters for coalesced in-flight completions."""
+    return _single_flight.stats()
+
+
+def request_fingerprint(provider: str, model: str, messages: list, temperature, max_tokens: int) -> str:
+    material = json.dumps([provider, model, temperature, max_tokens, messages], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+def _provider_cfg(provider: str) -> dict:
+    cfg = PROVIDERS.get((provider or "").lower())
+    if not cfg:
+        raise ValueError(f"Unsupported provider '{provider}'. Choose from: {', '.join(PROVIDERS)}")
+    return cfg
+
+
+def default_model(provider: str) -> str:
+    """Model configured for a provider in .env (GROQ_MODEL / OPENAI_MODEL)."""
+    cfg = _provider_cfg(provider)
+    return os.getenv(cfg["model_env"]) or cfg["default_model"]
+
+
+def get_session(provider: str) -> requests.Session:
+    """Return the shared keep-alive session for a provider, creating it on first use."""
+    provider = provider.lower()
+    session = _sessions.get(provider)
+    if session is not None:
+        return session
+    with _sessions_lock:
+        session = _sessions.get(provider)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            session.mount("https://", adapter)
+            session.headers.update({"Content-Type": "application/json"})
+            _sessions[provider] = session
+    return session
+
+
+def _build_payload(model: str, messages: list, temperature, max_tokens: int, stream: bool) -> dict:
+    payload = {"model": model, "messages": messages}
+    if temperature is not None:
+        payload["temperature"] = temperature
+    # o1/o4 reasoning models reject max_tokens (same rule as spec2.ai_planner)
+    if "o4" in model.lower() or "o1" in model.lower():
+        payload["max_completion_tokens"] = max_tokens
+    else:
+        payload["max_tokens"] = max_tokens
+    if stream:
+        payload["stream"] = True
+    return payload
+
+
+def _stream_usage(chunk: dict):
+    """Usage block of a streamed chunk (OpenAI: usage, Groq: x_groq.usage)."""
+    return chunk.get("usage") or (chunk.get("x_groq") or {}).get("usage")
+
+
+def _post(provider: str, payload: dict, timeout, stream: bool = False) -> requests.Response:
+    cfg = _provider_cfg(provider)
+    headers = {"Authorization": f"Bearer {os.getenv(cfg['key_env'], '')}"}
+    return get_session(provider).post(
+        cfg["url"], headers=headers, json=payload,
+        timeout=timeout or DEFAULT_TIMEOUT, stream=stream
+    )
+
+
+def _complete_once(provider: str, model: str, messages: list, temperature, max_tokens: int,
+                   timeout, priority: int) -> str:
+    """One upstream attempt against one provider/model, guarded by its breaker."""
+    breaker = get_breaker(provider, model)
+    if not breaker.allow():
+        raise CircuitOpen(provider, model, breaker.retry_in())
+    try:
+        acquire(provider, model, estimate_tokens(messages, max_tokens), priority)
+    except (RateLimitExceeded, RequestTooLarge) as e:
+        breaker.release()
+        _notify({"provider": provider, "model": model, "stream": False, "prompt_tokens": 0,
+                 "completion_tokens": 0, "latency": 0.0, "ttft": None, "error": e})
+        raise
+    payload = _build_payload(model, messages, temperature, max_tokens, stream=False)
+    record = {"provider": provider, "model": model, "stream": False,
+              "prompt_tokens": 0, "completion_tokens": 0, "ttft": None, "error": None}
+    start = time.monotonic()
+    try:
+        response = _post(provider, payload, timeout)
+        if response.status_code != 200:
+            raise LLMError(provider, response.status_code, response.text)
+        body = response.json()
+        text = body["choices"][0]["message"]["content"] or ""
+        record["prompt_tokens"], record["completion_tokens"] = _usage_tokens(body.get("usage"), messages, text)
+        breaker.record_success()
+        return text
+    except Exception as e:
+        record["error"] = e
+        if is_failover_error(e):
+            breaker.record_failure()
+        else:
+            breaker.record_success()  # provider answered; the request itself was bad
+        raise
+    finally:
+        record["latency"] = time.monotonic() - start
+        _notify(record)
+
+
+def _complete_routed(candidates: list, *args) -> str:
+    """Try candidates in order, moving on only for provider-health errors."""
+    error = None
+    for i, (provider, model) in enumerate(candidates):
+        try:
+            return _complete_once(provider, model, *args)
+        except Exception as e:
+            if not is_failover_error(e):
+                raise
+            error = e
+            if i + 1 < len(candidates):
+                print(f"⚠️ {provider}/{model} unavailable ({e}), failing over to {candidates[i + 1][0]}")
+    raise error
+
+
+def _complete_hedged(candidates: list, hedge_after: float, *args) -> str:
+    """Ask the first candidate; if it has not answered within hedge_after seconds, also
+    ask the rest and return whichever succeeds first."""
+    # Observers run in the pool thread, so carry the caller's labels there (set_call_wrapper)
+    routed = _in_caller_context(_complete_routed)
+    primary = _hedge_pool.submit(routed, candidates[:1], *args)
+    try:
+        return primary.result(timeout=hedge_after)
+    except FuturesTimeout:
+        pass
+    except Exception as e:
+        if not is_failover_error(e):
+            raise
+        return _complete_routed(candidates[1:], *args)
+    print(f"⏱️ {candidates[0][0]} slower than {hedge_after:.1f}s, hedging with {candidates[1][0]}")
+    backup = _hedge_pool.submit(routed, candidates[1:], *args)
+    pending, error = {primary, backup}, None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                return future.result()
+            except Exception as e:
+                error = e
+    raise error
+
+
+def complete(provider: str, messages: list, model: str = None, temperature=0.3,
+             max_tokens: int = 2000, timeout=None, priority: int = PRIORITY_INTERACTIVE,
+             fallback: bool = True, hedge: bool = False) -> str:
+    """Blocking chat completion. Returns the assistant message content.
+
+    Concurrent calls with an identical provider/model/prompt/parameters share one
+    upstream request (and one rate-limit slot). Unhealthy providers are skipped via
+    their circuit breaker; with hedge=True (and LLM_HEDGE_AFTER set) a slow first
+    provider is raced against the next one.
+    """
+    key = request_fingerprint(provider.lower(), model or default_model(provider), messages, temperature, max_tokens)
+
+    def _call():
+        candidates = _route(provider, model, fallback)
+        args = (messages, temperature, max_tokens, timeout, priority)
+        if hedge and HEDGE_AFTER > 0 and len(candidates) > 1:
+            return _complete_hedged(candidates, HEDGE_AFTER, *args)
+        return _complete_routed(candidates, *args)
+
+    return _single_flight.do(key, _call, label=provider.lower())
+
+
+def _stream_once(provider: str, model: str, messages: list, temperature, max_tokens: int,
+                 timeout, priority: int):
+    breaker = get_breaker(provider, model)
+    if not breaker.allow():
+        raise CircuitOpen(provider, model, breaker.retry_in())
+    try:
+        acquire(provider, model, estimate_tokens(messages, max_tokens), priority)
+    except (RateLimitExceeded, RequestTooLarge) as e:
+        breaker.release()
+        _notify({"provider": provider, "model": model, "stream": True, "prompt_tokens": 0,
+                 "completion_tokens": 0, "latency": 0.0, "ttft": None, "error": e})
+        raise
+    payload = _build_payload(model, messages, temperature, max_tokens, stream=True)
+    if provider == "openai":
+        payload["stream_options"] = {"include_usage": True}
+    record = {"provider": provider, "model": model, "stream": True,
+              "prompt_tokens": 0, "completion_tokens": 0, "ttft": None, "error": None}
+    usage, parts = None, []
+    start = time.monotonic()
+    try:
+        with _post(provider, payload, timeout, stream=True) as response:
+            if response.status_code != 200:
+                raise LLMError(provider, response.status_code, response.text)
+            for raw in response.iter_lines():
+                # Decode ourselves: requests assumes latin-1 for text/event-stream without a charset
+                line = raw.decode("utf-8", errors="replace").strip() if raw else ""
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                try:
+                    chunk = json.loads(data)
+                except json.JSONDecodeError:
+                    continue
+                usage = _stream_usage(chunk) or usage
+                choices = chunk.get("choices") or []
+                delta = (choices[0].get("delta") or {}).get("content") if choices else None
+                if delta:
+                    if record["ttft"] is None:
+                        record["ttft"] = time.monotonic() - start
+                    parts.append(delta)
+                    yield delta
+        breaker.record_success()
+    except Exception as e:
+        record["error"] = e
+        if is_failover_error(e):
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        raise
+    finally:
+        breaker.release()  # client disconnected mid-stream: no verdict
+        record["latency"] = time.monotonic() - start
+        record["prompt_tokens"], record["completion_tokens"] = _usage_tokens(usage, messages, "".join(parts))
+        _notify(record)
+
+
+def stream(provider: str, messages: list, model: str = None, temperature=0.3,
+           max_tokens: int = 2000, timeout=None, priority: int = PRIORITY_INTERACTIVE,
+           fallback: bool = True):
+    """Streaming chat completion. Yields content deltas as they arrive (SSE).
+
+    Fails over to the next healthy provider only before the first delta is sent.
+    """
+    candidates = _route(provider, model, fallback)
+    for i, (cand_provider, cand_model) in enumerate(candidates):
+        started = False
+        try:
+            for delta in _stream_once(cand_provider, cand_model, messages, temperature,
+                                      max_tokens, timeout, priority):
+                started = True
+                yield delta
+            return
+        except Exception as e:
+            if started or not is_failover_error(e) or i + 1 == len(candidates):
+                raise
+            print(f"⚠️ {cand_provider}/{cand_model} unavailable ({e}), failing over to {candidates[i + 1][0]}")
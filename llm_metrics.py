@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+LLM usage and latency accounting for Viser AI.
+
+llm_gateway reports every upstream call (prompt/completion tokens, latency,
+time-to-first-token for streams, error class); flask_server labels it with the
+endpoint and user and records it here. render_prometheus() produces the
+Prometheus text exposition served at /api/metrics.
+"""
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+TOKEN_BUCKETS = (64, 256, 1024, 2048, 4096, 8192, 16384, 65536)
+
+_tags = threading.local()
+
+
+@contextmanager
+def tags(**labels):
+    """Attach labels (endpoint, user) to LLM calls made by this thread, e.g. pool workers."""
+    previous = getattr(_tags, "labels", None)
+    _tags.labels = {**(previous or {}), **labels}
+    try:
+        yield
+    finally:
+        _tags.labels = previous
+
+
+def current_tags() -> dict:
+    return dict(getattr(_tags, "labels", None) or {})
+
+
+def error_class(exc) -> str:
+    """Short, low-cardinality label for an exception raised by an LLM call."""
+    status = getattr(exc, "status_code", None)
+    if status:
+        return f"http_{status}"
+    name = type(exc).__name__
+    if name == "RateLimitExceeded":
+        return "rate_limited"
+    if "Timeout" in name:
+        return "timeout"
+    if "Connection" in name:
+        return "connection"
+    return name
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus sense."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+def _fmt_labels(names, values, extra: str = "") -> str:
+    parts = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        parts.append(f'{name}="{value}"')
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class MetricsRegistry:
+    """Counters and histograms keyed by (endpoint, provider, model) plus a rolling per-user window."""
+
+    LABELS = ("endpoint", "provider", "model")
+
+    def __init__(self, user_window: float = 3600, max_window_events: int = 50000):
+        self.user_window = user_window
+        self._lock = threading.Lock()
+        self.requests = {}           # labels + (status,) -> n
+        self.errors = {}             # labels + (error_class,) -> n
+        self.prompt_tokens = {}      # labels -> n
+        self.completion_tokens = {}  # labels -> n
+        self.latency = {}            # labels -> Histogram
+        self.ttft = {}               # labels -> Histogram
+        self.completion_hist = {}    # labels -> Histogram
+        self._events = deque(maxlen=max_window_events)  # (ts, user, endpoint, prompt, completion, latency, error)
+        self.serialization = {}      # (endpoint, kind, format) -> [calls, json_tokens, encoded_tokens]
+
+    def record(self, endpoint: str, provider: str, model: str, user: str = "anonymous",
+               prompt_tokens: int = 0, completion_tokens: int = 0, latency: float = 0.0,
+               ttft: float = None, error: str = None):
+        key = (endpoint or "unknown", provider or "unknown", model or "unknown")
+        now = time.time()
+        with self._lock:
+            status = "error" if error else "ok"
+            self.requests[key + (status,)] = self.requests.get(key + (status,), 0) + 1
+            if error:
+                self.errors[key + (error,)] = self.errors.get(key + (error,), 0) + 1
+            self.prompt_tokens[key] = self.prompt_tokens.get(key, 0) + (prompt_tokens or 0)
+            self.completion_tokens[key] = self.completion_tokens.get(key, 0) + (completion_tokens or 0)
+            self.latency.setdefault(key, Histogram(LATENCY_BUCKETS)).observe(latency)
+            if ttft is not None:
+                self.ttft.setdefault(key, Histogram(LATENCY_BUCKETS)).observe(ttft)
+            if not error:
+                self.completion_hist.setdefault(key, Histogram(TOKEN_BUCKETS)).observe(completion_tokens or 0)
+            self._events.append((now, user or "anonymous", key[0], prompt_tokens or 0,
+                                 completion_tokens or 0, latency, bool(error)))
+
+    def record_serialization(self, endpoint: str, kind: str, fmt: str, json_tokens: int, encoded_tokens: int):
+        """Prompt payload size as plain JSON vs. as actually sent (TOON / compact JSON)."""
+        key = (endpoint or "unknown", kind, fmt)
+        with self._lock:
+            row = self.serialization.setdefault(key, [0, 0, 0])
+            row[0] += 1
+            row[1] += json_tokens
+            row[2] += encoded_tokens
+
+    def serialization_stats(self) -> dict:
+        with self._lock:
+            return {
+                f"{endpoint} {kind}": {
+                    "format": fmt, "calls": calls, "json_tokens": json_tokens, "encoded_tokens": encoded,
+                    "saved_tokens": json_tokens - encoded,
+                    "saved_ratio": round(1 - encoded / json_tokens, 4) if json_tokens else 0.0,
+                }
+                for (endpoint, kind, fmt), (calls, json_tokens, encoded) in sorted(self.serialization.items())
+            }
+
+    def user_breakdown(self) -> dict:
+        """Per-user, per-endpoint totals over the last `user_window` seconds."""
+        cutoff = time.time() - self.user_window
+        out = {}
+        with self._lock:
+            while self._events and self._events[0][0] < cutoff:
+                self._events.popleft()
+            for _, user, endpoint, prompt, completion, latency, failed in self._events:
+                u = out.setdefault(user, {"requests": 0, "errors": 0, "prompt_tokens": 0,
+                                          "completion_tokens": 0, "latency_seconds": 0.0, "endpoints": {}})
+                e = u["endpoints"].setdefault(endpoint, {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0})
+                for bucket in (u, e):
+                    bucket["requests"] += 1
+                    bucket["prompt_tokens"] += prompt
+                    bucket["completion_tokens"] += completion
+                u["errors"] += int(failed)
+                u["latency_seconds"] = round(u["latency_seconds"] + latency, 3)
+        return out
+
+    def _render_histograms(self, lines: list, name: str, help_text: str, series: dict):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} histogram")
+        for key, hist in sorted(series.items()):
+            for bound, count in zip(hist.buckets, hist.counts):
+                le = 'le="%s"' % bound
+                lines.append(f"{name}_bucket{_fmt_labels(self.LABELS, key, le)} {count}")
+            inf = 'le="+Inf"'
+            lines.append(f"{name}_bucket{_fmt_labels(self.LABELS, key, inf)} {hist.count}")
+            lines.append(f"{name}_sum{_fmt_labels(self.LABELS, key)} {round(hist.sum, 6)}")
+            lines.append(f"{name}_count{_fmt_labels(self.LABELS, key)} {hist.count}")
+
+    def _render_counter(self, lines: list, name: str, help_text: str, series: dict, extra_label: str = None):
+        names = self.LABELS + ((extra_label,) if extra_label else ())
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} counter")
+        for key, value in sorted(series.items()):
+            lines.append(f"{name}{_fmt_labels(names, key)} {value}")
+
+    def render_prometheus(self, extra: dict = None) -> str:
+        """Prometheus text format (0.0.4). `extra` adds plain series: {name: (help, value[, type])}."""
+        users = self.user_breakdown()
+        lines = []
+        with self._lock:
+            self._render_counter(lines, "llm_requests_total", "Upstream LLM calls.", self.requests, "status")
+            self._render_counter(lines, "llm_errors_total", "Failed LLM calls by error class.", self.errors, "error_class")
+            self._render_counter(lines, "llm_prompt_tokens_total", "Prompt tokens billed.", self.prompt_tokens)
+            self._render_counter(lines, "llm_completion_tokens_total", "Completion tokens billed.", self.completion_tokens)
+            self._render_histograms(lines, "llm_upstream_latency_seconds", "Upstream LLM call latency.", self.latency)
+            self._render_histograms(lines, "llm_time_to_first_token_seconds", "Time to first streamed token.", self.ttft)
+            self._render_histograms(lines, "llm_completion_tokens", "Completion tokens per call.", self.completion_hist)
+            names = ("endpoint", "kind", "format")
+            lines.append("# HELP llm_prompt_serialized_tokens_total Estimated prompt payload tokens as plain JSON (baseline) and as sent (encoded).")
+            lines.append("# TYPE llm_prompt_serialized_tokens_total counter")
+            baseline, sent = 'variant="baseline"', 'variant="encoded"'
+            for key, (_, json_tokens, encoded) in sorted(self.serialization.items()):
+                lines.append(f"llm_prompt_serialized_tokens_total{_fmt_labels(names, key, baseline)} {json_tokens}")
+                lines.append(f"llm_prompt_serialized_tokens_total{_fmt_labels(names, key, sent)} {encoded}")
+        lines.append(f"# HELP llm_user_window_tokens Tokens per user over the last {int(self.user_window)}s.")
+        lines.append("# TYPE llm_user_window_tokens gauge")
+        for user, u in sorted(users.items()):
+            for kind in ("prompt", "completion"):
+                lines.append(f"llm_user_window_tokens{_fmt_labels(('user', 'kind'), (user, kind))} {u[kind + '_tokens']}")
+        lines.append(f"# HELP llm_user_window_requests LLM calls per user over the last {int(self.user_window)}s.")
+        lines.append("# TYPE llm_user_window_requests gauge")
+        for user, u in sorted(users.items()):
+            lines.append(f"llm_user_window_requests{_fmt_labels(('user',), (user,))} {u['requests']}")
+        for name, (help_text, value, *kind) in (extra or {}).items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind[0] if kind else 'counter'}")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""
+Page-sharded PDF text extraction for Viser AI.
+
+PyPDF2's extract_text() is pure Python and holds the GIL, so extracting a large
+PDF on a request thread stalls every other request in the process. PdfEngine
+splits a document into page ranges and extracts them in a ProcessPoolExecutor,
+yielding page text back in page order as shards finish.
+
+Per-document budgets:
+- timeout: wall-clock limit for the whole document (enforced in the workers
+  with an interval timer, so a pathological page cannot pin a worker forever)
+- max_pages / max_chars: extraction stops (truncates) past these
+- max_worker_mb: address-space headroom for each worker process (POSIX), so
+  one hostile PDF fails with MemoryError instead of taking the host down
+
+Workers are forked once, by the server's entry point (start()), and never import
+the Flask app: spawn/forkserver children re-import the parent's __main__ module,
+which here would re-run flask_server's module-level setup (DB writers, schedulers)
+in every worker. The pool is never forked lazily from a request: until start() runs
+(CLI tools, plain imports), where fork is unavailable (Windows), and after a worker
+crash breaks the pool, pages are extracted in-process instead - re-forking a busy
+multithreaded server can deadlock the child on a lock held by another thread.
+Memory-budget overruns surface as MemoryError in the worker and do not break the pool.
+"""
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+
+class ExtractionBudgetExceeded(RuntimeError):
+    """Raised when a document runs past its time budget."""
+
+
+# ─── Worker side ────────────────────────────────────────────────────────────
+
+def _address_space() -> int:
+    """Current virtual size of this process in bytes (0 if unknown)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+
+def _init_worker(max_worker_mb: int):
+    # A forked worker starts with the parent's address space, so the cap is headroom on top of it
+    if max_worker_mb:
+        try:
+            import resource
+            limit = _address_space() + max_worker_mb * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        except (ImportError, ValueError, OSError):
+            pass
+
+
+def _on_deadline(signum, frame):
+    raise TimeoutError("PDF extraction time budget exceeded")
+
+
+def _arm_deadline(deadline: float):
+    if deadline and hasattr(signal, "setitimer"):
+        signal.signal(signal.SIGALRM, _on_deadline)
+        signal.setitimer(signal.ITIMER_REAL, max(0.01, deadline - time.time()))
+
+
+def _disarm_deadline():
+    if hasattr(signal, "setitimer"):
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+def _page_count(path: str, deadline: float = None) -> int:
+    import PyPDF2
+    _arm_deadline(deadline)
+    try:
+        with open(path, "rb") as f:
+            return len(PyPDF2.PdfReader(f).pages)
+    finally:
+        _disarm_deadline()
+
+
+def _extract_range(path: str, start: int, stop: int, deadline: float = None) -> list:
+    """Text of pages [start, stop) of one PDF (runs in a worker process)."""
+    import PyPDF2
+    _arm_deadline(deadline)
+    try:
+        with open(path, "rb") as f:
+            pages = PyPDF2.PdfReader(f).pages
+            return [pages[i].extract_text() or "" for i in range(start, min(stop, len(pages)))]
+    finally:
+        _disarm_deadline()
+
+
+# ─── Engine ─────────────────────────────────────────────────────────────────
+
+class PdfEngine:
+    """Shared process pool that extracts PDFs shard by shard."""
+
+    def __init__(self, workers: int = None, pages_per_shard: int = 8, timeout: float = 120.0,
+                 max_pages: int = 2000, max_chars: int = 5_000_000, max_worker_mb: int = 1024):
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.pages_per_shard = max(1, pages_per_shard)
+        self.timeout = timeout
+        self.max_pages = max_pages
+        self.max_chars = max_chars
+        self.max_worker_mb = max_worker_mb
+        self._pool = None
+        self._lock = threading.Lock()
+        self._page_totals = OrderedDict()  # path -> (size, mtime_ns, pages) seen by iter_pages
+        self.inline = "fork" not in multiprocessing.get_all_start_methods()
+        self.documents = 0
+        self.pages = 0
+        self.timeouts = 0
+        self.failures = 0
+
+    @property
+    def version(self) -> str:
+        """Part of the text-cache key: budgets that can truncate output change it."""
+        return f"p{self.max_pages}c{self.max_chars}"
+
+    def start(self):
+        """Fork the workers - call from the server entry point, before it serves requests."""
+        if self.inline:
+            return
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("fork"),
+                                                 initializer=_init_worker, initargs=(self.max_worker_mb,))
+                self._pool.submit(os.getpid).result()  # with fork, the first submit starts every worker
+
+    def _broken(self):
+        self.failures += 1
+        self.shutdown()
+        print("⚠️ PDF worker pool broke; extracting in-process until the server restarts")
+
+    def iter_pages(self, path: str):
+        """Yield (page_number, text) in page order; stops at max_pages / max_chars.
+
+        Raises ExtractionBudgetExceeded past the time budget; worker errors propagate.
+        """
+        path = os.path.abspath(path)
+        deadline = time.time() + self.timeout if self.timeout else None
+        pool = self._pool
+        if pool is None:
+            yield from self._iter_pages_inline(path, deadline)
+            return
+        pending = []
+        try:
+            total = self._remember_pages(path, self._result(pool.submit(_page_count, path, deadline), deadline))
+            if self.max_pages:
+                total = min(total, self.max_pages)
+            shards = iter(range(0, total, self.pages_per_shard))
+            window = self.workers * 2  # shards in flight; bounds memory held by finished-but-unread text
+
+            def submit_next():
+                start = next(shards, None)
+                if start is not None:
+                    pending.append((start, pool.submit(_extract_range, path, start,
+                                                       start + self.pages_per_shard, deadline)))
+
+            for _ in range(window):
+                submit_next()
+            chars = 0
+            self.documents += 1
+            while pending:
+                start, future = pending.pop(0)
+                texts = self._result(future, deadline)
+                submit_next()
+                for offset, text in enumerate(texts):
+                    if self.max_chars and chars + len(text) > self.max_chars:
+                        text = text[:self.max_chars - chars]
+                    chars += len(text)
+                    self.pages += 1
+                    yield start + offset + 1, text
+                    if self.max_chars and chars >= self.max_chars:
+                        return
+        except (TimeoutError, FutureTimeout):
+            self.timeouts += 1
+            raise ExtractionBudgetExceeded(f"PDF extraction exceeded its {self.timeout:g}s budget")
+        except BrokenProcessPool:
+            self._broken()
+            raise RuntimeError("PDF worker process died (crash or out of memory)")
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+    def _iter_pages_inline(self, path: str, deadline: float):
+        """No worker pool: extract in the calling thread, still within the page/char caps."""
+        total = self._remember_pages(path, _page_count(path))
+        if self.max_pages:
+            total = min(total, self.max_pages)
+        chars = 0
+        self.documents += 1
+        for start in range(0, total, self.pages_per_shard):
+            if deadline and time.time() > deadline:
+                self.timeouts += 1
+                raise ExtractionBudgetExceeded(f"PDF extraction exceeded its {self.timeout:g}s budget")
+            for offset, text in enumerate(_extract_range(path, start, start + self.pages_per_shard)):
+                if self.max_chars and chars + len(text) > self.max_chars:
+                    text = text[:self.max_chars - chars]
+                chars += len(text)
+                self.pages += 1
+                yield start + offset + 1, text
+                if self.max_chars and chars >= self.max_chars:
+                    return
+
+    def _remember_pages(self, path: str, total: int) -> int:
+        st = os.stat(path)
+        with self._lock:
+            self._page_totals[path] = (st.st_size, st.st_mtime_ns, total)
+            self._page_totals.move_to_end(path)
+            while len(self._page_totals) > 256:
+                self._page_totals.popitem(last=False)
+        return total
+
+    def page_count(self, path: str) -> int:
+        """Number of pages; free right after iter_pages on the same file, else read in a worker."""
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        with self._lock:
+            known = self._page_totals.get(path)
+        if known and known[:2] == (st.st_size, st.st_mtime_ns):
+            return known[2]
+        pool = self._pool
+        if pool is None:
+            return _page_count(path)
+        deadline = time.time() + self.timeout if self.timeout else None
+        try:
+            return self._result(pool.submit(_page_count, path, deadline), deadline)
+        except (TimeoutError, FutureTimeout):
+            self.timeouts += 1
+            raise ExtractionBudgetExceeded(f"PDF page count exceeded its {self.timeout:g}s budget")
+        except BrokenProcessPool:
+            self._broken()
+            raise RuntimeError("PDF worker process died (crash or out of memory)")
+
+    def extract(self, path: str) -> str:
+        """Whole-document text, pages joined by newlines (as PyPDF2 callers expect)."""
+        return "\n".join(text for _, text in self.iter_pages(path))
+
+    @staticmethod
+    def _result(future, deadline):
+        return future.result(timeout=max(0.0, deadline - time.time()) if deadline else None)
+
+    def stats(self) -> dict:
+        return {"workers": self.workers if self._pool else 0, "documents": self.documents, "pages": self.pages,
+                "timeouts": self.timeouts, "failures": self.failures}
+
+    def shutdown(self):
+        """Drop the worker pool; later extractions run in-process unless start() is called again."""
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool:
+            pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Bounded in-memory session cache for Viser AI.
+
+Replaces the unbounded user_sessions dict: entries are capped by count and by
+approximate size in bytes, least-recently-used sessions are evicted first, and
+a background sweeper drops sessions idle longer than a TTL. Sessions are
+written through to SQLite by the caller, so an evicted one is simply reloaded
+on its next access.
+
+Sizes are measured on writes only: `put` measures the new value, and callers
+that mutate a cached value in place report it with `touch`.
+
+Supports the dict operations flask_server uses (`in`, `[]`, `del`, `len`).
+"""
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+def approx_size(value) -> int:
+    """Rough in-memory footprint of a JSON-like value (strings dominate)."""
+    if isinstance(value, str):
+        return 49 + len(value)
+    if isinstance(value, dict):
+        return 64 + sum(approx_size(k) + approx_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return 56 + sum(approx_size(v) for v in value)
+    return sys.getsizeof(value)
+
+
+class SessionCache:
+    """LRU cache with entry/byte caps and idle TTL."""
+
+    def __init__(self, max_entries: int = 500, max_bytes: int = 64 * 1024 * 1024, idle_ttl: float = 3600,
+                 sweep_interval: float = 60, size_fn=approx_size):
+        self.max_entries = max(1, max_entries)
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.size_fn = size_fn
+        self._data = OrderedDict()  # key -> [value, size, last_access]
+        self._bytes = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = {"lru": 0, "bytes": 0, "idle": 0}
+        self._stop = threading.Event()
+        self._sweeper = None
+        if sweep_interval and idle_ttl:
+            self._sweeper = threading.Thread(target=self._sweep_loop, args=(sweep_interval,),
+                                             name="session-sweeper", daemon=True)
+            self._sweeper.start()
+
+    # ── dict-style access ────────────────────────────────────────────────────
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            return key in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+    def __delitem__(self, key):
+        if self.pop(key) is None:
+            raise KeyError(key)
+
+    # ── cache operations ─────────────────────────────────────────────────────
+    def get(self, key):
+        """Value for key (marking it most recently used), or None."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._data.move_to_end(key)
+            entry[2] = time.time()
+            return entry[0]
+
+    def peek(self, key):
+        """Value for key without marking it used (for background bookkeeping), or None."""
+        with self._lock:
+            entry = self._data.get(key)
+            return entry[0] if entry is not None else None
+
+    def put(self, key, value):
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            entry = [value, 0, time.time()]
+            self._data[key] = entry
+            self._resize(entry)
+            self._enforce(keep=key)
+
+    def touch(self, key, added=None):
+        """Account for an in-place mutation of key's value: add the size of `added`
+        (the part that was appended), or re-measure the whole value when it is None."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return
+            if added is None:
+                self._resize(entry)
+            else:
+                size = self.size_fn(added)
+                entry[1] += size
+                self._bytes += size
+            self._enforce(keep=key)
+
+    def pop(self, key):
+        """Remove without calling on_evict (explicit deletes)."""
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return None
+            self._bytes -= entry[1]
+            return entry[0]
+
+    def items(self) -> list:
+        with self._lock:
+            return [(k, e[0]) for k, e in self._data.items()]
+
+    def sweep(self) -> int:
+        """Evict entries idle longer than idle_ttl; returns how many were dropped."""
+        cutoff = time.time() - self.idle_ttl
+        with self._lock:
+            idle = [k for k, e in self._data.items() if e[2] < cutoff]
+            for key in idle:
+                self._bytes -= self._data.pop(key)[1]
+            self.evictions["idle"] += len(idle)
+        return len(idle)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._data), "bytes": self._bytes,
+                "max_entries": self.max_entries, "max_bytes": self.max_bytes,
+                "idle_ttl": self.idle_ttl, "hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": dict(self.evictions),
+            }
+
+    def close(self):
+        self._stop.set()
+
+    # ── internals ────────────────────────────────────────────────────────────
+    def _resize(self, entry):
+        size = self.size_fn(entry[0])
+        self._bytes += size - entry[1]
+        entry[1] = size
+
+    def _enforce(self, keep=None):
+        """Evict LRU entries until within both caps (never the entry just used). Call with the lock held."""
+        while len(self._data) > 1:
+            if len(self._data) > self.max_entries:
+                reason = "lru"
+            elif self.max_bytes and self._bytes > self.max_bytes:
+                reason = "bytes"
+            else:
+                break
+            key = next(iter(self._data))
+            if key == keep:
+                self._data.move_to_end(key)
+                key = next(iter(self._data))
+            self._bytes -= self._data.pop(key)[1]
+            self.evictions[reason] += 1
+
+    def _sweep_loop(self, interval: float):
+        while not self._stop.wait(interval):
+            self.sweep()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Session / flow state backends for Viser AI.
+
+Small JSON-value key/value stores with TTLs and atomic read-modify-write:
+
+- MemoryStore: process-local (the default, single `socketio.run` process).
+- SQLiteStore: a table in the shared chat_history.db, so several worker
+  processes on one host see the same email-flow state, automation lock and
+  session versions. update() runs under BEGIN IMMEDIATE, so concurrent
+  updates from different processes serialize instead of losing writes.
+
+Select with STATE_BACKEND=memory|sqlite (see create_store).
+"""
+import copy
+import json
+import threading
+import time
+
+
+class StateStore:
+    """Interface. Values must be JSON-serialisable; ttl is in seconds (None = no expiry)."""
+
+    shared = False
+
+    def get(self, key: str, default=None):
+        raise NotImplementedError
+
+    def set(self, key: str, value, ttl: float = None):
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        raise NotImplementedError
+
+    def add(self, key: str, value, ttl: float = None) -> bool:
+        """Set only if the key is absent (or expired); True if this call set it."""
+        raise NotImplementedError
+
+    def update(self, key: str, fn, default=None, ttl: float = None):
+        """Atomically replace the value with fn(current or default); returns the new value."""
+        raise NotImplementedError
+
+    def incr(self, key: str, amount: int = 1, ttl: float = None) -> int:
+        return self.update(key, lambda v: int(v or 0) + amount, 0, ttl)
+
+
+class MemoryStore(StateStore):
+    """Process-local store (values are copied in and out, as a shared backend would)."""
+
+    def __init__(self):
+        self._data = {}  # key -> (value, expires_at or None)
+        self._lock = threading.RLock()
+
+    def _live(self, key):
+        item = self._data.get(key)
+        if item and item[1] is not None and item[1] <= time.time():
+            del self._data[key]
+            return None
+        return item
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._live(key)
+            return copy.deepcopy(item[0]) if item else default
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (copy.deepcopy(value), time.time() + ttl if ttl else None)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def add(self, key, value, ttl=None):
+        with self._lock:
+            if self._live(key):
+                return False
+            self.set(key, value, ttl)
+            return True
+
+    def update(self, key, fn, default=None, ttl=None):
+        with self._lock:
+            item = self._live(key)
+            value = fn(copy.deepcopy(item[0]) if item else copy.deepcopy(default))
+            self.set(key, value, ttl)
+            return copy.deepcopy(value)
+
+
+class SQLiteStore(StateStore):
+    """Store in a `kv_state` table, shared by every process using the same database file."""
+
+    shared = True
+    PURGE_EVERY = 500  # writes between expired-row purges
+
+    def __init__(self, pool, table: str = "kv_state"):
+        self.pool = pool
+        self.table = table
+        self._writes = 0
+        with self.pool.connection() as conn:
+            conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS {table} (
+                    key        TEXT PRIMARY KEY,
+                    value      TEXT NOT NULL,
+                    expires_at REAL
+                )
+            """)
+
+    def _read(self, conn, key):
+        row = conn.execute(f"SELECT value, expires_at FROM {self.table} WHERE key=?", (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return None
+        return row
+
+    def _write(self, conn, key, value, ttl):
+        conn.execute(f"INSERT OR REPLACE INTO {self.table}(key, value, expires_at) VALUES(?,?,?)",
+                     (key, json.dumps(value), time.time() + ttl if ttl else None))
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            conn.execute(f"DELETE FROM {self.table} WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),))
+
+    def get(self, key, default=None):
+        with self.pool.connection() as conn:
+            row = self._read(conn, key)
+        return json.loads(row[0]) if row else default
+
+    def set(self, key, value, ttl=None):
+        with self.pool.connection() as conn:
+            self._write(conn, key, value, ttl)
+
+    def delete(self, key):
+        with self.pool.connection() as conn:
+            conn.execute(f"DELETE FROM {self.table} WHERE key=?", (key,))
+
+    def add(self, key, value, ttl=None):
+        with self.pool.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if self._read(conn, key):
+                return False
+            self._write(conn, key, value, ttl)
+            return True
+
+    def update(self, key, fn, default=None, ttl=None):
+        with self.pool.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = self._read(conn, key)
+            value = fn(json.loads(row[0]) if row else copy.deepcopy(default))
+            self._write(conn, key, value, ttl)
+            return value
+
+
+def create_store(backend: str = "memory", pool=None) -> StateStore:
+    """StateStore for STATE_BACKEND: 'memory' (default) or 'sqlite' (needs a db_pool.ConnectionPool)."""
+    backend = (backend or "memory").strip().lower()
+    if backend == "sqlite":
+        if pool is None:
+            raise ValueError("sqlite state backend needs a connection pool")
+        return SQLiteStore(pool)
+    if backend != "memory":
+        print(f"⚠️ Unknown STATE_BACKEND '{backend}', using in-memory state")
+    return MemoryStore()
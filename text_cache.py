@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+Extracted-text cache for Viser AI uploads.
+
+PDF/DOCX text extraction is pure CPU and the same upload is read by several
+routes (analyze, summarize-files, HR, BA/QA). Results are keyed by the file's
+sha256 plus an extractor version, kept gzip-compressed on disk and fronted by
+a small in-memory LRU, so repeat reads cost a hash lookup instead of a parse.
+
+The sha256 of a path is memoised on (size, mtime), so a cache hit does not
+re-hash the file. forget(path) drops a file's entries when its upload is
+deleted; the disk tier is also capped as a safety net for temp files. Its size is
+a running total (measured once, at startup), so a miss only walks the
+directory when the total actually crosses the cap.
+"""
+import gzip
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+
+def file_sha256(path: str, block_size: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class ExtractionCache:
+    """Two-tier (memory LRU + gzip files) cache of extracted text."""
+
+    def __init__(self, cache_dir: str, max_memory_bytes: int = 64 * 1024 * 1024,
+                 max_disk_bytes: int = 1024 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()  # key -> text
+        self._memory_bytes = 0
+        self._disk_bytes = self._measure_disk()  # running size of the disk tier
+        self._digests = {}            # path -> (size, mtime_ns, sha256)
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self.hits = {"memory": 0, "disk": 0}
+        self.misses = 0
+
+    # ── keys ─────────────────────────────────────────────────────────────────
+    def digest(self, path: str) -> str:
+        st = os.stat(path)
+        with self._lock:
+            known = self._digests.get(path)
+        if known and known[:2] == (st.st_size, st.st_mtime_ns):
+            return known[2]
+        sha = file_sha256(path)
+        with self._lock:
+            self._digests[path] = (st.st_size, st.st_mtime_ns, sha)
+        return sha
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[-2:], key + ".txt.gz")
+
+    # ── lookups ──────────────────────────────────────────────────────────────
+    def get_or_extract(self, path: str, kind: str, version: str, extractor) -> str:
+        """Cached text for (sha256(path), kind, version); runs extractor(path) on a miss.
+
+        Exceptions from the extractor propagate and nothing is cached.
+        """
+        sha = self.digest(path)
+        key = f"{kind}-{version}-{sha}"
+        text = self._memory_get(key)
+        if text is not None:
+            return text
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        try:
+            with key_lock:  # concurrent readers of the same file parse it once
+                text = self._memory_get(key)
+                if text is not None:
+                    return text
+                text = self._disk_get(key)
+                if text is None:
+                    self.misses += 1
+                    text = extractor(path)
+                    self._disk_put(key, text)
+                self._memory_put(key, text)
+                return text
+        finally:
+            with self._lock:
+                self._key_locks.pop(key, None)
+
+    def _memory_get(self, key):
+        with self._lock:
+            text = self._memory.get(key)
+            if text is not None:
+                self._memory.move_to_end(key)
+                self.hits["memory"] += 1
+            return text
+
+    def _memory_put(self, key, text):
+        size = len(text)
+        if size > self.max_memory_bytes:
+            return
+        with self._lock:
+            old = self._memory.pop(key, None)
+            if old is not None:
+                self._memory_bytes -= len(old)
+            self._memory[key] = text
+            self._memory_bytes += size
+            while self._memory_bytes > self.max_memory_bytes and self._memory:
+                _, dropped = self._memory.popitem(last=False)
+                self._memory_bytes -= len(dropped)
+
+    def _disk_get(self, key):
+        try:
+            with gzip.open(self._disk_path(key), "rt", encoding="utf-8") as f:
+                text = f.read()
+        except (FileNotFoundError, OSError, EOFError):
+            return None
+        self.hits["disk"] += 1
+        return text
+
+    def _disk_put(self, key, text):
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with gzip.open(tmp, "wt", encoding="utf-8", compresslevel=6) as f:
+                f.write(text)
+            try:
+                replaced = os.path.getsize(path)
+            except OSError:
+                replaced = 0
+            size = os.path.getsize(tmp)
+            os.replace(tmp, path)
+            if self._add_disk_bytes(size - replaced) > self.max_disk_bytes:
+                self._prune_disk()
+        except OSError as e:
+            print(f"⚠️ Text cache write error: {e}")
+
+    def _add_disk_bytes(self, delta: int) -> int:
+        with self._lock:
+            self._disk_bytes += delta
+            return self._disk_bytes
+
+    def _measure_disk(self) -> int:
+        total = 0
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                try:
+                    total += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        return total
+
+    def _prune_disk(self):
+        """Bring the disk tier down to 90% of max_disk_bytes, dropping least recently written files.
+
+        Only called when the running total crosses the cap; the slack means the next writes do
+        not walk the tree again. Re-measuring also corrects drift in the running total (e.g.
+        files written or removed by another worker process).
+        """
+        files = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                p = os.path.join(root, name)
+                try:
+                    st = os.stat(p)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, p))
+        total = sum(size for _, size, _ in files)
+        target = self.max_disk_bytes * 0.9
+        for _, size, p in sorted(files):
+            if total <= target:
+                break
+            try:
+                os.remove(p)
+                total -= size
+            except OSError:
+                pass
+        with self._lock:
+            self._disk_bytes = total
+
+    # ── lifecycle ────────────────────────────────────────────────────────────
+    def forget_digest(self, sha: str):
+        """Drop every cached extraction of content with this sha256."""
+        with self._lock:
+            for key in [k for k in self._memory if k.endswith("-" + sha)]:
+                self._memory_bytes -= len(self._memory.pop(key))
+            for path in [p for p, d in self._digests.items() if d[2] == sha]:
+                del self._digests[path]
+        folder = os.path.join(self.cache_dir, sha[-2:])
+        try:
+            for name in os.listdir(folder):
+                if name.endswith(f"-{sha}.txt.gz"):
+                    path = os.path.join(folder, name)
+                    size = os.path.getsize(path)
+                    os.remove(path)
+                    self._add_disk_bytes(-size)
+        except OSError:
+            pass
+
+    def forget(self, path: str):
+        """Drop cached text for a file whose upload is being deleted (call before removing it)."""
+        with self._lock:
+            known = self._digests.get(path)
+        sha = known[2] if known else None
+        if sha is None and os.path.exists(path):
+            sha = file_sha256(path)
+        if sha:
+            self.forget_digest(sha)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"memory_entries": len(self._memory), "memory_bytes": self._memory_bytes,
+                    "memory_hits": self.hits["memory"], "disk_hits": self.hits["disk"], "misses": self.misses,
+                    "disk_bytes": self._disk_bytes}
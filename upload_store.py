@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Streaming upload helpers for Viser AI.
+
+Uploads never pass through memory whole: the multipart parser writes each file
+part into a HashingSpool (a SpooledTemporaryFile that hashes with sha256 and
+enforces a size cap as bytes arrive), and request bodies of the resumable
+chunked-upload API are copied to disk chunk by chunk with copy_stream().
+Memory per upload is O(chunk size) either way.
+"""
+import hashlib
+import os
+import tempfile
+
+from werkzeug.exceptions import RequestEntityTooLarge
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class UploadTooLarge(RequestEntityTooLarge):
+    """Upload exceeds its size limit (HTTP 413). Raised while the body is still being read."""
+
+    def __init__(self, limit: int, filename: str = None):
+        self.limit = limit
+        self.filename = filename
+        what = f"'{filename}'" if filename else "Upload"
+        super().__init__(f"{what} exceeds the {limit / (1024 * 1024):g} MB limit for its file type")
+
+
+class HashingSpool:
+    """File-like sink for one multipart file part: spooled to disk, sha256'd, size-capped.
+
+    Small parts stay in memory (up to spool_bytes); larger ones roll over to a
+    temp file in `dir`. Supports what werkzeug's FileStorage needs (read, seek, ...).
+    """
+
+    def __init__(self, max_bytes: int = 0, filename: str = None, dir: str = None,
+                 spool_bytes: int = CHUNK_SIZE):
+        self.max_bytes = max_bytes
+        self.filename = filename
+        self.size = 0
+        self._hash = hashlib.sha256()
+        self._file = tempfile.SpooledTemporaryFile(max_size=spool_bytes, dir=dir)
+
+    def write(self, data) -> int:
+        self.size += len(data)
+        if self.max_bytes and self.size > self.max_bytes:
+            self._file.close()
+            raise UploadTooLarge(self.max_bytes, self.filename)
+        self._hash.update(data)
+        return self._file.write(data)
+
+    @property
+    def sha256(self) -> str:
+        return self._hash.hexdigest()
+
+    def save_to(self, path: str) -> str:
+        """Copy the spooled bytes to path (chunked); returns path."""
+        self._file.seek(0)
+        with open(path, "wb") as out:
+            copy_stream(self._file, out)
+        return path
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def __iter__(self):
+        return iter(self._file)
+
+
+def copy_stream(src, dst, max_bytes: int = 0, hasher=None, chunk_size: int = CHUNK_SIZE,
+                filename: str = None) -> int:
+    """Copy src to dst in chunk_size pieces, updating hasher; raises UploadTooLarge past max_bytes."""
+    copied = 0
+    while True:
+        chunk = src.read(chunk_size)
+        if not chunk:
+            return copied
+        copied += len(chunk)
+        if max_bytes and copied > max_bytes:
+            raise UploadTooLarge(max_bytes, filename)
+        if hasher is not None:
+            hasher.update(chunk)
+        dst.write(chunk)
+
+
+def sweep_stale(dir: str, max_age: float, now: float) -> int:
+    """Remove files in dir older than max_age seconds (abandoned partial uploads)."""
+    removed = 0
+    try:
+        names = os.listdir(dir)
+    except OSError:
+        return 0
+    for name in names:
+        path = os.path.join(dir, name)
+        try:
+            if now - os.path.getmtime(path) > max_age:
+                os.remove(path)
+                removed += 1
+        except OSError:
+            pass
+    return removed